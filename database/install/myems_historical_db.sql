@@ -37,6 +37,8 @@ CREATE TABLE IF NOT EXISTS `myems_historical_db`.`tbl_analog_value_latest` (
 CREATE INDEX `tbl_analog_value_latest_index_1`
 ON `myems_historical_db`.`tbl_analog_value_latest` (`point_id`, `utc_date_time`);
 CREATE INDEX `tbl_analog_value_latest_index_2` ON `myems_historical_db`.`tbl_analog_value_latest` (`utc_date_time`);
+CREATE UNIQUE INDEX `tbl_analog_value_latest_index_3`
+ON `myems_historical_db`.`tbl_analog_value_latest` (`point_id`);
 
 -- ---------------------------------------------------------------------------------------------------------------------
 -- Table `myems_historical_db`.`tbl_cost_files`
@@ -82,6 +84,8 @@ CREATE TABLE IF NOT EXISTS `myems_historical_db`.`tbl_digital_value_latest` (
 CREATE INDEX `tbl_digital_value_latest_index_1`
 ON `myems_historical_db`.`tbl_digital_value_latest` (`point_id`, `utc_date_time`);
 CREATE INDEX `tbl_digital_value_latest_index_2` ON `myems_historical_db`.`tbl_digital_value_latest` (`utc_date_time`);
+CREATE UNIQUE INDEX `tbl_digital_value_latest_index_3`
+ON `myems_historical_db`.`tbl_digital_value_latest` (`point_id`);
 
 -- ---------------------------------------------------------------------------------------------------------------------
 -- Table `myems_historical_db`.`tbl_energy_value`
@@ -99,6 +103,18 @@ CREATE TABLE IF NOT EXISTS `myems_historical_db`.`tbl_energy_value` (
 CREATE INDEX `tbl_energy_value_index_1` ON `myems_historical_db`.`tbl_energy_value` (`point_id`, `utc_date_time`);
 CREATE INDEX `tbl_energy_value_index_2` ON `myems_historical_db`.`tbl_energy_value` (`utc_date_time`);
 
+-- ---------------------------------------------------------------------------------------------------------------------
+-- Table `myems_historical_db`.`tbl_energy_value_cleaning_watermarks`
+-- ---------------------------------------------------------------------------------------------------------------------
+DROP TABLE IF EXISTS `myems_historical_db`.`tbl_energy_value_cleaning_watermarks` ;
+
+CREATE TABLE IF NOT EXISTS `myems_historical_db`.`tbl_energy_value_cleaning_watermarks` (
+  `point_id` BIGINT NOT NULL,
+  `last_id` BIGINT NOT NULL COMMENT 'The last id of energy values tagged by incremental cleaning',
+  `last_utc_date_time` DATETIME NULL COMMENT 'The date time in UTC of the last good energy value',
+  `base_value` DECIMAL(21, 6) NULL COMMENT 'The base value of the concave shape model',
+  PRIMARY KEY (`point_id`));
+
 -- ---------------------------------------------------------------------------------------------------------------------
 -- Table `myems_historical_db`.`tbl_energy_value_latest`
 -- ---------------------------------------------------------------------------------------------------------------------
@@ -113,6 +129,8 @@ CREATE TABLE IF NOT EXISTS `myems_historical_db`.`tbl_energy_value_latest` (
 CREATE INDEX `tbl_energy_value_latest_index_1`
 ON `myems_historical_db`.`tbl_energy_value_latest` (`point_id`, `utc_date_time`);
 CREATE INDEX `tbl_energy_value_latest_index_2` ON `myems_historical_db`.`tbl_energy_value_latest` (`utc_date_time`);
+CREATE UNIQUE INDEX `tbl_energy_value_latest_index_3`
+ON `myems_historical_db`.`tbl_energy_value_latest` (`point_id`);
 
 
 -- ---------------------------------------------------------------------------------------------------------------------
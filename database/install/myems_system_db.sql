@@ -239,6 +239,9 @@ CREATE TABLE IF NOT EXISTS `myems_system_db`.`tbl_data_sources` (
   `connection` LONGTEXT NOT NULL COMMENT 'MUST be in JSON format',
   `process_id` BIGINT,
   `last_seen_datetime_utc` DATETIME NULL  COMMENT 'The last seen date time in UTC via PING or TELNET',
+  `restart_count` INT NOT NULL DEFAULT 0 COMMENT 'The number of restarts of acquisition worker',
+  `last_exit_reason` VARCHAR(255) NULL COMMENT 'The reason of the last unexpected exit of acquisition worker',
+  `last_exit_datetime_utc` DATETIME NULL COMMENT 'The date time in UTC of the last unexpected exit of acquisition worker',
   `description` VARCHAR(255),
   PRIMARY KEY (`id`));
 CREATE INDEX `tbl_data_sources_index_1` ON `myems_system_db`.`tbl_data_sources` (`name`);
@@ -816,6 +819,9 @@ CREATE TABLE IF NOT EXISTS `myems_system_db`.`tbl_gateways` (
   `uuid` CHAR(36) NOT NULL,
   `token` CHAR(36) NOT NULL,
   `last_seen_datetime_utc` DATETIME NULL  COMMENT 'The last seen date time in UTC via PING, TELNET or Heartbeat',
+  `cpu_usage_percent` DECIMAL(5, 2) NULL COMMENT 'CPU usage of gateway host reported by Heartbeat',
+  `memory_usage_percent` DECIMAL(5, 2) NULL COMMENT 'Memory usage of gateway host reported by Heartbeat',
+  `disk_usage_percent` DECIMAL(5, 2) NULL COMMENT 'Disk usage of gateway host reported by Heartbeat',
   `description` VARCHAR(255) ,
   PRIMARY KEY (`id`));
 CREATE INDEX `tbl_gateways_index_1` ON `myems_system_db`.`tbl_gateways` (`name`);
@@ -0,0 +1,35 @@
+-- NOTE: this script is DANGEROUS and may cause data loss so it is for advanced users only
+-- 注意: 这个脚本很危险，可能会造成数据丢失，仅限高级用户使用
+-- NOTE: backup myems_historical_db before running this script, it rebuilds the tables and may take a long time
+-- 注意：运行这个脚本前必须备份myems_historical_db，这个脚本会重建数据表，可能需要很长时间
+-- NOTE: before running this script, you should stop all the acquisition services and the myems-cleaning service
+-- 注意：运行这个脚本前必须停止所有采集服务和myems-cleaning服务
+-- NOTE: after running this script, set RETENTION_MODE=partition in .env of myems-cleaning and start the services,
+--       monthly partitions are created ahead of time and expired partitions are dropped by myems-cleaning
+-- 注意：运行这个脚本后在myems-cleaning的.env中设置RETENTION_MODE=partition并启动服务，
+--       myems-cleaning会提前创建按月的分区并删除过期的分区
+-- NOTE: the utc_date_time in database are in UTC
+-- 注意：数据库中的utc_date_time是UTC时间
+
+-- the partitioning column must be a part of every unique key of the table
+ALTER TABLE `myems_historical_db`.`tbl_analog_value` DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `utc_date_time`);
+ALTER TABLE `myems_historical_db`.`tbl_digital_value` DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `utc_date_time`);
+
+-- the existing values are kept in one partition before the next month
+SET @next_month = DATE_FORMAT(DATE_ADD(UTC_TIMESTAMP(), INTERVAL 1 MONTH), '%Y-%m-01 00:00:00');
+
+SET @partition_analog_value = CONCAT(
+  'ALTER TABLE `myems_historical_db`.`tbl_analog_value` PARTITION BY RANGE COLUMNS(`utc_date_time`) (',
+  ' PARTITION phistory VALUES LESS THAN (''', @next_month, '''),',
+  ' PARTITION pmax VALUES LESS THAN (MAXVALUE))');
+PREPARE statement FROM @partition_analog_value;
+EXECUTE statement;
+DEALLOCATE PREPARE statement;
+
+SET @partition_digital_value = CONCAT(
+  'ALTER TABLE `myems_historical_db`.`tbl_digital_value` PARTITION BY RANGE COLUMNS(`utc_date_time`) (',
+  ' PARTITION phistory VALUES LESS THAN (''', @next_month, '''),',
+  ' PARTITION pmax VALUES LESS THAN (MAXVALUE))');
+PREPARE statement FROM @partition_digital_value;
+EXECUTE statement;
+DEALLOCATE PREPARE statement;
@@ -11,6 +11,42 @@ START TRANSACTION;
 
 DROP TABLE IF EXISTS `myems_system_db`.`tbl_energy_storage_containers_sensors` ;
 
+-- latest values are upserted on point_id
+DELETE l1 FROM `myems_historical_db`.`tbl_analog_value_latest` l1
+INNER JOIN `myems_historical_db`.`tbl_analog_value_latest` l2 ON l1.point_id = l2.point_id AND l1.id < l2.id;
+CREATE UNIQUE INDEX `tbl_analog_value_latest_index_3`
+ON `myems_historical_db`.`tbl_analog_value_latest` (`point_id`);
+
+DELETE l1 FROM `myems_historical_db`.`tbl_digital_value_latest` l1
+INNER JOIN `myems_historical_db`.`tbl_digital_value_latest` l2 ON l1.point_id = l2.point_id AND l1.id < l2.id;
+CREATE UNIQUE INDEX `tbl_digital_value_latest_index_3`
+ON `myems_historical_db`.`tbl_digital_value_latest` (`point_id`);
+
+DELETE l1 FROM `myems_historical_db`.`tbl_energy_value_latest` l1
+INNER JOIN `myems_historical_db`.`tbl_energy_value_latest` l2 ON l1.point_id = l2.point_id AND l1.id < l2.id;
+CREATE UNIQUE INDEX `tbl_energy_value_latest_index_3`
+ON `myems_historical_db`.`tbl_energy_value_latest` (`point_id`);
+
+-- host resource usage of gateways reported by heartbeat
+ALTER TABLE `myems_system_db`.`tbl_gateways`
+ADD `cpu_usage_percent` DECIMAL(5, 2) NULL COMMENT 'CPU usage of gateway host reported by Heartbeat' AFTER `last_seen_datetime_utc`,
+ADD `memory_usage_percent` DECIMAL(5, 2) NULL COMMENT 'Memory usage of gateway host reported by Heartbeat' AFTER `cpu_usage_percent`,
+ADD `disk_usage_percent` DECIMAL(5, 2) NULL COMMENT 'Disk usage of gateway host reported by Heartbeat' AFTER `memory_usage_percent`;
+
+-- restarts of acquisition workers supervised by gateways
+ALTER TABLE `myems_system_db`.`tbl_data_sources`
+ADD `restart_count` INT NOT NULL DEFAULT 0 COMMENT 'The number of restarts of acquisition worker' AFTER `last_seen_datetime_utc`,
+ADD `last_exit_reason` VARCHAR(255) NULL COMMENT 'The reason of the last unexpected exit of acquisition worker' AFTER `restart_count`,
+ADD `last_exit_datetime_utc` DATETIME NULL COMMENT 'The date time in UTC of the last unexpected exit of acquisition worker' AFTER `last_exit_reason`;
+
+-- watermarks of incremental energy value cleaning
+CREATE TABLE IF NOT EXISTS `myems_historical_db`.`tbl_energy_value_cleaning_watermarks` (
+  `point_id` BIGINT NOT NULL,
+  `last_id` BIGINT NOT NULL COMMENT 'The last id of energy values tagged by incremental cleaning',
+  `last_utc_date_time` DATETIME NULL COMMENT 'The date time in UTC of the last good energy value',
+  `base_value` DECIMAL(21, 6) NULL COMMENT 'The base value of the concave shape model',
+  PRIMARY KEY (`point_id`));
+
 -- UPDATE VERSION NUMBER
 UPDATE `myems_system_db`.`tbl_versions` SET version='5.7.0RC', release_date='2025-07-21' WHERE id=1;
 
@@ -7,16 +7,21 @@ from multiprocessing import Pool
 import mysql.connector
 
 import config
+import connection
 
 
 ########################################################################################################################
 # PROCEDURES
 # Step 1: get all combined equipments
-# Step 2: Create multiprocessing pool to call worker in parallel
+# Step 2: Call worker in parallel by the multiprocessing pool
 ########################################################################################################################
 
 
 def main(logger):
+    # the pool is kept across cycles, and every worker process keeps its connection pools, see connection.py
+    p = Pool(processes=config.pool_size,
+             initializer=connection.initialize,
+             initargs=(logger, (config.myems_system_db, config.myems_energy_db)))
 
     while True:
         # the outermost while loop
@@ -72,12 +77,13 @@ def main(logger):
         random.shuffle(combined_equipment_list)
 
         ################################################################################################################
-        # Step 2: Create multiprocessing pool to call worker in parallel
+        # Step 2: Call worker in parallel by the multiprocessing pool
         ################################################################################################################
-        p = Pool(processes=config.pool_size)
-        error_list = p.map(worker, combined_equipment_list)
-        p.close()
-        p.join()
+        try:
+            error_list = p.map(worker, combined_equipment_list)
+        except Exception as e:
+            # a task raised an error instead of returning it, go on with the next cycle
+            error_list = ["Error in step 2 of combined_equipment_energy_input_item.main " + str(e)]
 
         for error in error_list:
             if error is not None and len(error) > 0:
@@ -117,14 +123,14 @@ def worker(combined_equipment):
     cnx_system_db = None
     cursor_system_db = None
     try:
-        cnx_system_db = mysql.connector.connect(**config.myems_system_db)
+        cnx_system_db = connection.connect(config.myems_system_db)
         cursor_system_db = cnx_system_db.cursor()
     except Exception as e:
         error_string = "Error in step 1.1 of combined_equipment_energy_input_item.worker " + str(e)
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
         print(error_string)
         return error_string
 
@@ -150,7 +156,7 @@ def worker(combined_equipment):
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
         print(error_string)
         return error_string
 
@@ -182,7 +188,7 @@ def worker(combined_equipment):
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
         print(error_string)
         return error_string
 
@@ -215,7 +221,7 @@ def worker(combined_equipment):
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
         print(error_string)
         return error_string
 
@@ -248,7 +254,7 @@ def worker(combined_equipment):
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
 
     ####################################################################################################################
     # stop to the next combined equipment if this combined equipment is empty
@@ -267,14 +273,14 @@ def worker(combined_equipment):
     cnx_energy_db = None
     cursor_energy_db = None
     try:
-        cnx_energy_db = mysql.connector.connect(**config.myems_energy_db)
+        cnx_energy_db = connection.connect(config.myems_energy_db)
         cursor_energy_db = cnx_energy_db.cursor()
     except Exception as e:
         error_string = "Error in step 5.1 of combined_equipment_energy_input_item.worker " + str(e)
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -304,7 +310,7 @@ def worker(combined_equipment):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -336,7 +342,7 @@ def worker(combined_equipment):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -368,7 +374,7 @@ def worker(combined_equipment):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             print(error_string)
             return error_string
 
@@ -401,7 +407,7 @@ def worker(combined_equipment):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             print(error_string)
             return error_string
 
@@ -438,7 +444,7 @@ def worker(combined_equipment):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             print(error_string)
             return error_string
 
@@ -515,7 +521,7 @@ def worker(combined_equipment):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         return None
 
     print("common_start_datetime_utc: " + str(common_start_datetime_utc))
@@ -578,7 +584,7 @@ def worker(combined_equipment):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -615,11 +621,11 @@ def worker(combined_equipment):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             return error_string
 
     if cursor_energy_db:
         cursor_energy_db.close()
     if cnx_energy_db:
-        cnx_energy_db.close()
+        connection.release(cnx_energy_db)
     return None
@@ -7,16 +7,21 @@ from multiprocessing import Pool
 import mysql.connector
 
 import config
+import connection
 
 
 ########################################################################################################################
 # PROCEDURES
 # Step 1: get all combined equipments
-# Step 2: Create multiprocessing pool to call worker in parallel
+# Step 2: Call worker in parallel by the multiprocessing pool
 ########################################################################################################################
 
 
 def main(logger):
+    # the pool is kept across cycles, and every worker process keeps its connection pools, see connection.py
+    p = Pool(processes=config.pool_size,
+             initializer=connection.initialize,
+             initargs=(logger, (config.myems_system_db, config.myems_energy_db)))
 
     while True:
         # the outermost while loop
@@ -72,12 +77,13 @@ def main(logger):
         random.shuffle(combined_equipment_list)
 
         ################################################################################################################
-        # Step 2: Create multiprocessing pool to call worker in parallel
+        # Step 2: Call worker in parallel by the multiprocessing pool
         ################################################################################################################
-        p = Pool(processes=config.pool_size)
-        error_list = p.map(worker, combined_equipment_list)
-        p.close()
-        p.join()
+        try:
+            error_list = p.map(worker, combined_equipment_list)
+        except Exception as e:
+            # a task raised an error instead of returning it, go on with the next cycle
+            error_list = ["Error in step 2 of combined_equipment_energy_output_category.main " + str(e)]
 
         for error in error_list:
             if error is not None and len(error) > 0:
@@ -117,14 +123,14 @@ def worker(combined_equipment):
     cnx_system_db = None
     cursor_system_db = None
     try:
-        cnx_system_db = mysql.connector.connect(**config.myems_system_db)
+        cnx_system_db = connection.connect(config.myems_system_db)
         cursor_system_db = cnx_system_db.cursor()
     except Exception as e:
         error_string = "Error in step 1.1 of combined_equipment_energy_output_category.worker " + str(e)
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
         print(error_string)
         return error_string
 
@@ -149,7 +155,7 @@ def worker(combined_equipment):
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
         print(error_string)
         return error_string
 
@@ -180,7 +186,7 @@ def worker(combined_equipment):
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
         print(error_string)
         return error_string
 
@@ -212,7 +218,7 @@ def worker(combined_equipment):
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
         print(error_string)
         return error_string
 
@@ -245,7 +251,7 @@ def worker(combined_equipment):
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
 
     ####################################################################################################################
     # stop to the next combined equipment if this combined 3equipment is empty
@@ -264,14 +270,14 @@ def worker(combined_equipment):
     cnx_energy_db = None
     cursor_energy_db = None
     try:
-        cnx_energy_db = mysql.connector.connect(**config.myems_energy_db)
+        cnx_energy_db = connection.connect(config.myems_energy_db)
         cursor_energy_db = cnx_energy_db.cursor()
     except Exception as e:
         error_string = "Error in step 5.1 of combined_equipment_energy_output_category.worker " + str(e)
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -301,7 +307,7 @@ def worker(combined_equipment):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -333,7 +339,7 @@ def worker(combined_equipment):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -365,7 +371,7 @@ def worker(combined_equipment):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             print(error_string)
             return error_string
 
@@ -398,7 +404,7 @@ def worker(combined_equipment):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             print(error_string)
             return error_string
 
@@ -435,7 +441,7 @@ def worker(combined_equipment):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             print(error_string)
             return error_string
 
@@ -512,7 +518,7 @@ def worker(combined_equipment):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         return None
 
     print("common_start_datetime_utc: " + str(common_start_datetime_utc))
@@ -575,7 +581,7 @@ def worker(combined_equipment):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -612,11 +618,11 @@ def worker(combined_equipment):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             return error_string
 
     if cursor_energy_db:
         cursor_energy_db.close()
     if cnx_energy_db:
-        cnx_energy_db.close()
+        connection.release(cnx_energy_db)
     return None
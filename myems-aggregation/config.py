@@ -57,3 +57,8 @@ utc_offset = config('UTC_OFFSET', default='+08:00')
 # the pool size depends on the computing performance of the database server and the analysis server
 pool_size = config('POOL_SIZE', default=5, cast=int)
 
+# the number of connections kept to each database by every worker process, tasks borrow connections from them
+# NOTE: worker processes keep their connections across cycles, the max_connections of MySQL should allow for
+# POOL_SIZE * CONNECTION_POOL_SIZE connections to each database from every calculating process of the service
+connection_pool_size = config('CONNECTION_POOL_SIZE', default=1, cast=int)
+
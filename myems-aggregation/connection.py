@@ -0,0 +1,78 @@
+import mysql.connector
+from mysql.connector import pooling
+from mysql.connector.errors import PoolError
+
+import config
+
+
+########################################################################################################################
+# Per-process connection pools of worker processes.
+# The pools of worker processes are created once and kept across cycles with initialize as the initializer, and every
+# worker process keeps a small connection pool for each database, so that tasks borrow connections with connect and
+# give them back with release, instead of opening and closing their own connections to MySQL in every task.
+# A borrowed connection is reconnected by the pool if it is lost, and its session is reset when it is given back.
+#
+# NOTE: the same module is kept in myems-normalization and myems-aggregation, as every service is deployed on its own,
+# changes should be made to both copies.
+########################################################################################################################
+
+# the connection pools of this process by database
+pool_dict = dict()
+
+
+def initialize(logger, database_config_list):
+    """
+    the initializer of worker processes, create the connection pools of the process
+    :param logger: logger of the service
+    :param database_config_list: list of the configs of databases used by the tasks, such as config.myems_system_db
+    """
+    global pool_dict
+    # NOTE: a worker process forked from a process with connection pools must not share the sockets of them
+    pool_dict = dict()
+    for database_config in database_config_list:
+        try:
+            get_pool(database_config)
+        except Exception as e:
+            # no pool is kept for the database, and every task which borrows a connection tries to create it again
+            logger.error("Error in creating connection pool of " + database_config['database'] + " " + str(e))
+
+
+def get_pool(database_config):
+    pool = pool_dict.get(database_config['database'])
+    if pool is None:
+        pool = pooling.MySQLConnectionPool(pool_name=database_config['database'],
+                                           pool_size=config.connection_pool_size,
+                                           pool_reset_session=True,
+                                           **database_config)
+        pool_dict[database_config['database']] = pool
+    return pool
+
+
+def connect(database_config):
+    """
+    borrow a connection to the database from the connection pool of the process, close gives it back to the pool
+    :param database_config: the config of the database, such as config.myems_system_db
+    """
+    try:
+        return get_pool(database_config).get_connection()
+    except PoolError:
+        # all connections of the pool are borrowed, the task opens its own connection
+        return mysql.connector.connect(**database_config)
+
+
+def release(cnx):
+    """
+    give a borrowed connection back to the connection pool, or close a connection opened by the task.
+    resetting the session of a lost connection or of a connection with unread results raises an error,
+    then the connection is discarded by disconnecting it, and the pool reconnects it when it is borrowed again
+    :param cnx: the connection returned by connect
+    """
+    # the connection wrapped by a pooled connection, it is None after the pooled connection is given back
+    wrapped_cnx = getattr(cnx, '_cnx', None)
+    try:
+        cnx.close()
+    except Exception:
+        try:
+            (wrapped_cnx or cnx).disconnect()
+        except Exception:
+            pass
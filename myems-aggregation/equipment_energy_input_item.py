@@ -7,16 +7,21 @@ from multiprocessing import Pool
 import mysql.connector
 
 import config
+import connection
 
 
 ########################################################################################################################
 # PROCEDURES
 # Step 1: get all equipments
-# Step 2: Create multiprocessing pool to call worker in parallel
+# Step 2: Call worker in parallel by the multiprocessing pool
 ########################################################################################################################
 
 
 def main(logger):
+    # the pool is kept across cycles, and every worker process keeps its connection pools, see connection.py
+    p = Pool(processes=config.pool_size,
+             initializer=connection.initialize,
+             initargs=(logger, (config.myems_system_db, config.myems_energy_db)))
 
     while True:
         # the outermost while loop
@@ -72,12 +77,13 @@ def main(logger):
         random.shuffle(equipment_list)
 
         ################################################################################################################
-        # Step 2: Create multiprocessing pool to call worker in parallel
+        # Step 2: Call worker in parallel by the multiprocessing pool
         ################################################################################################################
-        p = Pool(processes=config.pool_size)
-        error_list = p.map(worker, equipment_list)
-        p.close()
-        p.join()
+        try:
+            error_list = p.map(worker, equipment_list)
+        except Exception as e:
+            # a task raised an error instead of returning it, go on with the next cycle
+            error_list = ["Error in step 2 of equipment_energy_input_item.main " + str(e)]
 
         for error in error_list:
             if error is not None and len(error) > 0:
@@ -115,14 +121,14 @@ def worker(equipment):
     cnx_system_db = None
     cursor_system_db = None
     try:
-        cnx_system_db = mysql.connector.connect(**config.myems_system_db)
+        cnx_system_db = connection.connect(config.myems_system_db)
         cursor_system_db = cnx_system_db.cursor()
     except Exception as e:
         error_string = "Error in step 1.1 of equipment_energy_input_item.worker " + str(e)
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
         print(error_string)
         return error_string
 
@@ -148,7 +154,7 @@ def worker(equipment):
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
         print(error_string)
         return error_string
 
@@ -180,7 +186,7 @@ def worker(equipment):
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
         print(error_string)
         return error_string
 
@@ -216,7 +222,7 @@ def worker(equipment):
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
 
     ####################################################################################################################
     # stop to the next equipment if this equipment is empty
@@ -234,14 +240,14 @@ def worker(equipment):
     cnx_energy_db = None
     cursor_energy_db = None
     try:
-        cnx_energy_db = mysql.connector.connect(**config.myems_energy_db)
+        cnx_energy_db = connection.connect(config.myems_energy_db)
         cursor_energy_db = cnx_energy_db.cursor()
     except Exception as e:
         error_string = "Error in step 4.1 of equipment_energy_input_item.worker " + str(e)
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -271,7 +277,7 @@ def worker(equipment):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -303,7 +309,7 @@ def worker(equipment):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -335,7 +341,7 @@ def worker(equipment):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             print(error_string)
             return error_string
 
@@ -368,7 +374,7 @@ def worker(equipment):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             print(error_string)
             return error_string
 
@@ -430,7 +436,7 @@ def worker(equipment):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         return None
 
     print("common_start_datetime_utc: " + str(common_start_datetime_utc))
@@ -484,7 +490,7 @@ def worker(equipment):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -521,11 +527,11 @@ def worker(equipment):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             return error_string
 
     if cursor_energy_db:
         cursor_energy_db.close()
     if cnx_energy_db:
-        cnx_energy_db.close()
+        connection.release(cnx_energy_db)
     return None
@@ -5,6 +5,7 @@ import mysql.connector
 import schedule
 
 import config
+import retention
 
 
 def job(logger):
@@ -24,19 +25,19 @@ def job(logger):
 
     expired_utc = datetime.utcnow() - timedelta(days=config.live_in_days)
     try:
-        cursor_historical.execute(" DELETE "
-                                  " FROM tbl_digital_value "
-                                  " WHERE utc_date_time < %s ", (expired_utc,))
-        cnx_historical.commit()
+        rows_reclaimed, bytes_reclaimed = retention.purge(logger, cnx_historical, cursor_historical,
+                                                          'tbl_digital_value', expired_utc)
     except Exception as e:
         logger.error("Error in delete_expired_trend process " + str(e))
+        return
     finally:
         if cursor_historical:
             cursor_historical.close()
         if cnx_historical:
             cnx_historical.close()
 
-    logger.info("Deleted trend before date time in UTC: " + expired_utc.isoformat()[0:19])
+    logger.info("Deleted trend before date time in UTC: " + expired_utc.isoformat()[0:19] +
+                ", reclaimed " + str(rows_reclaimed) + " rows and " + str(bytes_reclaimed) + " bytes")
 
 
 def process(logger):
@@ -2,8 +2,11 @@ import time
 from datetime import datetime, timedelta, timezone
 
 import mysql.connector
+import numpy as np
 
+import cleaning_kernel
 import config
+import tagging
 
 
 ########################################################################################################################
@@ -240,31 +243,24 @@ def process(logger):
         bad_list = list()
 
         if rows_energy_values is not None and len(rows_energy_values) > 0:
-            for row_energy_value in rows_energy_values:
-                point_id = row_energy_value[1]
-                actual_value = row_energy_value[2]
-                point = point_dict.get(point_id, None)
-                if point is None or actual_value > point['high_limit'] or actual_value < point['low_limit']:
-                    bad_list.append(row_energy_value[0])
+            # check values of all points at once
+            ids = cleaning_kernel.to_array(rows_energy_values, 0, np.int64)
+            point_ids = cleaning_kernel.to_array(rows_energy_values, 1, np.int64)
+            values = cleaning_kernel.to_array(rows_energy_values, 2, np.float64)
+            bad_list = ids[cleaning_kernel.check_limits(point_ids, values, point_dict)].tolist()
 
         print('bad list: ' + str(bad_list))
-        while len(bad_list) > 0:
-            update_100 = bad_list[:100]
-            bad_list = bad_list[100:]
-            try:
-                update = (" UPDATE tbl_energy_value "
-                          " SET is_bad = 1 "
-                          " WHERE id IN (" + ', '.join(map(str, update_100)) + ")")
-                cursor_historical.execute(update, )
-                cnx_historical.commit()
-            except Exception as e:
-                logger.error("Error in step 2.3 of clean_energy_value.process " + str(e))
-                if cursor_historical:
-                    cursor_historical.close()
-                if cnx_historical:
-                    cnx_historical.close()
-                time.sleep(60)
-                continue
+        try:
+            tagging.tag_values(cursor_historical, bad_list)
+            cnx_historical.commit()
+        except Exception as e:
+            logger.error("Error in step 2.3 of clean_energy_value.process " + str(e))
+            if cursor_historical:
+                cursor_historical.close()
+            if cnx_historical:
+                cnx_historical.close()
+            time.sleep(60)
+            continue
 
         ################################################################################################################
         # Step 3: check bad case class 2 which is in concave shape model.
@@ -420,80 +416,31 @@ def process(logger):
             time.sleep(60)
             continue
 
-        point_value_dict = dict()
-        current_point_value_list = list()
-        current_point_id = 0
-
-        if rows_energy_values is not None and len(rows_energy_values) > 0:
-            for row_energy_value in rows_energy_values:
-                previous_point_id = current_point_id
-                current_point_id = row_energy_value[0]
-                if current_point_id not in point_value_dict.keys():
-                    # new point id found
-                    # save previous point values
-                    if len(current_point_value_list) > 0:
-                        point_value_dict[previous_point_id] = current_point_value_list
-                        current_point_value_list = list()
-
-                    current_point_value_list.append({'id': row_energy_value[1],
-                                                     'actual_value': row_energy_value[3]})
-                else:
-                    current_point_value_list.append({'id': row_energy_value[1],
-                                                     'actual_value': row_energy_value[3]})
-            # end of for loop
-            # save rest point values
-            if len(current_point_value_list) > 0:
-                point_value_dict[current_point_id] = current_point_value_list
-
         # reinitialize bad list
         bad_list = list()
 
-        for point_id, point_value_list in point_value_dict.items():
-            if len(point_value_list) <= 1:
-                continue
-            elif len(point_value_list) == 2:
-                if point_value_list[1]['actual_value'] < point_value_list[0]['actual_value']:
-                    bad_list.append(point_value_list[1]['id'])
-                continue
-            else:
-                base_point_value = point_value_list[0]['actual_value']
-                concave_point_value_list = list()
-                for i in range(len(point_value_list)):
-                    if point_value_list[i]['actual_value'] < base_point_value:
-                        # candidate concave value found
-                        concave_point_value_list.append(point_value_list[i]['id'])
-                    else:
-                        # normal value found
-                        if len(concave_point_value_list) > 0:
-                            # save confirmed concave value(s) to bad value(s)
-                            bad_list.extend(concave_point_value_list)
-
-                        # prepare for next candidate concave value list
-                        base_point_value = point_value_list[i]['actual_value']
-                        concave_point_value_list.clear()
-                continue
+        if rows_energy_values is not None and len(rows_energy_values) > 0:
+            # values of each point are contiguous arrays in date time order
+            point_ids = cleaning_kernel.to_array(rows_energy_values, 0, np.int64)
+            ids = cleaning_kernel.to_array(rows_energy_values, 1, np.int64)
+            values = cleaning_kernel.to_array(rows_energy_values, 3, np.float64)
+            bad_list = cleaning_kernel.find_bad_values(point_ids, ids, values).tolist()
 
         print('bad list: ' + str(bad_list))
-        while len(bad_list) > 0:
-            update_100 = bad_list[:100]
-            bad_list = bad_list[100:]
-            try:
-                update = (" UPDATE tbl_energy_value "
-                          " SET is_bad = 1 "
-                          " WHERE id IN (" + ', '.join(map(str, update_100)) + ")")
-                cursor_historical.execute(update, )
-                cnx_historical.commit()
-            except Exception as e:
-                logger.error("Error in step 3.2 of clean_energy_value.process " + str(e))
-                if cursor_historical:
-                    cursor_historical.close()
-                if cnx_historical:
-                    cnx_historical.close()
-                time.sleep(60)
-                continue
-
-        ################################################################################################################
-        # TODO: bad case 2.8
+        try:
+            tagging.tag_values(cursor_historical, bad_list)
+            cnx_historical.commit()
+        except Exception as e:
+            logger.error("Error in step 3.2 of clean_energy_value.process " + str(e))
+            if cursor_historical:
+                cursor_historical.close()
+            if cnx_historical:
+                cnx_historical.close()
+            time.sleep(60)
+            continue
+
+        ################################################################################################################
+        # TODO: bad case 2.8 in window mode, it is checked by spike detection in incremental mode
         # id          point_id utc_date_time          actual_value is_bad (expected)
         # 105752070    3333    2018-02-04 00:27:15    138144       good
         # 105752305    3333    2018-02-04 00:28:19    138144       good
@@ -520,7 +467,7 @@ def process(logger):
         ################################################################################################################
 
         ################################################################################################################
-        # TODO: bad case 2.10
+        # TODO: bad case 2.10 in window mode, it is checked by spike detection in incremental mode
         # id       point_id utc_date_time          actual_value   is_bad (expected)
         # 106363135 3336    2018-02-06 04:45:57    253079.015625  good
         # 106363776 3336    2018-02-06 04:49:09    253079.015625  good
@@ -539,7 +486,7 @@ def process(logger):
         ################################################################################################################
 
         ################################################################################################################
-        # TODO: bad case 2.11
+        # TODO: bad case 2.11 in window mode, it is checked by spike detection in incremental mode
         # id       point_id utc_date_time          actual_value   is_bad (expected)
         # 14784589 21	    2020-03-05 07:22:22    17990           good
         # 14784450 21	    2020-03-05 07:21:17    17990           good
@@ -555,7 +502,7 @@ def process(logger):
         ################################################################################################################
 
         ################################################################################################################
-        # TODO: bad case 2.12
+        # TODO: bad case 2.12 in window mode, it is checked by spike detection in incremental mode
         # id       point_id utc_date_time          actual_value   is_bad (expected)
         # 3337308  21       2020-01-07 09:02:18    7990           good
         # 3337174  21       2020-01-07 09:01:13    7990	          good
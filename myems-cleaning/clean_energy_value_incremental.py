@@ -0,0 +1,519 @@
+import bisect
+import queue
+import sys
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from multiprocessing import Process, Queue
+
+import mysql.connector
+import numpy as np
+
+import cleaning_kernel
+import config
+import tagging
+
+
+########################################################################################################################
+# This procedure will find and tag the bad energy values incrementally.
+# Every point has a cleaning watermark in tbl_energy_value_cleaning_watermarks, that is the last tagged id, the date
+# time of the last good value and the base value of the concave shape model. New values are read in bounded id-range
+# chunks, so that the table is never scanned in full and every transaction tags at most CLEANING_CHUNK_SIZE values.
+# See clean_energy_value.py for the bad cases, and cleaning_kernel.py for the spikes of bad case class 3.
+#
+# Points are independent, so they are split into CLEANING_POOL_SIZE shards by point id, and every shard is cleaned by
+# its own worker process with its own connection and the watermarks of its own points. The coordinator reads every
+# chunk once and hands the values of every shard to its worker, so the values are not read once for every shard.
+# The coordinator restarts the workers which exited, reads again from the watermarks of the restarted shards, where the
+# other workers skip the values they have cleaned, and merges the progress reported by the workers.
+#
+# Step 1: get the limits of points.
+# Step 2: get the id range to clean, and the cleaning watermarks of the workers.
+# Step 3: read the values in each chunk, and check bad case class 1, class 3 and class 2 of them in the workers.
+# Step 4: tag the is_bad property of the values and advance the watermarks in one transaction per chunk.
+#         The values are tagged with one joined UPDATE through the staging table, see tagging.py.
+########################################################################################################################
+
+# values lower than the base value for longer than the lookback are accepted as a new base value,
+# as the window mode starts one hour early
+CONCAVE_LOOKBACK = timedelta(hours=1)
+
+# values which stay at the new level after a spike for longer than the hold time are accepted
+SPIKE_HOLD = timedelta(hours=1)
+
+# the maximum number of chunks read ahead for every worker
+CHUNK_QUEUE_SIZE = 2
+
+# the minimum interval of logging the merged progress of the workers
+PROGRESS_LOG_INTERVAL_IN_SECONDS = 60
+
+
+def process(logger):
+    """
+    read the values in chunks, hand the values of every shard to its worker, restart the workers which exited,
+    and merge their progress
+    """
+    number_of_shards = max(config.cleaning_pool_size, 1)
+    progress_queue = Queue()
+    worker_dict = dict()
+    chunk_queue_dict = dict()
+    # the last progress reported by every shard, tuple of cursor id, max id, number of good values and bad values
+    progress_dict = dict()
+    # the last id of the chunks read, None until the watermarks are loaded
+    cursor_id = None
+    # the monotonic time of the last log of the merged progress
+    logged_time = None
+
+    while True:
+        # the outermost loop to reconnect server if there is a connection error
+        cnx_historical = None
+        cursor_historical = None
+        try:
+            cnx_historical = mysql.connector.connect(**config.myems_historical_db)
+            cursor_historical = cnx_historical.cursor()
+        except Exception as e:
+            logger.error("Error at the begin of clean_energy_value_incremental.process " + str(e))
+            if cursor_historical:
+                cursor_historical.close()
+            if cnx_historical:
+                cnx_historical.close()
+            time.sleep(60)
+            continue
+
+        ################################################################################################################
+        # Step 1: get the limits of points.
+        ################################################################################################################
+        point_dict = get_point_dict(logger)
+        if point_dict is None:
+            cursor_historical.close()
+            cnx_historical.close()
+            time.sleep(60)
+            continue
+        shard_point_dict_list = [dict() for _ in range(number_of_shards)]
+        for point_id, point in point_dict.items():
+            shard_point_dict_list[point_id % number_of_shards][point_id] = point
+
+        ################################################################################################################
+        # Step 2: get the id range to clean, and the cleaning watermarks of the workers.
+        ################################################################################################################
+        try:
+            for shard_index in range(number_of_shards):
+                worker = worker_dict.get(shard_index)
+                if worker is not None and worker.is_alive():
+                    continue
+                if worker is not None:
+                    logger.error("Shard " + str(shard_index) + " of clean_energy_value_incremental.process "
+                                 "exited with code " + str(worker.exitcode) + ", restart it")
+                # the restarted worker starts over from its watermarks, and the other workers skip the values
+                # they have cleaned when the chunks are read again
+                start_id = get_start_id(cursor_historical,
+                                        load_watermarks(cursor_historical, shard_index, number_of_shards))
+                cursor_id = start_id if cursor_id is None else min(cursor_id, start_id)
+                chunk_queue_dict[shard_index] = Queue(maxsize=CHUNK_QUEUE_SIZE)
+                worker_dict[shard_index] = Process(target=clean_shard,
+                                                   args=(logger, shard_index, number_of_shards,
+                                                         chunk_queue_dict[shard_index], progress_queue))
+                worker_dict[shard_index].start()
+
+            cursor_historical.execute(" SELECT MAX(id) FROM tbl_energy_value ")
+            row = cursor_historical.fetchone()
+            max_id = row[0] if row is not None and row[0] is not None else 0
+        except Exception as e:
+            logger.error("Error in step 2 of clean_energy_value_incremental.process " + str(e))
+            cursor_historical.close()
+            cnx_historical.close()
+            time.sleep(60)
+            continue
+
+        ################################################################################################################
+        # Step 3: read the values in each chunk, and check bad case class 1, class 3 and class 2 of them in the workers.
+        # Step 4: tag the is_bad property of the values and advance the watermarks in one transaction per chunk.
+        ################################################################################################################
+        is_worker_exited = False
+        try:
+            while cursor_id < max_id and not is_worker_exited:
+                end_id = min(cursor_id + config.cleaning_chunk_size, max_id)
+                cursor_historical.execute(" SELECT id, point_id, utc_date_time, actual_value "
+                                          " FROM tbl_energy_value "
+                                          " WHERE id > %s AND id <= %s AND is_bad IS NULL ",
+                                          (cursor_id, end_id))
+                shard_row_list = [list() for _ in range(number_of_shards)]
+                for row in cursor_historical.fetchall():
+                    shard_row_list[row[1] % number_of_shards].append(row)
+
+                for shard_index in range(number_of_shards):
+                    if not put_chunk(worker_dict[shard_index], chunk_queue_dict[shard_index],
+                                     (shard_point_dict_list[shard_index], cursor_id, end_id, max_id,
+                                      shard_row_list[shard_index]),
+                                     progress_queue, progress_dict, number_of_shards):
+                        # the worker is restarted and the chunks are read again from its watermarks
+                        is_worker_exited = True
+                        break
+                else:
+                    cursor_id = end_id
+                if logged_time is None or time.monotonic() - logged_time >= PROGRESS_LOG_INTERVAL_IN_SECONDS:
+                    if log_progress(logger, progress_dict, number_of_shards, cursor_id, max_id):
+                        logged_time = time.monotonic()
+        except Exception as e:
+            logger.error("Error in step 3 of clean_energy_value_incremental.process " + str(e))
+        finally:
+            cursor_historical.close()
+            cnx_historical.close()
+
+        if not is_worker_exited:
+            merge_progress(progress_queue, progress_dict, number_of_shards, 60)
+            if log_progress(logger, progress_dict, number_of_shards, cursor_id, max_id):
+                logged_time = time.monotonic()
+
+
+def put_chunk(worker, chunk_queue, chunk, progress_queue, progress_dict, number_of_shards):
+    """put a chunk to the queue of a worker, and merge the progress while waiting, return False if the worker exited"""
+    while worker.is_alive():
+        try:
+            chunk_queue.put(chunk, timeout=1)
+            merge_progress(progress_queue, progress_dict, number_of_shards, 0)
+            return True
+        except queue.Full:
+            merge_progress(progress_queue, progress_dict, number_of_shards, 0)
+    return False
+
+
+def merge_progress(progress_queue, progress_dict, number_of_shards, timeout_in_seconds):
+    """merge the progress reported by the workers in the timeout"""
+    deadline = time.monotonic() + timeout_in_seconds
+    while True:
+        try:
+            shard_index, cursor_id, max_id, number_of_good_values, number_of_bad_values = \
+                progress_queue.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            return
+
+        previous = progress_dict.get(shard_index, (cursor_id, max_id, 0, 0))
+        progress_dict[shard_index] = (cursor_id, max_id,
+                                      previous[2] + number_of_good_values, previous[3] + number_of_bad_values)
+
+
+def log_progress(logger, progress_dict, number_of_shards, cursor_id, max_id):
+    """
+    log the merged progress of the workers, all values before the lowest cursor id of the shards are cleaned,
+    return False if not all the workers have reported their progress yet
+    """
+    if len(progress_dict) < number_of_shards:
+        return False
+    cleaned_id = min(progress[0] for progress in progress_dict.values())
+    logger.info("clean_energy_value_incremental cursor_id: " + str(cursor_id) + " cleaned_id: " + str(cleaned_id) +
+                " backlog: " + str(max(max_id - cleaned_id, 0)) +
+                " good values: " + str(sum(progress[2] for progress in progress_dict.values())) +
+                " bad values: " + str(sum(progress[3] for progress in progress_dict.values())))
+    return True
+
+
+def clean_shard(logger, shard_index, number_of_shards, chunk_queue, progress_queue):
+    """
+    clean the chunks of values of the points with point_id % number_of_shards == shard_index from chunk_queue,
+    and report the progress of every chunk to progress_queue.
+    the worker exits after errors, and is restarted by the coordinator from its watermarks
+    """
+    cnx_historical = None
+    cursor_historical = None
+    try:
+        cnx_historical = mysql.connector.connect(**config.myems_historical_db)
+        cursor_historical = cnx_historical.cursor()
+
+        # cleaning state of points by point id, it is kept in memory between chunks
+        state_dict = load_watermarks(cursor_historical, shard_index, number_of_shards)
+        # the last id of the chunks cleaned
+        cursor_id = get_start_id(cursor_historical, state_dict)
+        progress_queue.put((shard_index, cursor_id, cursor_id, 0, 0))
+
+        while True:
+            point_dict, start_id, end_id, max_id, row_list = chunk_queue.get()
+            if end_id <= cursor_id:
+                # the chunk is read again for a restarted worker, and it has been cleaned by this worker
+                continue
+            number_of_good_values, number_of_bad_values = clean_chunk(cnx_historical, cursor_historical,
+                                                                      point_dict, state_dict,
+                                                                      max(start_id, cursor_id),
+                                                                      [row for row in row_list if row[0] > cursor_id])
+            cursor_id = end_id
+            progress_queue.put((shard_index, cursor_id, max_id, number_of_good_values, number_of_bad_values))
+    except Exception as e:
+        logger.error("Error in step 3 of clean_energy_value_incremental.clean_shard " + str(e))
+        if cnx_historical:
+            try:
+                cnx_historical.rollback()
+            except Exception:
+                pass
+        time.sleep(60)
+        sys.exit(1)
+    finally:
+        if cursor_historical:
+            cursor_historical.close()
+        if cnx_historical:
+            cnx_historical.close()
+
+
+def get_point_dict(logger):
+    """get the high limits and low limits of energy value points, return None if failed"""
+    cnx_system = None
+    cursor_system = None
+    point_dict = dict()
+    try:
+        cnx_system = mysql.connector.connect(**config.myems_system_db)
+        cursor_system = cnx_system.cursor()
+
+        query = (" SELECT id, high_limit, low_limit "
+                 " FROM tbl_points "
+                 " WHERE object_type='ENERGY_VALUE' ")
+        cursor_system.execute(query)
+        rows_points = cursor_system.fetchall()
+
+        if rows_points is not None and len(rows_points) > 0:
+            for row in rows_points:
+                point_dict[row[0]] = {"high_limit": row[1],
+                                      "low_limit": row[2]}
+    except Exception as e:
+        logger.error("Error in step 1 of clean_energy_value_incremental.process " + str(e))
+        return None
+    finally:
+        if cursor_system:
+            cursor_system.close()
+        if cnx_system:
+            cnx_system.close()
+    return point_dict
+
+
+def load_watermarks(cursor_historical, shard_index, number_of_shards):
+    """load the cleaning watermarks of the points in the shard into cleaning states"""
+    cursor_historical.execute(" SELECT point_id, last_id, last_utc_date_time, base_value "
+                              " FROM tbl_energy_value_cleaning_watermarks "
+                              " WHERE point_id %% %s = %s ", (number_of_shards, shard_index))
+    state_dict = dict()
+    for row in cursor_historical.fetchall():
+        state_dict[row[0]] = {'last_id': row[1],
+                              'last_utc_date_time': row[2],
+                              'base_value': row[3],
+                              # the pending values and the recent rates of the point are loaded
+                              # when the point is found in a chunk
+                              'pending': None,
+                              'rates': None}
+    return state_dict
+
+
+def get_start_id(cursor_historical, state_dict):
+    """get the id to start cleaning from, after the highest watermark or from START_DATETIME_UTC"""
+    if len(state_dict) > 0:
+        return max(state['last_id'] for state in state_dict.values())
+
+    start_datetime_utc = datetime.strptime(config.start_datetime_utc, '%Y-%m-%d %H:%M:%S')
+    cursor_historical.execute(" SELECT id "
+                              " FROM tbl_energy_value "
+                              " WHERE utc_date_time >= %s "
+                              " ORDER BY utc_date_time "
+                              " LIMIT 1 ", (start_datetime_utc,))
+    row = cursor_historical.fetchone()
+    if row is None:
+        cursor_historical.execute(" SELECT MAX(id) FROM tbl_energy_value ")
+        row = cursor_historical.fetchone()
+        return row[0] if row is not None and row[0] is not None else 0
+    return row[0] - 1
+
+
+def clean_chunk(cnx_historical, cursor_historical, point_dict, state_dict, start_id, rows_energy_values):
+    """
+    check and tag the unchecked values of the points in the shard of a chunk after start_id in one transaction
+    :param rows_energy_values: list of (id, point_id, utc_date_time, actual_value) of the shard in the chunk
+    :return: tuple of number of good values and number of bad values
+    """
+    point_value_dict = dict()
+    for row in rows_energy_values:
+        if row[1] not in point_value_dict:
+            point_value_dict[row[1]] = list()
+        point_value_dict[row[1]].append((row[0], row[2], row[3]))
+
+    good_list = list()
+    bad_list = list()
+    for point_id, point_value_list in point_value_dict.items():
+        state = state_dict.get(point_id)
+        if state is None:
+            state = {'last_id': start_id,
+                     'last_utc_date_time': None,
+                     'base_value': None,
+                     'pending': list(),
+                     'rates': deque(maxlen=config.spike_window_size)}
+            state_dict[point_id] = state
+        elif state['pending'] is None:
+            load_state(cursor_historical, point_id, state, start_id)
+
+        point_value_list.sort(key=lambda x: (x[1], x[0]))
+        # the rolling window of rates is advanced between slices of values, so that a long backlog of a point is
+        # checked with its recent rates instead of the rates before the backlog
+        start = 0
+        while start < len(point_value_list):
+            if config.spike_window_size <= 0:
+                end = len(point_value_list)
+            elif len(state['rates']) < config.spike_window_size:
+                end = start + cleaning_kernel.SPIKE_MIN_SAMPLES
+            else:
+                end = start + config.spike_window_size
+            point_good_list, point_bad_list = check_values(point_dict.get(point_id), state,
+                                                           point_value_list[start:end])
+            good_list.extend(point_good_list)
+            bad_list.extend(point_bad_list)
+            start = end
+
+    tagging.tag_values(cursor_historical, bad_list, good_list)
+
+    if len(point_value_dict) > 0:
+        upsert = (" INSERT INTO tbl_energy_value_cleaning_watermarks "
+                  "             (point_id, last_id, last_utc_date_time, base_value) "
+                  " VALUES (%s, %s, %s, %s) "
+                  " ON DUPLICATE KEY UPDATE last_id = VALUES(last_id), "
+                  "                         last_utc_date_time = VALUES(last_utc_date_time), "
+                  "                         base_value = VALUES(base_value) ")
+        cursor_historical.executemany(upsert, [(point_id,
+                                                state_dict[point_id]['last_id'],
+                                                state_dict[point_id]['last_utc_date_time'],
+                                                state_dict[point_id]['base_value'])
+                                               for point_id in point_value_dict.keys()])
+    cnx_historical.commit()
+    return len(good_list), len(bad_list)
+
+
+def load_state(cursor_historical, point_id, state, start_id):
+    """
+    load the values of a point which are still unchecked after the watermark,
+    and the rates of the recent good values of the point
+    """
+    state['pending'] = list()
+    state['rates'] = deque(maxlen=config.spike_window_size)
+    if state['last_utc_date_time'] is None:
+        return
+    cursor_historical.execute(" SELECT id, utc_date_time, actual_value "
+                              " FROM tbl_energy_value "
+                              " WHERE point_id = %s AND utc_date_time > %s AND id <= %s AND is_bad IS NULL "
+                              " ORDER BY utc_date_time, id ", (point_id, state['last_utc_date_time'], start_id))
+    state['pending'] = [(row[0], row[1], row[2]) for row in cursor_historical.fetchall()]
+
+    if config.spike_window_size > 0:
+        cursor_historical.execute(" SELECT id, utc_date_time, actual_value "
+                                  " FROM tbl_energy_value "
+                                  " WHERE point_id = %s AND utc_date_time <= %s AND is_bad = 0 "
+                                  " ORDER BY utc_date_time DESC "
+                                  " LIMIT %s ", (point_id, state['last_utc_date_time'], config.spike_window_size + 1))
+        rows = cursor_historical.fetchall()[::-1]
+        state['rates'].extend(cleaning_kernel.get_rates(cleaning_kernel.to_array(rows, 2, np.float64),
+                                                        cleaning_kernel.to_seconds(rows, 1),
+                                                        None, None).tolist())
+
+
+def check_values(point, state, point_value_list):
+    """
+    check the values of a point with the limits, the spike detection and the concave shape model,
+    and advance the state of the point. the values which cannot be decided yet are kept pending,
+    they are checked again before the next values of the point
+    :param point: dict of high_limit and low_limit, or None if the point is not found
+    :param state: cleaning state of the point
+    :param point_value_list: list of (id, utc_date_time, actual_value) sorted by utc_date_time
+    :return: tuple of good id list and bad id list
+    """
+    ids = cleaning_kernel.to_array(point_value_list, 0, np.int64)
+    values = cleaning_kernel.to_array(point_value_list, 2, np.float64)
+
+    # bad case class 1
+    if point is None:
+        is_bad = np.ones(len(values), dtype=bool)
+    else:
+        is_bad = (values > float(point['high_limit'])) | (values < float(point['low_limit']))
+
+    # values inserted late before the last good value are checked with the limits only,
+    # they are the head of the values sorted by date time
+    is_late = np.zeros(len(values), dtype=bool)
+    if state['last_utc_date_time'] is not None:
+        number_of_late_values = bisect.bisect_left(point_value_list, state['last_utc_date_time'],
+                                                   key=lambda x: x[1])
+        is_late[:number_of_late_values] = True
+        is_late &= ~is_bad
+
+    bad_list = ids[is_bad].tolist()
+    good_list = ids[is_late].tolist()
+    if len(bad_list) > 0 or len(good_list) > 0:
+        state['last_id'] = max(state['last_id'], int(ids[is_bad | is_late].max()))
+
+    # the pending values of the point are checked again before the new values
+    row_list = state['pending'] + [point_value_list[i] for i in np.flatnonzero(~(is_bad | is_late))]
+    ids = cleaning_kernel.to_array(row_list, 0, np.int64)
+    values = cleaning_kernel.to_array(row_list, 2, np.float64)
+    seconds = cleaning_kernel.to_seconds(row_list, 1)
+    base_value = state['base_value']
+    base_second = np.nan
+    if state['last_utc_date_time'] is not None:
+        base_second = cleaning_kernel.to_seconds([(state['last_utc_date_time'],)], 0)[0]
+
+    # bad case class 3, spikes are rare so they are found and resolved one by one
+    max_rate = cleaning_kernel.get_max_rate(state['rates'], config.spike_threshold)
+    is_spike = np.zeros(len(row_list), dtype=bool)
+    is_held = np.zeros(len(row_list), dtype=bool)
+    is_accepted = np.zeros(len(row_list), dtype=bool)
+    while True:
+        index = np.flatnonzero(~is_spike)
+        spike = cleaning_kernel.find_spike(values[index], seconds[index], base_value, base_second, max_rate,
+                                           is_accepted[index])
+        if spike is None:
+            break
+        end, is_spike_bad = cleaning_kernel.resolve_spike(values[index], seconds[index], spike,
+                                                          SPIKE_HOLD.total_seconds())
+        if end is None:
+            # the spike and the values after it are undecided
+            is_held[index[spike:]] = True
+            break
+        elif is_spike_bad:
+            is_spike[index[spike:end]] = True
+        else:
+            is_accepted[index[spike:end]] = True
+    bad_list.extend(ids[is_spike].tolist())
+    if np.any(is_spike):
+        state['last_id'] = max(state['last_id'], int(ids[is_spike].max()))
+
+    # bad case class 2 of the rest values
+    index = np.flatnonzero(~(is_spike | is_held))
+    ids = ids[index]
+    values = values[index]
+    seconds = seconds[index]
+    is_good = np.zeros(len(index), dtype=bool)
+    pending = list()
+    start = 0
+    while start < len(index):
+        is_candidate, first_pending = cleaning_kernel.check_concave(values[start:], state['base_value'])
+        # values lower than the base value for longer than the lookback are accepted as a new base value
+        run_starts = cleaning_kernel.get_run_starts(is_candidate)
+        is_expired = is_candidate & \
+            (seconds[start:] - seconds[start:][run_starts] > CONCAVE_LOOKBACK.total_seconds())
+        expired_index_list = np.flatnonzero(is_expired)
+        if len(expired_index_list) == 0:
+            end = first_pending
+            accepted_start = first_pending
+        else:
+            end = expired_index_list[0] + 1
+            accepted_start = run_starts[expired_index_list[0]]
+
+        # candidates before the accepted values are confirmed by normal values
+        bad_list.extend(ids[start:start + accepted_start][is_candidate[:accepted_start]].tolist())
+        is_good[start:start + accepted_start] = ~is_candidate[:accepted_start]
+        is_good[start + accepted_start:start + end] = True
+        if end > 0:
+            last_row = row_list[index[start + end - 1]]
+            state['last_id'] = max(state['last_id'], int(ids[start:start + end].max()))
+            state['base_value'] = last_row[2]
+            state['last_utc_date_time'] = last_row[1]
+        if len(expired_index_list) == 0:
+            pending = [row_list[i] for i in index[start + first_pending:]]
+            break
+        start += end
+    good_list.extend(ids[is_good].tolist())
+    state['pending'] = pending + [row_list[i] for i in np.flatnonzero(is_held)]
+
+    # the rates of the good values are the rolling window of spike detection
+    state['rates'].extend(cleaning_kernel.get_rates(values[is_good], seconds[is_good],
+                                                    base_value, base_second).tolist())
+    return good_list, bad_list
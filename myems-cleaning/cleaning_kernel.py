@@ -0,0 +1,176 @@
+import numpy as np
+
+
+########################################################################################################################
+# Vectorized kernel of bad energy value checks.
+# The values of a point are loaded as contiguous arrays in date time order, and bad case class 1 (high limits and low
+# limits) and bad case class 2 (concave shape model) are checked with array operations instead of per-row loops.
+#
+# In the concave shape model the base value is the running maximum of the values, a value lower than the base value
+# is a candidate concave value, and candidates followed by a normal value are bad. Candidates after the last normal
+# value are pending, they are confirmed or accepted by later values.
+#
+# NOTE: values are compared as float64, DECIMAL(21, 6) values beyond 15 significant digits may compare equal.
+########################################################################################################################
+
+
+def to_array(rows, index, dtype):
+    """return the column of rows at index as an array"""
+    return np.fromiter((row[index] for row in rows), dtype=dtype, count=len(rows))
+
+
+def to_seconds(rows, index):
+    """return the date times of rows at index as an array of timestamps in seconds"""
+    date_times = np.array([row[index] for row in rows], dtype='datetime64[us]')
+    return (date_times - np.datetime64(0, 'us')) / np.timedelta64(1, 's')
+
+
+def check_limits(point_ids, values, point_dict):
+    """
+    check bad case class 1 of values of all points at once
+    :param point_ids: array of point ids of values
+    :param values: array of values
+    :param point_dict: dict of high_limit and low_limit by point id
+    :return: mask of bad values, values of points not found are bad
+    """
+    if len(point_dict) == 0:
+        return np.ones(len(values), dtype=bool)
+    known_point_ids = np.sort(np.fromiter(point_dict.keys(), dtype=np.int64, count=len(point_dict)))
+    high_limits = np.array([point_dict[point_id]['high_limit'] for point_id in known_point_ids], dtype=np.float64)
+    low_limits = np.array([point_dict[point_id]['low_limit'] for point_id in known_point_ids], dtype=np.float64)
+
+    index = np.minimum(np.searchsorted(known_point_ids, point_ids), len(known_point_ids) - 1)
+    is_found = known_point_ids[index] == point_ids
+    return ~is_found | (values > high_limits[index]) | (values < low_limits[index])
+
+
+def check_concave(values, base_value=None):
+    """
+    check bad case class 2 of the values of a point in date time order
+    :param values: array of values
+    :param base_value: base value before the first value, or None to take the first value as the base value
+    :return: tuple of candidate mask, and index of the first pending candidate, the candidates before it are bad
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=bool), 0
+    initial_value = -np.inf if base_value is None else float(base_value)
+    previous_base_values = np.empty(len(values), dtype=np.float64)
+    previous_base_values[0] = initial_value
+    np.maximum.accumulate(values[:-1], out=previous_base_values[1:])
+    np.maximum(previous_base_values[1:], initial_value, out=previous_base_values[1:])
+
+    is_candidate = values < previous_base_values
+    normal_index_list = np.flatnonzero(~is_candidate)
+    first_pending = normal_index_list[-1] + 1 if len(normal_index_list) > 0 else 0
+    return is_candidate, first_pending
+
+
+def get_run_starts(is_candidate):
+    """return the index of the first candidate of the run of candidates which every value belongs to"""
+    index = np.arange(len(is_candidate))
+    last_normal = np.maximum.accumulate(np.where(is_candidate, -1, index))
+    return np.where(is_candidate, last_normal + 1, index)
+
+
+def find_bad_values(point_ids, ids, values):
+    """
+    check bad case class 2 of the values in a time window, the first value of each point is the base value
+    :param point_ids: array of point ids sorted by point id, then by date time
+    :param ids: array of ids of values
+    :param values: array of values
+    :return: array of bad ids
+    """
+    bad_id_list = list()
+    boundaries = np.flatnonzero(np.diff(point_ids)) + 1
+    for start, end in zip(np.concatenate(([0], boundaries)), np.concatenate((boundaries, [len(point_ids)]))):
+        if end - start <= 1:
+            continue
+        elif end - start == 2:
+            if values[start + 1] < values[start]:
+                bad_id_list.append(ids[start + 1:end])
+            continue
+        is_candidate, first_pending = check_concave(values[start:end])
+        bad_id_list.append(ids[start:start + first_pending][is_candidate[:first_pending]])
+    if len(bad_id_list) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(bad_id_list)
+
+
+########################################################################################################################
+# Spike detection of bad case class 3, bad case 2.8, 2.10, 2.11 and 2.12 in clean_energy_value.py.
+# The maximum plausible rate of a point is the rolling median of its recent rates plus SPIKE_THRESHOLD times the scale,
+# which is the larger of the scaled MAD and the median. A value which rises above the base value faster than that is a
+# spike, the spike is bad if the following values fall back below it, and it is accepted if the following values keep
+# rising, or if they stay at the new level for longer than the hold time.
+########################################################################################################################
+
+# the minimum number of recent rates of a point before spikes are checked
+SPIKE_MIN_SAMPLES = 10
+
+
+def get_max_rate(rate_window, threshold):
+    """return the maximum plausible rate by rolling median and MAD of recent rates, or inf if not enough rates"""
+    if len(rate_window) < SPIKE_MIN_SAMPLES:
+        return np.inf
+    rates = np.fromiter(rate_window, dtype=np.float64, count=len(rate_window))
+    median = np.median(rates)
+    mad = np.median(np.abs(rates - median))
+    return median + threshold * max(1.4826 * mad, median)
+
+
+def find_spike(values, seconds, base_value, base_second, max_rate, is_exempt):
+    """
+    find the first spike of the values of a point in date time order
+    :param values: array of values
+    :param seconds: array of timestamps in seconds
+    :param base_value: base value before the first value, or None
+    :param base_second: timestamp of the base value in seconds
+    :param max_rate: maximum plausible rate
+    :param is_exempt: mask of values which are accepted already
+    :return: index of the first spike, or None if not found
+    """
+    if len(values) == 0 or np.isinf(max_rate):
+        return None
+    is_candidate, _ = check_concave(values, base_value)
+    index = np.arange(len(values))
+    # the base value of every value is the last value which is not a candidate before it
+    last_normal = np.maximum.accumulate(np.where(is_candidate, -1, index))
+    reference = np.empty(len(values), dtype=np.int64)
+    reference[0] = -1
+    reference[1:] = last_normal[:-1]
+    reference_values = np.where(reference >= 0, values[reference], np.nan if base_value is None else float(base_value))
+    reference_seconds = np.where(reference >= 0, seconds[reference], base_second)
+    with np.errstate(invalid='ignore'):
+        is_spike = ~is_candidate & ~is_exempt & \
+            (values - reference_values > max_rate * (seconds - reference_seconds))
+    spike_index_list = np.flatnonzero(is_spike)
+    return spike_index_list[0] if len(spike_index_list) > 0 else None
+
+
+def resolve_spike(values, seconds, start, hold_in_seconds):
+    """
+    follow the values after the spike at start
+    :return: tuple of end and is_bad, the values in [start, end) are bad if is_bad is True, else they are accepted,
+             end is None if the values are still undecided
+    """
+    for i in range(start + 1, len(values)):
+        if seconds[i] - seconds[start] > hold_in_seconds:
+            return i, False
+        if values[i] < values[start]:
+            # the values fall back below the spike
+            return i, True
+        if values[i] > values[i - 1]:
+            # the values keep rising from the new level
+            return i, False
+    return None, None
+
+
+def get_rates(values, seconds, base_value, base_second):
+    """return the non-negative rates between consecutive good values of a point"""
+    if base_value is not None:
+        values = np.concatenate(([float(base_value)], values))
+        seconds = np.concatenate(([base_second], seconds))
+    elapsed = np.diff(seconds)
+    increments = np.diff(values)
+    is_valid = (elapsed > 0) & (increments >= 0)
+    return increments[is_valid] / elapsed[is_valid]
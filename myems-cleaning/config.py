@@ -26,5 +26,33 @@ live_in_days = config('LIVE_IN_DAYS', default=365, cast=int)
 # format string: "%Y-%m-%d %H:%M:%S"
 start_datetime_utc = config('START_DATETIME_UTC', default='2023-12-31 16:00:00')
 
+# indicates how expired analog values and digital values are deleted,
+# 'delete' deletes them in batches of primary key ranges,
+# 'partition' also drops expired monthly partitions of tables partitioned by utc_date_time, see database/partition
+retention_mode = config('RETENTION_MODE', default='delete')
+
+# the number of ids in one batch of deleting expired values, and the sleep between batches to throttle deleting
+retention_batch_size = config('RETENTION_BATCH_SIZE', default=10000, cast=int)
+retention_batch_interval_in_seconds = config('RETENTION_BATCH_INTERVAL_IN_SECONDS', default=0.5, cast=float)
+
+# indicates how to clean energy values,
+# 'window' checks all values in the time window since the last checked value,
+# 'incremental' checks only the values newer than the watermark of each point in bounded id-range chunks
+energy_value_cleaning_mode = config('ENERGY_VALUE_CLEANING_MODE', default='window')
+
+# the maximum number of ids in one chunk of incremental cleaning, values of a chunk are tagged in one transaction
+cleaning_chunk_size = config('CLEANING_CHUNK_SIZE', default=10000, cast=int)
+
+# the number of worker processes of incremental cleaning, points are split into shards by point id,
+# and every shard is cleaned by its own worker with its own connection and watermarks,
+# the values are read once by the coordinator and handed to the workers
+cleaning_pool_size = config('CLEANING_POOL_SIZE', default=1, cast=int)
+
+# the number of recent rates of each point in the rolling window of spike detection in incremental cleaning,
+# a value rising faster than the rolling median plus SPIKE_THRESHOLD times the scaled MAD (or the median) is a spike.
+# set SPIKE_WINDOW_SIZE to 0 to disable spike detection
+spike_window_size = config('SPIKE_WINDOW_SIZE', default=60, cast=int)
+spike_threshold = config('SPIKE_THRESHOLD', default=10.0, cast=float)
+
 # indicates if the program is in debug mode
 is_debug = config('IS_DEBUG', default=False, cast=bool)
@@ -5,6 +5,8 @@ from multiprocessing import Process
 import clean_analog_value
 import clean_digital_value
 import clean_energy_value
+import clean_energy_value_incremental
+import config
 
 
 def main():
@@ -31,7 +33,10 @@ def main():
     # clean digital values
     Process(target=clean_digital_value.process, args=(logger,)).start()
     # clean energy values
-    Process(target=clean_energy_value.process, args=(logger,)).start()
+    if config.energy_value_cleaning_mode == 'incremental':
+        Process(target=clean_energy_value_incremental.process, args=(logger,)).start()
+    else:
+        Process(target=clean_energy_value.process, args=(logger,)).start()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,181 @@
+import time
+from datetime import datetime
+
+import config
+
+
+########################################################################################################################
+# Retention of analog values and digital values.
+# Expired values are deleted in batches of primary key ranges, every batch is committed in its own small transaction
+# and followed by a short sleep, so that inserts of acquisition services are never blocked for long.
+# The first unexpired id is found by binary search over the primary key, and values inserted late are deleted point by
+# point, so that no statement scans the whole table, as there is no index starting with utc_date_time.
+# With RETENTION_MODE=partition, tables partitioned by range of utc_date_time (see database/partition) are kept with
+# monthly partitions ahead of time, and partitions which are expired entirely are dropped instantly before the rest
+# expired values are deleted in batches.
+########################################################################################################################
+
+# the number of monthly partitions created ahead of the current month
+PARTITIONS_AHEAD = 3
+
+
+def purge(logger, cnx_historical, cursor_historical, table_name, expired_utc):
+    """
+    delete values before expired_utc from the table
+    :param table_name: tbl_analog_value or tbl_digital_value
+    :return: tuple of number of rows and number of bytes reclaimed
+    """
+    rows_reclaimed = 0
+    bytes_reclaimed = 0
+    if config.retention_mode == 'partition':
+        partition_list = get_partitions(cursor_historical, table_name)
+        if len(partition_list) > 0:
+            add_partitions(cursor_historical, table_name, partition_list, datetime.utcnow())
+            rows_reclaimed, bytes_reclaimed = drop_partitions(cursor_historical, table_name, partition_list,
+                                                              expired_utc)
+        else:
+            logger.error(table_name + " is not partitioned by range of utc_date_time, "
+                                      "expired values are deleted in batches")
+
+    rows_deleted = delete_in_batches(cnx_historical, cursor_historical, table_name, expired_utc)
+    rows_reclaimed += rows_deleted
+    bytes_reclaimed += rows_deleted * get_average_row_length(cursor_historical, table_name)
+    return rows_reclaimed, bytes_reclaimed
+
+
+def delete_in_batches(cnx_historical, cursor_historical, table_name, expired_utc):
+    """
+    delete values before expired_utc in batches of primary key ranges, return number of rows deleted.
+    the tables have no index starting with utc_date_time, so every statement is bounded by the primary key,
+    or by the index of (point_id, utc_date_time), and never scans or locks the whole table
+    """
+    cursor_historical.execute(" SELECT MIN(id), MAX(id) FROM " + table_name)
+    row = cursor_historical.fetchone()
+    if row is None or row[0] is None:
+        return 0
+    min_id, max_id = row
+
+    end_id = get_first_unexpired_id(cursor_historical, table_name, min_id, max_id, expired_utc)
+
+    rows_deleted = 0
+    for start_id in range(min_id, end_id, config.retention_batch_size):
+        cursor_historical.execute(" DELETE FROM " + table_name +
+                                  " WHERE id >= %s AND id < %s AND utc_date_time < %s ",
+                                  (start_id, min(start_id + config.retention_batch_size, end_id), expired_utc))
+        rows_deleted += cursor_historical.rowcount
+        cnx_historical.commit()
+        time.sleep(config.retention_batch_interval_in_seconds)
+
+    # values inserted late with ids after the first unexpired value, they are deleted point by point
+    # through the index of (point_id, utc_date_time)
+    cursor_historical.execute(" SELECT DISTINCT point_id FROM " + table_name)
+    point_id_list = [row[0] for row in cursor_historical.fetchall()]
+    for point_id in point_id_list:
+        while True:
+            cursor_historical.execute(" DELETE FROM " + table_name +
+                                      " WHERE point_id = %s AND utc_date_time < %s "
+                                      " LIMIT %s ", (point_id, expired_utc, config.retention_batch_size))
+            rows_deleted += cursor_historical.rowcount
+            cnx_historical.commit()
+            if cursor_historical.rowcount < config.retention_batch_size:
+                break
+            time.sleep(config.retention_batch_interval_in_seconds)
+
+    return rows_deleted
+
+
+def get_first_unexpired_id(cursor_historical, table_name, min_id, max_id, expired_utc):
+    """
+    find the id of the first value at or after expired_utc by binary search over the primary key,
+    as ids increase with date times except values inserted late, every probe reads one row by the primary key
+    :return: the first unexpired id, or max_id + 1 if all values are expired
+    """
+    low_id = min_id
+    high_id = max_id + 1
+    while low_id < high_id:
+        cursor_historical.execute(" SELECT id, utc_date_time "
+                                  " FROM " + table_name +
+                                  " WHERE id >= %s "
+                                  " ORDER BY id "
+                                  " LIMIT 1 ", ((low_id + high_id) // 2,))
+        row = cursor_historical.fetchone()
+        if row is None or row[1] >= expired_utc:
+            high_id = (low_id + high_id) // 2
+        else:
+            low_id = row[0] + 1
+    return low_id
+
+
+def get_average_row_length(cursor_historical, table_name):
+    cursor_historical.execute(" SELECT AVG_ROW_LENGTH "
+                              " FROM information_schema.TABLES "
+                              " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s ", (table_name,))
+    row = cursor_historical.fetchone()
+    return row[0] if row is not None and row[0] is not None else 0
+
+
+########################################################################################################################
+# Partitions
+########################################################################################################################
+
+
+def get_partitions(cursor_historical, table_name):
+    """return the range partitions of the table in order, or an empty list if the table is not partitioned"""
+    cursor_historical.execute(" SELECT PARTITION_NAME, PARTITION_DESCRIPTION, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH "
+                              " FROM information_schema.PARTITIONS "
+                              " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+                              "       AND PARTITION_METHOD = 'RANGE COLUMNS' "
+                              " ORDER BY PARTITION_ORDINAL_POSITION ", (table_name,))
+    partition_list = list()
+    for row in cursor_historical.fetchall():
+        description = row[1].strip("'")
+        partition_list.append({'name': row[0],
+                               # values less than the upper bound, or None for MAXVALUE
+                               'upper_bound': None if description == 'MAXVALUE'
+                               else datetime.strptime(description, '%Y-%m-%d %H:%M:%S'),
+                               'rows': row[2] or 0,
+                               'bytes': (row[3] or 0) + (row[4] or 0)})
+    return partition_list
+
+
+def add_partitions(cursor_historical, table_name, partition_list, now):
+    """create monthly partitions up to PARTITIONS_AHEAD months after the current month"""
+    bounded_list = [partition for partition in partition_list if partition['upper_bound'] is not None]
+    if len(bounded_list) == 0:
+        return
+    upper_bound = bounded_list[-1]['upper_bound']
+    target = get_next_month(datetime(now.year, now.month, 1), PARTITIONS_AHEAD + 1)
+    while upper_bound < target:
+        lower_bound = upper_bound
+        upper_bound = get_next_month(datetime(upper_bound.year, upper_bound.month, 1), 1)
+        partition = (" PARTITION p" + lower_bound.strftime('%Y%m') +
+                     " VALUES LESS THAN ('" + upper_bound.strftime('%Y-%m-%d %H:%M:%S') + "') ")
+        if partition_list[-1]['upper_bound'] is None:
+            # the partition of MAXVALUE is usually empty as partitions are created ahead of time
+            cursor_historical.execute(" ALTER TABLE " + table_name +
+                                      " REORGANIZE PARTITION " + partition_list[-1]['name'] + " INTO "
+                                      " (" + partition + ", "
+                                      "  PARTITION " + partition_list[-1]['name'] + " VALUES LESS THAN (MAXVALUE)) ")
+        else:
+            cursor_historical.execute(" ALTER TABLE " + table_name + " ADD PARTITION (" + partition + ") ")
+
+
+def drop_partitions(cursor_historical, table_name, partition_list, expired_utc):
+    """
+    drop the partitions which are expired entirely,
+    return tuple of number of rows and number of bytes dropped, which are estimated by information_schema
+    """
+    expired_list = [partition for partition in partition_list
+                    if partition['upper_bound'] is not None and partition['upper_bound'] <= expired_utc]
+    # a table keeps at least one partition
+    if len(expired_list) == 0 or len(expired_list) == len(partition_list):
+        return 0, 0
+    cursor_historical.execute(" ALTER TABLE " + table_name +
+                              " DROP PARTITION " + ', '.join(partition['name'] for partition in expired_list))
+    return sum(partition['rows'] for partition in expired_list), sum(partition['bytes'] for partition in expired_list)
+
+
+def get_next_month(date_time, number_of_months):
+    """return the first day of the month number_of_months after the month of date_time"""
+    month = date_time.month - 1 + number_of_months
+    return datetime(date_time.year + month // 12, month % 12 + 1, 1)
@@ -0,0 +1,35 @@
+########################################################################################################################
+# Set-based tagging of the is_bad property of energy values.
+# The ids of checked values are bulk loaded into a staging table, and all of them are tagged with one joined UPDATE,
+# so that the number of statements does not grow with the number of bad values found in a cleaning cycle.
+# The staging table is a temporary table, it is private to the connection, so that parallel cleaning workers never
+# see the ids of each other, and it is dropped by the server when the connection is closed.
+########################################################################################################################
+
+# the maximum number of ids in one multi-row INSERT into the staging table
+STAGING_BATCH_SIZE = 10000
+
+
+def tag_values(cursor_historical, bad_id_list, good_id_list=()):
+    """
+    tag the values of bad_id_list as bad and the values of good_id_list as good,
+    the caller commits the transaction
+    """
+    if len(bad_id_list) == 0 and len(good_id_list) == 0:
+        return
+    cursor_historical.execute(" CREATE TEMPORARY TABLE IF NOT EXISTS tbl_energy_value_cleaning_staging ( "
+                              "   id BIGINT NOT NULL, "
+                              "   is_bad BOOL NOT NULL, "
+                              "   PRIMARY KEY (id)) ")
+    cursor_historical.execute(" DELETE FROM tbl_energy_value_cleaning_staging ")
+
+    row_list = [(id_, 1) for id_ in bad_id_list] + [(id_, 0) for id_ in good_id_list]
+    for i in range(0, len(row_list), STAGING_BATCH_SIZE):
+        # executemany of INSERT is sent as one multi-row INSERT statement
+        cursor_historical.executemany(" INSERT IGNORE INTO tbl_energy_value_cleaning_staging (id, is_bad) "
+                                      " VALUES (%s, %s) ", row_list[i:i + STAGING_BATCH_SIZE])
+
+    cursor_historical.execute(" UPDATE tbl_energy_value v "
+                              " INNER JOIN tbl_energy_value_cleaning_staging s ON v.id = s.id "
+                              " SET v.is_bad = s.is_bad ")
+    cursor_historical.execute(" DELETE FROM tbl_energy_value_cleaning_staging ")
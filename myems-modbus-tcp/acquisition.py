@@ -1,36 +1,27 @@
 import os
-import json
-import math
-import telnetlib3
 import asyncio
 import time
 from datetime import datetime
-from decimal import Decimal
 import mysql.connector
-from modbus_tk import modbus_tcp
 import config
-from byte_swap import byte_swap_32_bit, byte_swap_64_bit
+import metrics
+from historical_writer import write_point_values
+from modbus_client import ModbusTcpClient
+from read_plan import build_read_plan, get_due_scan_classes, get_next_due, reschedule, start_schedule, to_buffer
+from spool import Spool
 
 
-########################################################################################################################
-# Check connectivity to the host and port
-########################################################################################################################
-async def check_connectivity(host, port):
-    reader, writer = await telnetlib3.open_connection(host, port)
-    # Close the connection
-    writer.close()
-
 ########################################################################################################################
 # Acquisition Procedures
 # Step 1: Update process id in database
-# Step 2: Check connectivity to the host and port
-# Step 3: Get point list
-# Step 4: Read point values from Modbus slaves
-# Step 5: Bulk insert point values and update latest values in historical database
+# Step 2: Connect to the host and port over a persistent connection
+# Step 3: Get point list and build read plan
+# Step 4: Read point values of due scan classes from Modbus slaves in blocks
+# Step 5: Insert trend values and upsert latest values in historical database in one transaction
 ########################################################################################################################
 
 
-def process(logger, data_source_id, host, port, interval_in_seconds):
+def process(logger, data_source_id, host, port, interval_in_seconds, pipeline_window=1, reload_event=None):
     ####################################################################################################################
     # Step 1: Update process id in database
     ####################################################################################################################
@@ -62,13 +53,25 @@ def process(logger, data_source_id, host, port, interval_in_seconds):
         if cnx_system_db:
             cnx_system_db.close()
 
+    # spool of values which cannot be written to historical database
+    point_value_spool = Spool(logger, 'data_source_' + str(data_source_id))
+    point_value_spool.start_replayer()
+    # dump metrics of this data source to be served by the gateway process
+    metrics.start_exporter('data_source_' + str(data_source_id))
+
+    # event loop of this process to drive the Modbus TCP client, which pipelines block reads over one connection
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    client = ModbusTcpClient(host=host, port=port, timeout_in_sec=5.0, window=pipeline_window,
+                             data_source_id=data_source_id)
+
     while True:
         # begin of the outermost while loop
         ################################################################################################################
-        # Step 2: Check connectivity to the host and port
+        # Step 2: Connect to the host and port over a persistent connection
         ################################################################################################################
         try:
-            asyncio.run(check_connectivity(host, port))
+            loop.run_until_complete(client.connect())
             print("Succeeded to connect %s:%s in acquisition process ", host, port)
         except Exception as e:
             logger.error("Failed to connect %s:%s in acquisition process: %s  ", host, port, str(e))
@@ -77,7 +80,7 @@ def process(logger, data_source_id, host, port, interval_in_seconds):
             continue
 
         ################################################################################################################
-        # Step 3: Get point list
+        # Step 3: Get point list and build read plan
         ################################################################################################################
         cnx_system_db = None
         cursor_system_db = None
@@ -133,6 +136,19 @@ def process(logger, data_source_id, host, port, interval_in_seconds):
                                "offset_constant": row_point[5],
                                "address": row_point[6]})
 
+        # compile points and group them into scan classes of block reads
+        read_plan = build_read_plan(logger, data_source_id, point_list, interval_in_seconds, config.block_read_max_gap)
+        if len(read_plan) == 0:
+            # there is no valid points for this data source
+            logger.error("Valid Point Not Found in Data Source (ID = %s) ", data_source_id)
+            if cursor_system_db:
+                cursor_system_db.close()
+            if cnx_system_db:
+                cnx_system_db.close()
+            # go to begin of the outermost while loop
+            time.sleep(60)
+            continue
+
         ################################################################################################################
         # Step 4: Read point values from Modbus slaves
         ################################################################################################################
@@ -144,142 +160,168 @@ def process(logger, data_source_id, host, port, interval_in_seconds):
             cursor_historical_db = cnx_historical_db.cursor()
         except Exception as e:
             logger.error("Error in step 4.1 of acquisition process " + str(e))
-            if cursor_historical_db:
-                cursor_historical_db.close()
-            if cnx_historical_db:
-                cnx_historical_db.close()
+            # keep polling, values are spooled until the historical database is available
+            cnx_historical_db = None
+            cursor_historical_db = None
 
-            if cursor_system_db:
-                cursor_system_db.close()
-            if cnx_system_db:
-                cnx_system_db.close()
-            # go to begin of the outermost while loop
-            time.sleep(60)
-            continue
-
-        # connect to the Modbus data source
-        master = modbus_tcp.TcpMaster(host=host, port=port, timeout_in_sec=5.0)
-        master.set_timeout(5.0)
-        print("Ready to connect to %s:%s ", host, port)
+        # schedule the first reads of scan classes
+        start_schedule(read_plan, time.monotonic())
 
         # inner while loop to read all point values periodically
         while True:
             # begin of the inner while loop
-            is_modbus_tcp_timed_out = False
-            energy_value_list = list()
-            analog_value_list = list()
-            digital_value_list = list()
-
-            # TODO: update point list in another thread
-            # foreach point loop
-            for point in point_list:
-                # begin of foreach point loop
-                try:
-                    address = json.loads(point['address'])
-                except Exception as e:
-                    logger.error("Error in step 4.2 of acquisition process: Invalid point address in JSON " + str(e))
-                    continue
-
-                if 'slave_id' not in address.keys() \
-                        or 'function_code' not in address.keys() \
-                        or 'offset' not in address.keys() \
-                        or 'number_of_registers' not in address.keys() \
-                        or 'format' not in address.keys() \
-                        or 'byte_swap' not in address.keys() \
-                        or address['slave_id'] < 1 \
-                        or address['function_code'] not in (1, 2, 3, 4) \
-                        or address['offset'] < 0 \
-                        or address['number_of_registers'] < 0 \
-                        or len(address['format']) < 1 \
-                        or not isinstance(address['byte_swap'], bool):
-                    logger.error('Data Source(ID=%s), Point(ID=%s) Invalid address data.',
-                                 data_source_id, point['id'])
-                    # invalid point is found
-                    # go to begin of foreach point loop to process next point
-                    continue
+            if reload_event is not None and reload_event.is_set():
+                # points of this data source were changed,
+                # go to begin of the outermost while loop to reload point list and rebuild read plan
+                reload_event.clear()
+                loop.run_until_complete(client.close())
+                if cursor_historical_db:
+                    cursor_historical_db.close()
+                if cnx_historical_db:
+                    cnx_historical_db.close()
+                if cursor_system_db:
+                    cursor_system_db.close()
+                if cnx_system_db:
+                    cnx_system_db.close()
+                break
 
-                # read point value
-                try:
-                    result = master.execute(slave=address['slave_id'],
-                                            function_code=address['function_code'],
-                                            starting_address=address['offset'],
-                                            quantity_of_x=address['number_of_registers'],
-                                            data_format=address['format'])
-                except Exception as e:
-                    logger.error(str(e) +
-                                 " host:" + host + " port:" + str(port) +
-                                 " slave_id:" + str(address['slave_id']) +
-                                 " function_code:" + str(address['function_code']) +
-                                 " starting_address:" + str(address['offset']) +
-                                 " quantity_of_x:" + str(address['number_of_registers']) +
-                                 " data_format:" + str(address['format']) +
-                                 " byte_swap:" + str(address['byte_swap']))
-
-                    if 'timed out' in str(e):
+            is_modbus_tcp_timed_out = False
+            # value lists indexed by ANALOG_VALUE, ENERGY_VALUE and DIGITAL_VALUE
+            value_lists = (list(), list(), list())
+            # timestamp of this cycle for deadband heartbeat
+            timestamp = time.time()
+
+            now = time.monotonic()
+            due_scan_class_list = get_due_scan_classes(read_plan, now)
+            # the read budget of this tick is the shortest interval of due scan classes,
+            # scan classes not read within the budget stay due and are read first in the next tick
+            budget_in_seconds = min(scan_class.interval_in_seconds for scan_class in due_scan_class_list) \
+                if len(due_scan_class_list) > 0 else 0
+
+            # foreach scan class loop
+            for scan_class in due_scan_class_list:
+                # begin of foreach scan class loop
+                reschedule(scan_class, time.monotonic())
+
+                # pipeline block reads of the scan class, each block reads all registers in one request
+                data_list = loop.run_until_complete(client.read_many([(block.slave_id,
+                                                                       block.function_code,
+                                                                       block.starting_address,
+                                                                       block.quantity_of_x)
+                                                                      for block in scan_class.blocks]))
+                # a timeout fails the other outstanding requests, so check timeout before any fallback
+                for data in data_list:
+                    if isinstance(data, TimeoutError):
+                        logger.error(str(data) + " host:" + host + " port:" + str(port))
                         is_modbus_tcp_timed_out = True
-                        # timeout error
-                        # break the foreach point loop
                         break
-                    else:
-                        # exception occurred when read register value,
-                        # go to begin of foreach point loop to process next point
-                        continue
-
-                if result is None or not isinstance(result, tuple) or len(result) == 0:
-                    logger.error("Error in step 4.3 of acquisition process: \n"
-                                 " invalid result: None "
-                                 " for point_id: " + str(point['id']))
-                    # invalid result
-                    # go to begin of foreach point loop to process next point
-                    continue
+                if is_modbus_tcp_timed_out:
+                    # timeout error
+                    # break the foreach scan class loop
+                    break
+
+                # foreach block loop
+                for block, data in zip(scan_class.blocks, data_list):
+                    # begin of foreach block loop
+                    try:
+                        if isinstance(data, Exception):
+                            raise data
+                        # decode and convert values of all points in the block at once
+                        value_list = block.decode(to_buffer(block.function_code, data))
+                    except Exception as e:
+                        logger.error(str(e) +
+                                     " host:" + host + " port:" + str(port) +
+                                     " slave_id:" + str(block.slave_id) +
+                                     " function_code:" + str(block.function_code) +
+                                     " starting_address:" + str(block.starting_address) +
+                                     " quantity_of_x:" + str(block.quantity_of_x))
+
+                        if 'timed out' in str(e):
+                            is_modbus_tcp_timed_out = True
+                            # timeout error
+                            # break the foreach block loop
+                            break
+                        else:
+                            # exception occurred when read block, for example the block contains unmapped registers,
+                            # fall back to read points in this block one by one
+                            if not isinstance(data, Exception):
+                                metrics.inc('myems_modbus_tcp_decode_errors_total',
+                                            (('data_source_id', data_source_id),))
+                            value_list = None
+
+                    # foreach point loop
+                    for i, point in enumerate(block.points):
+                        # begin of foreach point loop
+                        if value_list is not None:
+                            value = value_list[i]
+                        else:
+                            # read point value
+                            try:
+                                data = loop.run_until_complete(client.read(point.slave_id,
+                                                                           point.function_code,
+                                                                           point.offset,
+                                                                           point.number_of_registers))
+                                value = point.convert(point.decode(to_buffer(point.function_code, data), point.offset))
+                            except Exception as e:
+                                logger.error(str(e) +
+                                             " host:" + host + " port:" + str(port) +
+                                             " slave_id:" + str(point.slave_id) +
+                                             " function_code:" + str(point.function_code) +
+                                             " starting_address:" + str(point.offset) +
+                                             " quantity_of_x:" + str(point.number_of_registers) +
+                                             " data_format:" + str(point.format) +
+                                             " byte_swap:" + str(point.byte_swap))
+
+                                if 'timed out' in str(e):
+                                    is_modbus_tcp_timed_out = True
+                                    # timeout error
+                                    # break the foreach point loop
+                                    break
+                                else:
+                                    # exception occurred when read register value,
+                                    # go to begin of foreach point loop to process next point
+                                    continue
+
+                        if value is None:
+                            logger.error(" Error in step 4.3 of acquisition process:\n"
+                                         " invalid result: not a number or out of range "
+                                         " for point_id: " + str(point.id))
+                            metrics.inc('myems_modbus_tcp_decode_errors_total', (('data_source_id', data_source_id),))
+                            # invalid result
+                            # go to begin of foreach point loop to process next point
+                            continue
+
+                        value_lists[point.value_list_index].append({'point_id': point.id,
+                                                                    'is_trend': point.is_trend_value(value, timestamp),
+                                                                    'value': value})
+
+                    # end of foreach point loop
+
+                    if is_modbus_tcp_timed_out:
+                        # break the foreach block loop
+                        break
 
-                if not isinstance(result[0], float) and not isinstance(result[0], int) or math.isnan(result[0]):
-                    logger.error(" Error in step 4.4 of acquisition process:\n"
-                                 " invalid result: not float and not int or not a number "
-                                 " for point_id: " + str(point['id']))
-                    # invalid result
-                    # go to begin of foreach point loop to process next point
-                    continue
+                # end of foreach block loop
+
+                if is_modbus_tcp_timed_out or time.monotonic() - now > budget_in_seconds:
+                    # break the foreach scan class loop
+                    break
+
+            # end of foreach scan class loop
 
-                if address['byte_swap']:
-                    if address['number_of_registers'] == 2:
-                        value = byte_swap_32_bit(result[0])
-                    elif address['number_of_registers'] == 4:
-                        value = byte_swap_64_bit(result[0])
-                    else:
-                        value = result[0]
-                else:
-                    value = result[0]
-
-                if point['object_type'] == 'ANALOG_VALUE':
-                    # Standard SQL requires that DECIMAL(18, 3) be able to store any value with 18 digits and
-                    # 3 decimals, so values that can be stored in the column range
-                    # from -999999999999999.999 to 999999999999999.999.
-                    if Decimal(-999999999999999.999) <= Decimal(value) <= Decimal(999999999999999.999):
-                        analog_value_list.append({'point_id': point['id'],
-                                                  'is_trend': point['is_trend'],
-                                                  'value': Decimal(value) * point['ratio'] + point['offset_constant']})
-                elif point['object_type'] == 'ENERGY_VALUE':
-                    # Standard SQL requires that DECIMAL(18, 3) be able to store any value with 18 digits and
-                    # 3 decimals, so values that can be stored in the column range
-                    # from -999999999999999.999 to 999999999999999.999.
-                    if Decimal(-999999999999999.999) <= Decimal(value) <= Decimal(999999999999999.999):
-                        energy_value_list.append({'point_id': point['id'],
-                                                  'is_trend': point['is_trend'],
-                                                  'value': Decimal(value) * point['ratio'] + point['offset_constant']})
-                elif point['object_type'] == 'DIGITAL_VALUE':
-                    digital_value_list.append({'point_id': point['id'],
-                                               'is_trend': point['is_trend'],
-                                               'value': int(value) * int(point['ratio']) + int(point['offset_constant'])
-                                               })
-
-            # end of foreach point loop
+            if not is_modbus_tcp_timed_out and len(due_scan_class_list) > 0:
+                metrics.observe('myems_modbus_tcp_cycle_duration_seconds',
+                                (('data_source_id', data_source_id),),
+                                time.monotonic() - now)
+                metrics.inc('myems_modbus_tcp_points_read_total',
+                            (('data_source_id', data_source_id),),
+                            sum(len(value_list) for value_list in value_lists))
 
             if is_modbus_tcp_timed_out:
                 # Modbus TCP connection timeout
 
-                # destroy the Modbus master
-                del master
+                # close the connection to the Modbus data source
+                loop.run_until_complete(client.close())
 
                 # close the connection to database
                 if cursor_historical_db:
@@ -296,23 +338,31 @@ def process(logger, data_source_id, host, port, interval_in_seconds):
                 time.sleep(60)
                 break
 
+            if len(due_scan_class_list) == 0:
+                # no scan class is due, sleep until the next due scan class
+                time.sleep(max(get_next_due(read_plan) - time.monotonic(), 0))
+                continue
+
             ############################################################################################################
-            # Step 5: Bulk insert point values and update latest values in historical database
+            # Step 5: Insert trend values and upsert latest values in historical database in one transaction
             ############################################################################################################
+            current_datetime_utc = datetime.utcnow()
             # check the connection to the Historical Database
-            if not cnx_historical_db.is_connected():
+            if cnx_historical_db is None or not cnx_historical_db.is_connected():
                 try:
                     cnx_historical_db = mysql.connector.connect(**config.myems_historical_db)
                     cursor_historical_db = cnx_historical_db.cursor()
                 except Exception as e:
                     logger.error("Error in step 5.1 of acquisition process: " + str(e))
-                    if cursor_historical_db:
-                        cursor_historical_db.close()
-                    if cnx_historical_db:
-                        cnx_historical_db.close()
-                    # go to begin of the inner while loop
-                    time.sleep(60)
-                    continue
+                    cnx_historical_db = None
+                    cursor_historical_db = None
+
+            # insert trend values and upsert latest values in one transaction,
+            # spool the values to replay later if the historical database is unavailable
+            if cnx_historical_db is None \
+                    or not write_point_values(logger, cnx_historical_db, cursor_historical_db,
+                                              [(current_datetime_utc, value_lists)]):
+                point_value_spool.append([(current_datetime_utc, value_lists)])
 
             # check the connection to the System Database
             if not cnx_system_db.is_connected():
@@ -329,171 +379,6 @@ def process(logger, data_source_id, host, port, interval_in_seconds):
                     time.sleep(60)
                     continue
 
-            current_datetime_utc = datetime.utcnow()
-            # bulk insert values into historical database within a period
-            # and then update latest values
-            while len(analog_value_list) > 0:
-                analog_value_list_100 = analog_value_list[:100]
-                analog_value_list = analog_value_list[100:]
-
-                add_values = (" INSERT INTO tbl_analog_value (point_id, utc_date_time, actual_value) "
-                              " VALUES  ")
-                trend_value_count = 0
-
-                for point_value in analog_value_list_100:
-                    if point_value['is_trend']:
-                        add_values += " (" + str(point_value['point_id']) + ","
-                        add_values += "'" + current_datetime_utc.isoformat() + "',"
-                        add_values += str(point_value['value']) + "), "
-                        trend_value_count += 1
-
-                if trend_value_count > 0:
-                    try:
-                        # trim ", " at the end of string and then execute
-                        cursor_historical_db.execute(add_values[:-2])
-                        cnx_historical_db.commit()
-                    except Exception as e:
-                        logger.error("Error in step 5.3.1 of acquisition process " + str(e))
-                        # ignore this exception
-
-                # update tbl_analog_value_latest
-                delete_values = " DELETE FROM tbl_analog_value_latest WHERE point_id IN ( "
-                latest_values = (" INSERT INTO tbl_analog_value_latest (point_id, utc_date_time, actual_value) "
-                                 " VALUES  ")
-                latest_value_count = 0
-
-                for point_value in analog_value_list_100:
-                    delete_values += str(point_value['point_id']) + ","
-                    latest_values += " (" + str(point_value['point_id']) + ","
-                    latest_values += "'" + current_datetime_utc.isoformat() + "',"
-                    latest_values += str(point_value['value']) + "), "
-                    latest_value_count += 1
-
-                if latest_value_count > 0:
-                    try:
-                        # replace "," at the end of string with ")"
-                        cursor_historical_db.execute(delete_values[:-1] + ")")
-                        cnx_historical_db.commit()
-                    except Exception as e:
-                        logger.error("Error in step 5.3.2 of acquisition process " + str(e))
-                        # ignore this exception
-
-                    try:
-                        # trim ", " at the end of string and then execute
-                        cursor_historical_db.execute(latest_values[:-2])
-                        cnx_historical_db.commit()
-                    except Exception as e:
-                        logger.error("Error in step 5.3.3 of acquisition process " + str(e))
-                        # ignore this exception
-
-            while len(energy_value_list) > 0:
-                energy_value_list_100 = energy_value_list[:100]
-                energy_value_list = energy_value_list[100:]
-
-                add_values = (" INSERT INTO tbl_energy_value (point_id, utc_date_time, actual_value) "
-                              " VALUES  ")
-                trend_value_count = 0
-
-                for point_value in energy_value_list_100:
-                    if point_value['is_trend']:
-                        add_values += " (" + str(point_value['point_id']) + ","
-                        add_values += "'" + current_datetime_utc.isoformat() + "',"
-                        add_values += str(point_value['value']) + "), "
-                        trend_value_count += 1
-
-                if trend_value_count > 0:
-                    try:
-                        # trim ", " at the end of string and then execute
-                        cursor_historical_db.execute(add_values[:-2])
-                        cnx_historical_db.commit()
-                    except Exception as e:
-                        logger.error("Error in step 5.4.1 of acquisition process: " + str(e))
-                        # ignore this exception
-
-                # update tbl_energy_value_latest
-                delete_values = " DELETE FROM tbl_energy_value_latest WHERE point_id IN ( "
-                latest_values = (" INSERT INTO tbl_energy_value_latest (point_id, utc_date_time, actual_value) "
-                                 " VALUES  ")
-                latest_value_count = 0
-                for point_value in energy_value_list_100:
-                    delete_values += str(point_value['point_id']) + ","
-                    latest_values += " (" + str(point_value['point_id']) + ","
-                    latest_values += "'" + current_datetime_utc.isoformat() + "',"
-                    latest_values += str(point_value['value']) + "), "
-                    latest_value_count += 1
-
-                if latest_value_count > 0:
-                    try:
-                        # replace "," at the end of string with ")"
-                        cursor_historical_db.execute(delete_values[:-1] + ")")
-                        cnx_historical_db.commit()
-
-                    except Exception as e:
-                        logger.error("Error in step 5.4.2 of acquisition process " + str(e))
-                        # ignore this exception
-
-                    try:
-                        # trim ", " at the end of string and then execute
-                        cursor_historical_db.execute(latest_values[:-2])
-                        cnx_historical_db.commit()
-
-                    except Exception as e:
-                        logger.error("Error in step 5.4.3 of acquisition process " + str(e))
-                        # ignore this exception
-
-            while len(digital_value_list) > 0:
-                digital_value_list_100 = digital_value_list[:100]
-                digital_value_list = digital_value_list[100:]
-
-                add_values = (" INSERT INTO tbl_digital_value (point_id, utc_date_time, actual_value) "
-                              " VALUES  ")
-                trend_value_count = 0
-
-                for point_value in digital_value_list_100:
-                    if point_value['is_trend']:
-                        add_values += " (" + str(point_value['point_id']) + ","
-                        add_values += "'" + current_datetime_utc.isoformat() + "',"
-                        add_values += str(point_value['value']) + "), "
-                        trend_value_count += 1
-
-                if trend_value_count > 0:
-                    try:
-                        # trim ", " at the end of string and then execute
-                        cursor_historical_db.execute(add_values[:-2])
-                        cnx_historical_db.commit()
-                    except Exception as e:
-                        logger.error("Error in step 5.5.1 of acquisition process: " + str(e))
-                        # ignore this exception
-
-                # update tbl_digital_value_latest
-                delete_values = " DELETE FROM tbl_digital_value_latest WHERE point_id IN ( "
-                latest_values = (" INSERT INTO tbl_digital_value_latest (point_id, utc_date_time, actual_value) "
-                                 " VALUES  ")
-                latest_value_count = 0
-                for point_value in digital_value_list_100:
-                    delete_values += str(point_value['point_id']) + ","
-                    latest_values += " (" + str(point_value['point_id']) + ","
-                    latest_values += "'" + current_datetime_utc.isoformat() + "',"
-                    latest_values += str(point_value['value']) + "), "
-                    latest_value_count += 1
-
-                if latest_value_count > 0:
-                    try:
-                        # replace "," at the end of string with ")"
-                        cursor_historical_db.execute(delete_values[:-1] + ")")
-                        cnx_historical_db.commit()
-                    except Exception as e:
-                        logger.error("Error in step 5.5.2 of acquisition process " + str(e))
-                        # ignore this exception
-
-                    try:
-                        # trim ", " at the end of string and then execute
-                        cursor_historical_db.execute(latest_values[:-2])
-                        cnx_historical_db.commit()
-                    except Exception as e:
-                        logger.error("Error in step 5.5.3 of acquisition process " + str(e))
-                        # ignore this exception
-
             # update data source last seen datetime
             update_row = (" UPDATE tbl_data_sources "
                           " SET last_seen_datetime_utc = '" + current_datetime_utc.isoformat() + "' "
@@ -511,9 +396,9 @@ def process(logger, data_source_id, host, port, interval_in_seconds):
                 time.sleep(60)
                 continue
 
-            # Sleep interval in seconds and continue the inner while loop
+            # Sleep until the next due scan class and continue the inner while loop
             # this argument may be a floating point number for subsecond precision
-            time.sleep(interval_in_seconds)
+            time.sleep(max(get_next_due(read_plan) - time.monotonic(), 0))
 
         # end of the inner while loop
 
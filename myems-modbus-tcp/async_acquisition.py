@@ -0,0 +1,433 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import mysql.connector
+import config
+import metrics
+import reloader
+import supervisor
+from historical_writer import write_point_values
+from modbus_client import ModbusTcpClient
+from read_plan import build_read_plan, get_due_scan_classes, get_next_due, reschedule, start_schedule, to_buffer
+from spool import Spool
+
+
+########################################################################################################################
+# Asyncio Acquisition Procedures
+# One event loop drives all data sources assigned to this process concurrently
+# Step 1: Start the historical database writer shared by all data sources
+# Step 2: Reload data sources of this process periodically
+# Step 3: Start, stop or re-plan acquisition tasks of the changed data sources,
+#         acquisition tasks terminated unexpectedly are restarted with exponential backoff
+# Step 4: Update process id of the started data sources in database
+########################################################################################################################
+
+
+def process(logger, index, number_of_processes):
+    """
+    :param logger: logger
+    :param index: index of this process, data sources with id % number_of_processes == index are acquired
+    :param number_of_processes: the number of event loop processes
+    """
+    asyncio.run(run(logger, index, number_of_processes))
+
+
+async def run(logger, index, number_of_processes):
+    loop = asyncio.get_running_loop()
+    ####################################################################################################################
+    # Step 1: Start the historical database writer shared by all data sources
+    ####################################################################################################################
+    # spool of values which cannot be written to historical database
+    point_value_spool = Spool(logger, 'asyncio_process_' + str(index))
+    point_value_spool.start_replayer()
+    # dump metrics of this process to be served by the gateway process
+    metrics.start_exporter('asyncio_process_' + str(index))
+    writer = HistoricalWriter(logger, point_value_spool)
+    writer_task = asyncio.create_task(writer.run())
+
+    # bound the number of data sources reading from the same host at the same time
+    host_semaphores = dict()
+    running_dict = dict()
+    while not writer_task.done():
+        ################################################################################################################
+        # Step 2: Reload data sources of this process periodically
+        ################################################################################################################
+        latest_dict = await loop.run_in_executor(None, reloader.load_data_sources, logger)
+        if latest_dict is None:
+            # wait for a while and retry
+            await asyncio.sleep(60)
+            continue
+        latest_dict = {data_source_id: data_source for data_source_id, data_source in latest_dict.items()
+                       if data_source_id % number_of_processes == index}
+
+        ################################################################################################################
+        # Step 3: Start, stop or re-plan acquisition tasks of the changed data sources
+        ################################################################################################################
+        to_stop, to_start, to_replan = reloader.diff(running_dict, latest_dict)
+
+        for data_source_id in to_stop:
+            running = running_dict.pop(data_source_id)
+            if running['task'] is not None:
+                running['task'].cancel()
+
+        started_list = list()
+        for data_source_id in to_start:
+            data_source = latest_dict[data_source_id]
+            print("Data Source: ID=%s, Name=%s, Connection=%s " %
+                  (data_source_id, data_source['name'], data_source['connection']))
+            running = {'connection': data_source['connection'],
+                       'points_signature': data_source['points_signature'],
+                       'task': None,
+                       'reload_event': None}
+            server = reloader.parse_connection(logger, data_source_id, data_source['connection'])
+            if server is not None:
+                host, port, interval_in_seconds, pipeline_window = server
+                if host not in host_semaphores:
+                    host_semaphores[host] = asyncio.Semaphore(config.max_concurrency_per_host)
+                running['reload_event'] = asyncio.Event()
+                running['task'] = asyncio.create_task(supervise(logger, data_source_id, functools.partial(
+                    acquire, logger, writer, host_semaphores[host], data_source_id, host, port, interval_in_seconds,
+                    pipeline_window, running['reload_event'])))
+                started_list.append(data_source_id)
+            running_dict[data_source_id] = running
+
+        for data_source_id in to_replan:
+            running = running_dict[data_source_id]
+            running['points_signature'] = latest_dict[data_source_id]['points_signature']
+            if running['reload_event'] is not None:
+                # the acquisition task reloads points and rebuilds its read plan
+                running['reload_event'].set()
+
+        ################################################################################################################
+        # Step 4: Update process id of the started data sources in database
+        ################################################################################################################
+        if len(started_list) > 0:
+            await loop.run_in_executor(None, update_process_id, logger, started_list)
+
+        await asyncio.sleep(config.reload_interval_in_seconds)
+
+    # the writer is stopped unexpectedly
+    writer_task.result()
+
+
+def update_process_id(logger, data_source_id_list):
+    cnx_system_db = None
+    cursor_system_db = None
+    try:
+        cnx_system_db = mysql.connector.connect(**config.myems_system_db)
+        cursor_system_db = cnx_system_db.cursor()
+    except Exception as e:
+        logger.error("Error in step 1.1 of asyncio acquisition process " + str(e))
+        if cursor_system_db:
+            cursor_system_db.close()
+        if cnx_system_db:
+            cnx_system_db.close()
+        return False
+
+    update_row = (" UPDATE tbl_data_sources "
+                  " SET process_id = %s "
+                  " WHERE id IN (" + ", ".join(["%s"] * len(data_source_id_list)) + ") ")
+    try:
+        cursor_system_db.execute(update_row, (os.getpid(), *data_source_id_list))
+        cnx_system_db.commit()
+    except Exception as e:
+        logger.error("Error in step 1.2 of asyncio acquisition process " + str(e))
+        return False
+    finally:
+        if cursor_system_db:
+            cursor_system_db.close()
+        if cnx_system_db:
+            cnx_system_db.close()
+
+    return True
+
+
+def get_point_list(logger, data_source_id):
+    """get point list of the data source, return None if failed"""
+    cnx_system_db = None
+    cursor_system_db = None
+    try:
+        cnx_system_db = mysql.connector.connect(**config.myems_system_db)
+        cursor_system_db = cnx_system_db.cursor()
+        query = (" SELECT id, name, object_type, is_trend, ratio, offset_constant, address "
+                 " FROM tbl_points "
+                 " WHERE data_source_id = %s AND is_virtual = 0 "
+                 " ORDER BY id ")
+        cursor_system_db.execute(query, (data_source_id,))
+        rows_point = cursor_system_db.fetchall()
+    except Exception as e:
+        logger.error("Error in step 3.1 of asyncio acquisition process " + str(e))
+        return None
+    finally:
+        if cursor_system_db:
+            cursor_system_db.close()
+        if cnx_system_db:
+            cnx_system_db.close()
+
+    point_list = list()
+    for row_point in rows_point:
+        point_list.append({"id": row_point[0],
+                           "name": row_point[1],
+                           "object_type": row_point[2],
+                           "is_trend": row_point[3],
+                           "ratio": row_point[4],
+                           "offset_constant": row_point[5],
+                           "address": row_point[6]})
+    return point_list
+
+
+async def supervise(logger, data_source_id, acquire_factory):
+    """
+    run the acquisition task of one data source until cancelled,
+    restart it with exponential backoff if it terminated unexpectedly
+    """
+    loop = asyncio.get_running_loop()
+    number_of_failures = 0
+    while True:
+        started_at = time.monotonic()
+        try:
+            await acquire_factory()
+            exit_reason = "returned"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            exit_reason = "raised " + type(e).__name__ + ": " + str(e)
+        # a task which ran stably for a while starts over from the shortest backoff
+        if time.monotonic() - started_at > config.restart_backoff_max_in_seconds:
+            number_of_failures = 0
+        number_of_failures += 1
+        backoff_in_seconds = supervisor.get_backoff_in_seconds(number_of_failures)
+        logger.error("Acquisition task of data source (ID = %s) %s, restart in %s seconds",
+                     data_source_id, exit_reason, backoff_in_seconds)
+        await loop.run_in_executor(None, supervisor.record_exit, logger, exit_reason, [data_source_id])
+        await asyncio.sleep(backoff_in_seconds)
+
+
+async def acquire(logger, writer, host_semaphore, data_source_id, host, port, interval_in_seconds, pipeline_window,
+                  reload_event):
+    """acquisition task of one data source, it runs until cancelled"""
+    loop = asyncio.get_running_loop()
+    client = ModbusTcpClient(host=host, port=port, timeout_in_sec=5.0, window=pipeline_window,
+                             data_source_id=data_source_id)
+    try:
+        while True:
+            # begin of the outermost while loop
+            reload_event.clear()
+            point_list = await loop.run_in_executor(None, get_point_list, logger, data_source_id)
+            if point_list is None or len(point_list) == 0:
+                logger.error("Point Not Found in Data Source (ID = %s) ", data_source_id)
+                # go to begin of the outermost while loop
+                await asyncio.sleep(60)
+                continue
+
+            # compile points and group them into scan classes of block reads
+            read_plan = build_read_plan(logger, data_source_id, point_list, interval_in_seconds,
+                                        config.block_read_max_gap)
+            if len(read_plan) == 0:
+                logger.error("Valid Point Not Found in Data Source (ID = %s) ", data_source_id)
+                # go to begin of the outermost while loop
+                await asyncio.sleep(60)
+                continue
+
+            try:
+                await client.connect()
+                print("Succeeded to connect %s:%s in asyncio acquisition process ", host, port)
+            except Exception as e:
+                logger.error("Failed to connect %s:%s in asyncio acquisition process: %s  ", host, port, str(e))
+                # go to begin of the outermost while loop
+                await asyncio.sleep(300)
+                continue
+
+            # schedule the first reads of scan classes
+            start_schedule(read_plan, time.monotonic())
+
+            # inner while loop to read point values of due scan classes
+            while not reload_event.is_set():
+                due_scan_class_list = get_due_scan_classes(read_plan, time.monotonic())
+                # value lists indexed by ANALOG_VALUE, ENERGY_VALUE and DIGITAL_VALUE
+                value_lists = (list(), list(), list())
+                try:
+                    if len(due_scan_class_list) > 0:
+                        async with host_semaphore:
+                            await asyncio.wait_for(read_point_values(logger, client, data_source_id, due_scan_class_list,
+                                                                     host, port, value_lists),
+                                                   timeout=config.cycle_timeout_in_seconds)
+                except Exception as e:
+                    logger.error("Error in step 3.2 of asyncio acquisition process: %s host: %s port: %s",
+                                 str(e) or "timed out", host, port)
+                    await client.close()
+                    # break the inner while loop
+                    # go to begin of the outermost while loop
+                    await asyncio.sleep(60)
+                    break
+
+                if len(due_scan_class_list) > 0:
+                    await writer.put((data_source_id, datetime.utcnow(), value_lists))
+
+                # Sleep until the next due scan class and continue the inner while loop,
+                # wake up early if points of this data source were changed
+                try:
+                    await asyncio.wait_for(reload_event.wait(),
+                                           timeout=max(get_next_due(read_plan) - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    pass
+            # end of the inner while loop
+
+        # end of the outermost while loop
+    finally:
+        await client.close()
+
+
+async def read_point_values(logger, client, data_source_id, due_scan_class_list, host, port, value_lists):
+    """
+    read all blocks of due scan classes, timeout errors are raised to the caller,
+    the read budget is the shortest interval of due scan classes and the rest scan classes stay due for the next tick
+    """
+    # timestamp of this cycle for deadband heartbeat
+    timestamp = time.time()
+    now = time.monotonic()
+    budget_in_seconds = min(scan_class.interval_in_seconds for scan_class in due_scan_class_list)
+    for scan_class in due_scan_class_list:
+        reschedule(scan_class, time.monotonic())
+        # pipeline block reads of the scan class
+        data_list = await client.read_many([(block.slave_id,
+                                             block.function_code,
+                                             block.starting_address,
+                                             block.quantity_of_x) for block in scan_class.blocks])
+        for data in data_list:
+            if isinstance(data, TimeoutError):
+                raise data
+
+        for block, data in zip(scan_class.blocks, data_list):
+            try:
+                if isinstance(data, Exception):
+                    raise data
+                # decode and convert values of all points in the block at once
+                value_list = block.decode(to_buffer(block.function_code, data))
+            except Exception as e:
+                logger.error(str(e) +
+                             " host:" + host + " port:" + str(port) +
+                             " slave_id:" + str(block.slave_id) +
+                             " function_code:" + str(block.function_code) +
+                             " starting_address:" + str(block.starting_address) +
+                             " quantity_of_x:" + str(block.quantity_of_x))
+                if not isinstance(data, Exception):
+                    metrics.inc('myems_modbus_tcp_decode_errors_total', (('data_source_id', data_source_id),))
+                # fall back to read points in this block one by one
+                value_list = None
+
+            for i, point in enumerate(block.points):
+                if value_list is not None:
+                    value = value_list[i]
+                else:
+                    try:
+                        data = await client.read(point.slave_id,
+                                                 point.function_code,
+                                                 point.offset,
+                                                 point.number_of_registers)
+                        value = point.convert(point.decode(to_buffer(point.function_code, data), point.offset))
+                    except TimeoutError:
+                        raise
+                    except Exception as e:
+                        logger.error(str(e) +
+                                     " host:" + host + " port:" + str(port) +
+                                     " slave_id:" + str(point.slave_id) +
+                                     " function_code:" + str(point.function_code) +
+                                     " starting_address:" + str(point.offset) +
+                                     " quantity_of_x:" + str(point.number_of_registers) +
+                                     " data_format:" + str(point.format) +
+                                     " byte_swap:" + str(point.byte_swap))
+                        continue
+
+                if value is None:
+                    logger.error(" Error in step 3.3 of asyncio acquisition process:\n"
+                                 " invalid result: not a number or out of range "
+                                 " for point_id: " + str(point.id))
+                    metrics.inc('myems_modbus_tcp_decode_errors_total', (('data_source_id', data_source_id),))
+                    continue
+
+                value_lists[point.value_list_index].append({'point_id': point.id,
+                                                            'is_trend': point.is_trend_value(value, timestamp),
+                                                            'value': value})
+
+        if time.monotonic() - now > budget_in_seconds:
+            break
+
+    metrics.observe('myems_modbus_tcp_cycle_duration_seconds',
+                    (('data_source_id', data_source_id),),
+                    time.monotonic() - now)
+    metrics.inc('myems_modbus_tcp_points_read_total',
+                (('data_source_id', data_source_id),),
+                sum(len(value_list) for value_list in value_lists))
+
+
+class HistoricalWriter:
+    """write point values of all data sources in this process through one connection to each database"""
+
+    def __init__(self, logger, point_value_spool):
+        self.logger = logger
+        self.point_value_spool = point_value_spool
+        self.queue = asyncio.Queue(maxsize=config.writer_queue_size)
+        # mysql connector is blocking, so all writes run in one thread which owns the connections
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.cnx_historical_db = None
+        self.cursor_historical_db = None
+        self.cnx_system_db = None
+        self.cursor_system_db = None
+
+    async def put(self, item):
+        """
+        :param item: tuple of (data_source_id, current_datetime_utc, value_lists)
+        """
+        await self.queue.put(item)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # write all values queued while the previous batch was being written
+            batch = [await self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await loop.run_in_executor(self.executor, self.write, batch)
+
+    def write(self, batch):
+        cycle_list = [(item[1], item[2]) for item in batch]
+        # check the connection to the Historical Database
+        if self.cnx_historical_db is None or not self.cnx_historical_db.is_connected():
+            try:
+                self.cnx_historical_db = mysql.connector.connect(**config.myems_historical_db)
+                self.cursor_historical_db = self.cnx_historical_db.cursor()
+            except Exception as e:
+                self.logger.error("Error in step 2.1 of asyncio acquisition process: " + str(e))
+                self.cnx_historical_db = None
+                self.cursor_historical_db = None
+
+        # values of all data sources in the batch are written in one transaction,
+        # spool the values to replay later if the historical database is unavailable
+        if self.cnx_historical_db is None \
+                or not write_point_values(self.logger, self.cnx_historical_db, self.cursor_historical_db, cycle_list):
+            self.point_value_spool.append(cycle_list)
+
+        # check the connection to the System Database
+        if self.cnx_system_db is None or not self.cnx_system_db.is_connected():
+            try:
+                self.cnx_system_db = mysql.connector.connect(**config.myems_system_db)
+                self.cursor_system_db = self.cnx_system_db.cursor()
+            except Exception as e:
+                self.logger.error("Error in step 2.2 of asyncio acquisition process: " + str(e))
+                self.cnx_system_db = None
+                self.cursor_system_db = None
+                return
+
+        # update data sources last seen datetime
+        update_row = (" UPDATE tbl_data_sources "
+                      " SET last_seen_datetime_utc = %s "
+                      " WHERE id = %s ")
+        try:
+            self.cursor_system_db.executemany(update_row, [(item[1].isoformat(), item[0]) for item in batch])
+            self.cnx_system_db.commit()
+        except Exception as e:
+            self.logger.error("Error in step 2.3 of asyncio acquisition process " + str(e))
@@ -0,0 +1,307 @@
+import argparse
+import json
+import logging
+import random
+import struct
+import time
+import timeit
+import urllib.request
+import uuid
+from decimal import Decimal
+import mysql.connector
+import config
+from byte_swap import byte_swap_32_bit, byte_swap_64_bit
+from read_plan import build_read_plan, to_buffer
+
+
+########################################################################################################################
+# Acquisition Load Benchmark
+# Step 1: Populate data sources and points of simulated devices for the gateway in config
+#         python3 benchmark.py populate --port 5020 --devices 10 --points 1000 --interval 1
+# Step 2: Start simulator.py with the same devices, and start this service with the same config
+# Step 3: Report points per second, cycle time percentiles and database write rates from the metrics endpoint
+#         python3 benchmark.py run --duration 60
+# Step 4: Delete the data sources, points and values of the benchmark
+#         python3 benchmark.py cleanup
+# Micro-benchmark of decoding a block read, the per-value path against the batched path
+#         python3 benchmark.py decode --points 60
+########################################################################################################################
+
+# Name prefix of data sources and points created by the benchmark
+NAME_PREFIX = 'benchmark-'
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def populate(args):
+    """insert one data source for each simulated device and points of consecutive holding registers"""
+    cnx_system_db = mysql.connector.connect(**config.myems_system_db)
+    cursor_system_db = cnx_system_db.cursor()
+    try:
+        for i in range(args.devices):
+            port = args.port + i
+            cursor_system_db.execute(" INSERT INTO tbl_data_sources "
+                                     "    (name, uuid, gateway_id, protocol, connection, description) "
+                                     " VALUES (%s, %s, %s, 'modbus-tcp', %s, %s) ",
+                                     (NAME_PREFIX + str(port),
+                                      str(uuid.uuid4()),
+                                      config.gateway['id'],
+                                      json.dumps({'host': args.host, 'port': port,
+                                                  'interval_in_seconds': args.interval}),
+                                      'created by benchmark.py'))
+            data_source_id = cursor_system_db.lastrowid
+            rows = list()
+            for j in range(args.points):
+                # leave a gap after every 8 registers so that block reads are exercised
+                address = {'slave_id': 1 + j % args.slaves,
+                           'function_code': 3,
+                           'offset': (j // args.slaves) + (j // args.slaves) // 8 * args.gap,
+                           'number_of_registers': 1,
+                           'format': '>H',
+                           'byte_swap': False}
+                rows.append((NAME_PREFIX + str(port) + '-' + str(j), data_source_id, json.dumps(address)))
+            cursor_system_db.executemany(" INSERT INTO tbl_points "
+                                         "    (name, data_source_id, object_type, units, high_limit, low_limit, "
+                                         "     ratio, offset_constant, is_trend, is_virtual, address) "
+                                         " VALUES (%s, %s, 'ANALOG_VALUE', 'NONE', 65535, 0, 1, 0, 1, 0, %s) ",
+                                         rows)
+        cnx_system_db.commit()
+    finally:
+        cursor_system_db.close()
+        cnx_system_db.close()
+    print("Populated %d data sources with %d points each for gateway %d" %
+          (args.devices, args.points, config.gateway['id']))
+
+
+def cleanup(args):
+    """delete data sources, points and values created by the benchmark"""
+    cnx_system_db = mysql.connector.connect(**config.myems_system_db)
+    cursor_system_db = cnx_system_db.cursor()
+    try:
+        cursor_system_db.execute(" SELECT p.id "
+                                 " FROM tbl_points p, tbl_data_sources ds "
+                                 " WHERE p.data_source_id = ds.id AND ds.name LIKE %s AND ds.gateway_id = %s ",
+                                 (NAME_PREFIX + '%', config.gateway['id']))
+        point_id_list = [row[0] for row in cursor_system_db.fetchall()]
+        cursor_system_db.execute(" DELETE p FROM tbl_points p, tbl_data_sources ds "
+                                 " WHERE p.data_source_id = ds.id AND ds.name LIKE %s AND ds.gateway_id = %s ",
+                                 (NAME_PREFIX + '%', config.gateway['id']))
+        cursor_system_db.execute(" DELETE FROM tbl_data_sources WHERE name LIKE %s AND gateway_id = %s ",
+                                 (NAME_PREFIX + '%', config.gateway['id']))
+        cnx_system_db.commit()
+    finally:
+        cursor_system_db.close()
+        cnx_system_db.close()
+
+    cnx_historical_db = mysql.connector.connect(**config.myems_historical_db)
+    cursor_historical_db = cnx_historical_db.cursor()
+    try:
+        for i in range(0, len(point_id_list), 1000):
+            in_clause = ', '.join(str(point_id) for point_id in point_id_list[i:i + 1000])
+            for table_name in ('tbl_analog_value', 'tbl_analog_value_latest'):
+                cursor_historical_db.execute(" DELETE FROM " + table_name + " WHERE point_id IN (" + in_clause + ") ")
+        cnx_historical_db.commit()
+    finally:
+        cursor_historical_db.close()
+        cnx_historical_db.close()
+    print("Deleted %d points of benchmark" % len(point_id_list))
+
+
+########################################################################################################################
+# Report from metrics endpoint
+########################################################################################################################
+
+
+def scrape(url):
+    """
+    scrape the metrics endpoint
+    :return: dict of (name, labels) to value, where labels is a frozenset of (label_name, label_value) pairs
+    """
+    sample_dict = dict()
+    with urllib.request.urlopen(url, timeout=10) as response:
+        for line in response.read().decode('utf-8').splitlines():
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            series, value = line.rsplit(' ', 1)
+            if '{' in series:
+                name, labels = series[:-1].split('{', 1)
+                labels = frozenset(tuple(label.split('=', 1)) for label in labels.replace('"', '').split(','))
+            else:
+                name, labels = series, frozenset()
+            sample_dict[(name, labels)] = float(value)
+    return sample_dict
+
+
+def delta(before, after, name, label_filter=None):
+    """return the sum of increases of all series of a metric"""
+    total = 0.0
+    for (sample_name, labels), value in after.items():
+        if sample_name == name and (label_filter is None or label_filter(dict(labels))):
+            total += value - before.get((sample_name, labels), 0.0)
+    return total
+
+
+def histogram_quantiles(before, after, name):
+    """estimate quantiles of the increases of all series of a histogram by linear interpolation in buckets"""
+    bucket_dict = dict()
+    for (sample_name, labels), value in after.items():
+        if sample_name == name + '_bucket':
+            upper_bound = float(dict(labels)['le'])
+            bucket_dict[upper_bound] = bucket_dict.get(upper_bound, 0.0) + value - before.get((sample_name, labels), 0.0)
+    bucket_list = sorted(bucket_dict.items())
+    if len(bucket_list) == 0 or bucket_list[-1][1] == 0:
+        return [None] * len(QUANTILES)
+
+    quantile_list = list()
+    for quantile in QUANTILES:
+        rank = quantile * bucket_list[-1][1]
+        lower_bound, lower_count = 0.0, 0.0
+        for upper_bound, count in bucket_list:
+            if count >= rank:
+                if upper_bound == float('inf'):
+                    # the quantile is beyond the largest finite bucket
+                    quantile_list.append(lower_bound)
+                else:
+                    quantile_list.append(lower_bound + (upper_bound - lower_bound) *
+                                         (rank - lower_count) / max(count - lower_count, 1e-9))
+                break
+            lower_bound, lower_count = upper_bound, count
+    return quantile_list
+
+
+def format_quantiles(quantile_list):
+    return ', '.join('p%d %s' % (quantile * 100, 'n/a' if value is None else '%.3fs' % value)
+                     for quantile, value in zip(QUANTILES, quantile_list))
+
+
+def run(args):
+    url = 'http://%s:%d/metrics' % (config.metrics_host, config.metrics_port)
+    before = scrape(url)
+    start_time = time.monotonic()
+    time.sleep(args.duration)
+    after = scrape(url)
+    duration = time.monotonic() - start_time
+
+    points_read = delta(before, after, 'myems_modbus_tcp_points_read_total')
+    cycles = delta(before, after, 'myems_modbus_tcp_cycle_duration_seconds_count')
+    requests = delta(before, after, 'myems_modbus_tcp_request_duration_seconds_count')
+    trend_rows = delta(before, after, 'myems_modbus_tcp_rows_written_total',
+                       lambda labels: not labels['table'].endswith('_latest'))
+    latest_rows = delta(before, after, 'myems_modbus_tcp_rows_written_total',
+                        lambda labels: labels['table'].endswith('_latest'))
+    transactions = delta(before, after, 'myems_modbus_tcp_write_duration_seconds_count')
+
+    print("Duration:           %.1fs" % duration)
+    print("Points read:        %.1f points/s" % (points_read / duration))
+    print("Cycles:             %.1f cycles/s" % (cycles / duration))
+    print("Cycle time:         " +
+          format_quantiles(histogram_quantiles(before, after, 'myems_modbus_tcp_cycle_duration_seconds')))
+    print("Requests:           %.1f requests/s" % (requests / duration))
+    print("Round trip time:    " +
+          format_quantiles(histogram_quantiles(before, after, 'myems_modbus_tcp_request_duration_seconds')))
+    print("Timeouts:           %d" % delta(before, after, 'myems_modbus_tcp_timeouts_total'))
+    print("Request errors:     %d" % delta(before, after, 'myems_modbus_tcp_request_errors_total'))
+    print("Decode errors:      %d" % delta(before, after, 'myems_modbus_tcp_decode_errors_total'))
+    print("Trend rows written: %.1f rows/s" % (trend_rows / duration))
+    print("Latest rows upsert: %.1f rows/s" % (latest_rows / duration))
+    print("Transactions:       %.1f transactions/s" % (transactions / duration))
+    print("Write time:         " +
+          format_quantiles(histogram_quantiles(before, after, 'myems_modbus_tcp_write_duration_seconds')))
+    print("Spooled cycles:     %d" % delta(before, after, 'myems_modbus_tcp_spooled_cycles_total'))
+
+
+########################################################################################################################
+# Micro-benchmark of decoding
+########################################################################################################################
+
+
+def decode(args):
+    """compare the per-value path with struct, byte swap functions and Decimal against the batched block decoder"""
+    formats = (('>H', 1, False), ('>h', 1, False), ('>f', 2, False), ('>f', 2, True),
+               ('<I', 2, False), ('>I', 2, True), ('>d', 4, False), ('>q', 4, True))
+    point_list = list()
+    offset = 0
+    for i in range(args.points):
+        data_format, number_of_registers, byte_swap = formats[i % len(formats)]
+        if offset + number_of_registers > 125:
+            break
+        point_list.append({'id': i,
+                           'object_type': 'DIGITAL_VALUE' if i % 10 == 9 else 'ANALOG_VALUE',
+                           'is_trend': 1,
+                           'ratio': Decimal('0.1'),
+                           'offset_constant': Decimal('0'),
+                           'address': json.dumps({'slave_id': 1, 'function_code': 3, 'offset': offset,
+                                                  'number_of_registers': number_of_registers,
+                                                  'format': data_format, 'byte_swap': byte_swap})})
+        offset += number_of_registers
+    read_plan = build_read_plan(logging.getLogger(), 0, point_list, 1, 0)
+    block = read_plan[0].blocks[0]
+    registers = tuple(random.getrandbits(8) for _ in range(block.quantity_of_x))
+    address_list = [json.loads(point['address']) for point in point_list]
+
+    def per_value():
+        # decode every point from registers as the acquisition did before block reads and read plan
+        value_list = list()
+        for point, address in zip(point_list, address_list):
+            index = address['offset'] - block.starting_address
+            result = struct.unpack(address['format'],
+                                   struct.pack('>%dH' % address['number_of_registers'],
+                                               *registers[index:index + address['number_of_registers']]))
+            value = result[0]
+            if address['byte_swap']:
+                if address['number_of_registers'] == 2:
+                    value = byte_swap_32_bit(value)
+                elif address['number_of_registers'] == 4:
+                    value = byte_swap_64_bit(value)
+            if point['object_type'] == 'DIGITAL_VALUE':
+                value_list.append(int(value) * int(point['ratio']) + int(point['offset_constant']))
+            elif Decimal(-999999999999999.999) <= Decimal(value) <= Decimal(999999999999999.999):
+                value_list.append(Decimal(value) * point['ratio'] + point['offset_constant'])
+        return value_list
+
+    def per_point():
+        # decode every point alone from the buffer of the block
+        buffer = to_buffer(block.function_code, registers)
+        return [point.convert(point.decode(buffer, block.starting_address)) for point in block.points]
+
+    def batched():
+        return block.decode(to_buffer(block.function_code, registers))
+
+    print("Points in block:    %d, registers: %d, structs: %d" %
+          (len(block.points), block.quantity_of_x, len(block.decoders)))
+    for name, function in (('per value', per_value), ('per point', per_point), ('batched', batched)):
+        seconds = min(timeit.repeat(function, number=args.repeat, repeat=5)) / args.repeat
+        print("%-19s %.2f us/block, %.3f us/point" % (name + ':', seconds * 1e6, seconds * 1e6 / len(block.points)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Acquisition load benchmark with simulator.py')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_populate = subparsers.add_parser('populate', help='populate data sources and points of simulated devices')
+    parser_populate.add_argument('--host', default='127.0.0.1')
+    parser_populate.add_argument('--port', type=int, default=5020, help='port of the first simulated device')
+    parser_populate.add_argument('--devices', type=int, default=1)
+    parser_populate.add_argument('--slaves', type=int, default=1)
+    parser_populate.add_argument('--points', type=int, default=1000, help='number of points of each device')
+    parser_populate.add_argument('--gap', type=int, default=2, help='unused registers after every 8 points')
+    parser_populate.add_argument('--interval', type=float, default=1, help='interval in seconds of data sources')
+    parser_run = subparsers.add_parser('run', help='report acquisition performance from the metrics endpoint')
+    parser_run.add_argument('--duration', type=float, default=60, help='duration of measurement in seconds')
+    subparsers.add_parser('cleanup', help='delete data sources, points and values of the benchmark')
+    parser_decode = subparsers.add_parser('decode', help='micro-benchmark of decoding a block read')
+    parser_decode.add_argument('--points', type=int, default=60, help='number of points in the block')
+    parser_decode.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.command == 'populate':
+        populate(args)
+    elif args.command == 'run':
+        run(args)
+    elif args.command == 'cleanup':
+        cleanup(args)
+    elif args.command == 'decode':
+        decode(args)
+
+
+if __name__ == "__main__":
+    main()
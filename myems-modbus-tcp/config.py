@@ -27,3 +27,60 @@ gateway = {
     'id': config('GATEWAY_ID', default=1, cast=int),
     'token': config('GATEWAY_TOKEN', default='983427af-1c35-42ba-8b4d-288675550225')
 }
+
+# The maximum number of unused registers between two points that are merged into one block read.
+# Set to -1 to read every point individually for devices that reject reading unmapped registers.
+block_read_max_gap = config('BLOCK_READ_MAX_GAP', default=10, cast=int)
+
+# Acquisition mode
+# 'process': fork one process for each data source
+# 'asyncio': drive all data sources concurrently by event loops in a few processes
+acquisition_mode = config('ACQUISITION_MODE', default='process')
+
+# The number of event loop processes in asyncio acquisition mode
+asyncio_processes = config('ASYNCIO_PROCESSES', default=1, cast=int)
+
+# The maximum number of data sources reading from the same host at the same time in asyncio acquisition mode
+max_concurrency_per_host = config('MAX_CONCURRENCY_PER_HOST', default=4, cast=int)
+
+# The maximum time to read all points of a data source in one cycle in asyncio acquisition mode
+cycle_timeout_in_seconds = config('CYCLE_TIMEOUT_IN_SECONDS', default=300, cast=int)
+
+# The maximum number of cycles waiting for the shared historical database writer in asyncio acquisition mode
+writer_queue_size = config('WRITER_QUEUE_SIZE', default=1000, cast=int)
+
+# Indicates how long the service waits between reloading data sources and points
+reload_interval_in_seconds = config('RELOAD_INTERVAL_IN_SECONDS', default=60, cast=int)
+
+# Indicates how often the main process checks worker processes,
+# worker processes or acquisition tasks terminated unexpectedly are restarted with exponential backoff,
+# from the initial backoff doubling up to the maximum backoff, and start over after running longer than the maximum
+supervisor_interval_in_seconds = config('SUPERVISOR_INTERVAL_IN_SECONDS', default=5, cast=int)
+restart_backoff_initial_in_seconds = config('RESTART_BACKOFF_INITIAL_IN_SECONDS', default=5, cast=int)
+restart_backoff_max_in_seconds = config('RESTART_BACKOFF_MAX_IN_SECONDS', default=600, cast=int)
+
+# The default maximum silence of a trend value of analog point with deadband,
+# a trend value is written when the heartbeat expires even if the value has not moved past the deadband
+deadband_heartbeat_in_seconds = config('DEADBAND_HEARTBEAT_IN_SECONDS', default=900, cast=int)
+
+# Spool of values which cannot be written to historical database,
+# values are replayed with original timestamps when the historical database is available
+spool_directory = config('SPOOL_DIRECTORY', default='spool')
+spool_segment_size_in_bytes = config('SPOOL_SEGMENT_SIZE_IN_BYTES', default=1024*1024, cast=int)
+spool_max_size_in_bytes = config('SPOOL_MAX_SIZE_IN_BYTES', default=1024*1024*1024, cast=int)
+spool_replay_interval_in_seconds = config('SPOOL_REPLAY_INTERVAL_IN_SECONDS', default=60, cast=int)
+# A segment rejected by historical database for its values is moved aside to a .failed file after the maximum attempts
+spool_max_replay_attempts = config('SPOOL_MAX_REPLAY_ATTEMPTS', default=3, cast=int)
+
+# Local HTTP endpoint of metrics in Prometheus text format, served by the gateway process at /metrics
+# Set METRICS_PORT to 0 to disable metrics
+metrics_host = config('METRICS_HOST', default='127.0.0.1')
+metrics_port = config('METRICS_PORT', default=9110, cast=int)
+# Acquisition processes dump snapshots of their metrics to this directory periodically
+metrics_directory = config('METRICS_DIRECTORY', default='metrics')
+metrics_interval_in_seconds = config('METRICS_INTERVAL_IN_SECONDS', default=15, cast=int)
+
+# The default maximum number of outstanding requests pipelined over the connection to a device,
+# which can be overridden by pipeline_window in connection of data source.
+# The client falls back to 1, that is serial mode, if the device does not handle pipelined requests.
+pipeline_window = config('PIPELINE_WINDOW', default=1, cast=int)
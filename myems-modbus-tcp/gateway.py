@@ -1,3 +1,5 @@
+import os
+import shutil
 import time
 from datetime import datetime
 
@@ -5,6 +7,7 @@ import mysql.connector
 import schedule
 
 import config
+import metrics
 
 
 ########################################################################################################################
@@ -58,17 +61,26 @@ def job(logger, ):
     ############################################################################################################
     # Step 2: Collect Gateway Information
     ############################################################################################################
-    # todo: get more information, such as CPU/MEMORY/DISK
     current_datetime_utc = datetime.utcnow()
+    cpu_usage_percent, memory_usage_percent, disk_usage_percent = get_host_resource_usage()
+    for name, value in (('myems_modbus_tcp_host_cpu_usage_percent', cpu_usage_percent),
+                        ('myems_modbus_tcp_host_memory_usage_percent', memory_usage_percent),
+                        ('myems_modbus_tcp_host_disk_usage_percent', disk_usage_percent)):
+        if value is not None:
+            metrics.set_gauge(name, (), value)
 
     ############################################################################################################
     # Step 3: Update Gateway Information
     ############################################################################################################
     update_row = (" UPDATE tbl_gateways "
-                  " SET last_seen_datetime_utc = '" + current_datetime_utc.isoformat() + "' "
+                  " SET last_seen_datetime_utc = '" + current_datetime_utc.isoformat() + "', "
+                  "     cpu_usage_percent = %s, memory_usage_percent = %s, disk_usage_percent = %s "
                   " WHERE id = %s ")
     try:
-        cursor_system_db.execute(update_row, (config.gateway['id'], ))
+        cursor_system_db.execute(update_row, (cpu_usage_percent,
+                                              memory_usage_percent,
+                                              disk_usage_percent,
+                                              config.gateway['id'], ))
         cnx_system_db.commit()
     except Exception as e:
         logger.error("Error in step 3.1 of gateway process " + str(e))
@@ -80,7 +92,58 @@ def job(logger, ):
             cnx_system_db.close()
 
 
+# CPU times of the last heartbeat, used to calculate CPU usage between two heartbeats
+last_cpu_times = None
+
+
+def get_host_resource_usage():
+    """
+    get resource usage of the gateway host from /proc on Linux and the disk of the working directory
+    :return: tuple of (cpu_usage_percent, memory_usage_percent, disk_usage_percent), None if not available
+    """
+    global last_cpu_times
+    cpu_usage_percent = None
+    memory_usage_percent = None
+    disk_usage_percent = None
+
+    try:
+        with open('/proc/stat') as f:
+            # cpu user nice system idle iowait irq softirq steal ...
+            cpu_times = [int(x) for x in f.readline().split()[1:9]]
+        if last_cpu_times is not None:
+            total = sum(cpu_times) - sum(last_cpu_times)
+            idle = cpu_times[3] + cpu_times[4] - last_cpu_times[3] - last_cpu_times[4]
+            if total > 0:
+                cpu_usage_percent = round(100.0 * (total - idle) / total, 2)
+        last_cpu_times = cpu_times
+    except Exception:
+        pass
+
+    try:
+        meminfo = dict()
+        with open('/proc/meminfo') as f:
+            for line in f:
+                meminfo[line.split(':')[0]] = int(line.split()[1])
+        memory_usage_percent = round(100.0 * (meminfo['MemTotal'] - meminfo['MemAvailable']) / meminfo['MemTotal'], 2)
+    except Exception:
+        pass
+
+    try:
+        disk_usage = shutil.disk_usage(os.getcwd())
+        disk_usage_percent = round(100.0 * disk_usage.used / disk_usage.total, 2)
+    except Exception:
+        pass
+
+    return cpu_usage_percent, memory_usage_percent, disk_usage_percent
+
+
 def process(logger, ):
+    # serve metrics of all acquisition processes, and dump metrics of host resource usage
+    metrics.start_server(logger)
+    metrics.start_exporter('gateway')
+    # the first heartbeat only samples CPU times
+    get_host_resource_usage()
+
     schedule.every(config.interval_in_seconds).seconds.do(job, logger,)
 
     while True:
@@ -0,0 +1,101 @@
+import time
+from mysql.connector import errors
+import metrics
+
+
+########################################################################################################################
+# Historical Writer
+# Insert trend values and upsert latest values of one or more acquisition cycles in one transaction.
+# It is shared by the per-process acquisition and the asyncio acquisition.
+########################################################################################################################
+
+# The maximum number of rows in one INSERT statement
+MAX_ROWS_PER_STATEMENT = 1000
+
+# Table names by index of value lists, ANALOG_VALUE, ENERGY_VALUE and DIGITAL_VALUE
+TABLE_NAMES = ('tbl_analog_value', 'tbl_energy_value', 'tbl_digital_value')
+
+# Error numbers of MySQL which are transient for a transaction, lock wait timeout and deadlock
+TRANSIENT_ERRNOS = (1205, 1213)
+
+
+def write_point_values(logger, cnx_historical_db, cursor_historical_db, cycle_list, update_latest=True):
+    """
+    write values of acquisition cycles in one transaction,
+    readers never see a missing latest value because latest values are upserted on point_id
+    :param logger: logger
+    :param cnx_historical_db: connection to historical database
+    :param cursor_historical_db: cursor of the connection
+    :param cycle_list: list of tuples (current_datetime_utc, value_lists) in chronological order,
+                       value_lists are indexed by ANALOG_VALUE, ENERGY_VALUE and DIGITAL_VALUE
+    :param update_latest: whether or not to upsert latest values
+    :return: True if committed, False if rolled back
+    """
+    try:
+        write_cycles(cnx_historical_db, cursor_historical_db, cycle_list, update_latest)
+    except Exception as e:
+        logger.error("Error in step 5.3 of acquisition process " + str(e))
+        try:
+            cnx_historical_db.rollback()
+        except Exception as e:
+            logger.error("Error in step 5.4 of acquisition process " + str(e))
+        return False
+    return True
+
+
+def write_cycles(cnx_historical_db, cursor_historical_db, cycle_list, update_latest=True):
+    """write values of acquisition cycles and commit, raise the error of the transaction, the caller rolls back"""
+    start_time = time.monotonic()
+    # dict of table name to number of rows written in this transaction
+    rows_written_dict = dict()
+    for index, table_name in enumerate(TABLE_NAMES):
+        trend_rows = list()
+        # only the last value of each point is kept in latest table
+        latest_dict = dict()
+        for current_datetime_utc, value_lists in cycle_list:
+            for point_value in value_lists[index]:
+                if point_value['is_trend']:
+                    trend_rows.append((point_value['point_id'], current_datetime_utc, point_value['value']))
+                latest_dict[point_value['point_id']] = (point_value['point_id'],
+                                                        current_datetime_utc,
+                                                        point_value['value'])
+
+        insert_rows(cursor_historical_db,
+                    " INSERT INTO " + table_name + " (point_id, utc_date_time, actual_value) VALUES ",
+                    "",
+                    trend_rows)
+        rows_written_dict[table_name] = len(trend_rows)
+        if update_latest:
+            insert_rows(cursor_historical_db,
+                        " INSERT INTO " + table_name + "_latest (point_id, utc_date_time, actual_value) VALUES ",
+                        " ON DUPLICATE KEY UPDATE "
+                        " utc_date_time = VALUES(utc_date_time), actual_value = VALUES(actual_value) ",
+                        list(latest_dict.values()))
+            rows_written_dict[table_name + '_latest'] = len(latest_dict)
+
+    cnx_historical_db.commit()
+
+    metrics.observe('myems_modbus_tcp_write_duration_seconds', (), time.monotonic() - start_time)
+    for table_name, rows_written in rows_written_dict.items():
+        metrics.inc('myems_modbus_tcp_rows_written_total', (('table', table_name),), rows_written)
+
+
+def is_transient_error(cnx_historical_db, e):
+    """
+    return True if the error of a transaction is transient, such as a lost connection or a deadlock,
+    or False if it is caused by the values, such as a value out of range of the column
+    """
+    if isinstance(e, (errors.InterfaceError, errors.OperationalError)) or getattr(e, 'errno', None) in TRANSIENT_ERRNOS:
+        return True
+    try:
+        return not cnx_historical_db.is_connected()
+    except Exception:
+        return True
+
+
+def insert_rows(cursor, insert_clause, suffix_clause, rows):
+    """execute parameterized multi-row inserts with at most MAX_ROWS_PER_STATEMENT rows each"""
+    for i in range(0, len(rows), MAX_ROWS_PER_STATEMENT):
+        rows_in_statement = rows[i:i + MAX_ROWS_PER_STATEMENT]
+        cursor.execute(insert_clause + ", ".join(["(%s, %s, %s)"] * len(rows_in_statement)) + suffix_clause,
+                       [parameter for row in rows_in_statement for parameter in row])
@@ -1,12 +1,14 @@
-import json
 import logging
 import time
 from logging.handlers import RotatingFileHandler
-from multiprocessing import Process
+from multiprocessing import Event
 import mysql.connector
 import acquisition
+import async_acquisition
 import config
 import gateway
+import reloader
+import supervisor
 
 
 def main():
@@ -31,102 +33,110 @@ def main():
     ####################################################################################################################
     # Create Gateway Process
     ####################################################################################################################
-    Process(target=gateway.process, args=(logger,)).start()
+    gateway_worker = supervisor.new_worker('gateway', gateway.process, (logger,))
+    supervisor.start(gateway_worker)
 
-    # Get Data Sources
-    data_source_list = list()
+    ####################################################################################################################
+    # Reset data sources' process_id to NULL
+    ####################################################################################################################
     while True:
-        # TODO: This service has to RESTART to reload latest data sources and this should be fixed
         cnx_system_db = None
         cursor_system_db = None
         try:
             cnx_system_db = mysql.connector.connect(**config.myems_system_db)
             cursor_system_db = cnx_system_db.cursor()
-        except Exception as e:
-            logger.error("Error in main process " + str(e))
-            if cursor_system_db:
-                cursor_system_db.close()
-            if cnx_system_db:
-                cnx_system_db.close()
-            # sleep several minutes and continue the outer loop to reload points
-            time.sleep(60)
-            continue
-
-        # Get data sources by gateway and protocol
-        rows_data_source = None
-        try:
-            # query all data sources by the gateway and token
-            query = (" SELECT ds.id, ds.name, ds.connection "
-                     " FROM tbl_data_sources ds, tbl_gateways g "
-                     " WHERE ds.protocol = 'modbus-tcp' AND ds.gateway_id = g.id AND g.id = %s AND g.token = %s "
-                     " ORDER BY ds.id ")
-            cursor_system_db.execute(query, (config.gateway['id'], config.gateway['token'],))
-            rows_data_source = cursor_system_db.fetchall()
-
-            # reset data sources' process_id to NULL
             query = (" UPDATE tbl_data_sources ds, tbl_gateways g "
                      " SET ds.process_id = NULL "
                      " WHERE ds.protocol = 'modbus-tcp' AND ds.gateway_id = g.id AND g.id = %s AND g.token = %s ")
             cursor_system_db.execute(query, (config.gateway['id'], config.gateway['token'],))
             cnx_system_db.commit()
-
         except Exception as e:
             logger.error("Error in main process " + str(e))
-            # sleep several minutes and continue the outer loop to reload points
+            # sleep several minutes and retry
             time.sleep(60)
+            continue
         finally:
             if cursor_system_db:
                 cursor_system_db.close()
             if cnx_system_db:
                 cnx_system_db.close()
+        break
 
-        if rows_data_source is None or len(rows_data_source) == 0:
-            logger.error("Data Source Not Found, Wait for minutes to retry.")
-            # wait for a while and retry
-            time.sleep(60)
-            continue
-        else:
-            # Stop the while loop to connect these data sources
-            data_source_list = rows_data_source
-            break
+    if config.acquisition_mode == 'asyncio':
+        # every event loop process reloads its own share of data sources
+        number_of_processes = max(config.asyncio_processes, 1)
+        worker_list = list()
+        for index in range(number_of_processes):
+            worker = supervisor.new_worker('asyncio_process_' + str(index), async_acquisition.process,
+                                           (logger, index, number_of_processes))
+            supervisor.start(worker)
+            worker_list.append(worker)
 
-    for data_source in data_source_list:
-        print("Data Source: ID=%s, Name=%s, Connection=%s " %
-              (data_source[0], data_source[1], data_source[2]))
+        # restart event loop processes and gateway process if they terminated unexpectedly
+        while True:
+            supervisor.check(logger, gateway_worker, list())
+            for worker in worker_list:
+                # data sources of an event loop process are matched by its process id
+                supervisor.check(logger, worker)
+            time.sleep(config.supervisor_interval_in_seconds)
 
-        if data_source[2] is None or len(data_source[2]) == 0:
-            logger.error("Data Source Connection Not Found.")
+    ####################################################################################################################
+    # Reload data sources periodically, and start, stop or re-plan only the changed data sources,
+    # restart worker processes which terminated unexpectedly in between
+    ####################################################################################################################
+    running_dict = dict()
+    next_reload = time.monotonic()
+    while True:
+        if time.monotonic() < next_reload:
+            supervisor.check(logger, gateway_worker, list())
+            for data_source_id, running in running_dict.items():
+                if running['worker'] is not None:
+                    supervisor.check(logger, running['worker'], [data_source_id])
+            time.sleep(config.supervisor_interval_in_seconds)
             continue
 
-        try:
-            server = json.loads(data_source[2])
-        except Exception as e:
-            logger.error("Data Source Connection JSON error " + str(e))
+        latest_dict = reloader.load_data_sources(logger)
+        if latest_dict is None:
+            # wait for a while and retry
+            next_reload = time.monotonic() + 60
             continue
+        next_reload = time.monotonic() + config.reload_interval_in_seconds
 
-        if 'host' not in server.keys() \
-                or 'port' not in server.keys() \
-                or server['host'] is None \
-                or server['port'] is None \
-                or len(server['host']) == 0 \
-                or not isinstance(server['port'], int) \
-                or server['port'] < 1 \
-                or server['port'] > 65535:
-            logger.error("Data Source Connection Invalid.")
-            continue
-        if 'interval_in_seconds' not in server.keys() \
-            or (not isinstance(server['interval_in_seconds'], int)
-                and not isinstance(server['interval_in_seconds'], float)) \
-            or server['interval_in_seconds'] < 0 \
-                or server['interval_in_seconds'] > 3600:
-            interval_in_seconds = config.interval_in_seconds
-        else:
-            interval_in_seconds = server['interval_in_seconds']
+        if len(latest_dict) == 0:
+            logger.error("Data Source Not Found, Wait for minutes to retry.")
+
+        to_stop, to_start, to_replan = reloader.diff(running_dict, latest_dict)
+
+        for data_source_id in to_stop:
+            running = running_dict.pop(data_source_id)
+            if running['worker'] is not None:
+                supervisor.stop(running['worker'])
+
+        for data_source_id in to_start:
+            data_source = latest_dict[data_source_id]
+            print("Data Source: ID=%s, Name=%s, Connection=%s " %
+                  (data_source_id, data_source['name'], data_source['connection']))
+            running = {'connection': data_source['connection'],
+                       'points_signature': data_source['points_signature'],
+                       'worker': None,
+                       'reload_event': None}
+            server = reloader.parse_connection(logger, data_source_id, data_source['connection'])
+            if server is not None:
+                host, port, interval_in_seconds, pipeline_window = server
+                # fork worker process for each data source
+                running['reload_event'] = Event()
+                running['worker'] = supervisor.new_worker('data_source_' + str(data_source_id), acquisition.process,
+                                                          (logger, data_source_id, host, port, interval_in_seconds,
+                                                           pipeline_window, running['reload_event']))
+                supervisor.start(running['worker'])
+            running_dict[data_source_id] = running
 
-        # fork worker process for each data source
-        # todo: how to restart the process if the process terminated unexpectedly
-        Process(target=acquisition.process,
-                args=(logger, data_source[0], server['host'], server['port'], interval_in_seconds)).start()
+        for data_source_id in to_replan:
+            running = running_dict[data_source_id]
+            running['points_signature'] = latest_dict[data_source_id]['points_signature']
+            if running['reload_event'] is not None:
+                # the worker process reloads points and rebuilds its read plan
+                running['reload_event'].set()
 
 
 if __name__ == "__main__":
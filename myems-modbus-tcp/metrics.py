@@ -0,0 +1,201 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import config
+
+
+########################################################################################################################
+# Metrics
+# Every acquisition process keeps counters, gauges and latency histograms in memory, and an exporter thread dumps
+# a snapshot to METRICS_DIRECTORY periodically. The gateway process serves all snapshots through a local HTTP endpoint
+# in Prometheus text format, where every series is labeled with the worker that produced it.
+########################################################################################################################
+
+# Upper bounds of latency histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Type and help of metrics by name
+METRICS = {
+    'myems_modbus_tcp_cycle_duration_seconds':
+        ('histogram', 'Duration of reading due scan classes of a data source.'),
+    'myems_modbus_tcp_request_duration_seconds':
+        ('histogram', 'Round trip time of Modbus requests.'),
+    'myems_modbus_tcp_points_read_total':
+        ('counter', 'Number of point values read.'),
+    'myems_modbus_tcp_timeouts_total':
+        ('counter', 'Number of Modbus requests timed out.'),
+    'myems_modbus_tcp_request_errors_total':
+        ('counter', 'Number of Modbus requests failed with exception responses or other errors.'),
+    'myems_modbus_tcp_decode_errors_total':
+        ('counter', 'Number of point values failed to decode, not a number or out of range.'),
+    'myems_modbus_tcp_rows_written_total':
+        ('counter', 'Number of rows written to historical database.'),
+    'myems_modbus_tcp_write_duration_seconds':
+        ('histogram', 'Duration of transactions writing to historical database.'),
+    'myems_modbus_tcp_spooled_cycles_total':
+        ('counter', 'Number of acquisition cycles appended to spool.'),
+    'myems_modbus_tcp_failed_segments_total':
+        ('counter', 'Number of spool segments rejected by historical database and moved aside.'),
+    'myems_modbus_tcp_host_cpu_usage_percent':
+        ('gauge', 'CPU usage of gateway host.'),
+    'myems_modbus_tcp_host_memory_usage_percent':
+        ('gauge', 'Memory usage of gateway host.'),
+    'myems_modbus_tcp_host_disk_usage_percent':
+        ('gauge', 'Disk usage of gateway host.'),
+}
+
+_lock = threading.Lock()
+# dict of (name, labels) to value, where labels is a tuple of (label_name, label_value) pairs
+_counters = dict()
+_gauges = dict()
+# dict of (name, labels) to list of bucket counts followed by sum and count
+_histograms = dict()
+
+
+def inc(name, labels, value=1):
+    """increase a counter"""
+    with _lock:
+        _counters[(name, labels)] = _counters.get((name, labels), 0) + value
+
+
+def set_gauge(name, labels, value):
+    """set a gauge"""
+    with _lock:
+        _gauges[(name, labels)] = value
+
+
+def observe(name, labels, value):
+    """observe a value in a histogram"""
+    with _lock:
+        histogram = _histograms.get((name, labels))
+        if histogram is None:
+            histogram = [0] * (len(BUCKETS) + 2)
+            _histograms[(name, labels)] = histogram
+        for i, upper_bound in enumerate(BUCKETS):
+            if value <= upper_bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+def snapshot():
+    """return all metrics of this process as a JSON serializable list"""
+    with _lock:
+        return [['counter', name, labels, value] for (name, labels), value in _counters.items()] + \
+               [['gauge', name, labels, value] for (name, labels), value in _gauges.items()] + \
+               [['histogram', name, labels, list(value)] for (name, labels), value in _histograms.items()]
+
+
+########################################################################################################################
+# Exporter of acquisition processes
+########################################################################################################################
+
+
+def start_exporter(name):
+    """
+    start a daemon thread to dump metrics of this process periodically
+    :param name: name of the worker, for example data_source_1 or asyncio_process_0
+    """
+    if config.metrics_port == 0:
+        return
+    os.makedirs(config.metrics_directory, exist_ok=True)
+    threading.Thread(target=_export_forever, args=(name,), daemon=True).start()
+
+
+def _export_forever(name):
+    path = os.path.join(config.metrics_directory, name + '.json')
+    while True:
+        try:
+            # write to a temporary file and rename it, so that the server never reads a partial snapshot
+            with open(path + '.tmp', 'w') as f:
+                json.dump(snapshot(), f, separators=(',', ':'))
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            print("Error in exporting metrics " + str(e))
+        time.sleep(config.metrics_interval_in_seconds)
+
+
+########################################################################################################################
+# Server in gateway process
+########################################################################################################################
+
+
+def render():
+    """render snapshots of all live workers in Prometheus text format"""
+    series_dict = dict()
+    now = time.time()
+    for file_name in sorted(os.listdir(config.metrics_directory)):
+        if not file_name.endswith('.json'):
+            continue
+        path = os.path.join(config.metrics_directory, file_name)
+        try:
+            # snapshots of terminated workers are stale
+            if now - os.path.getmtime(path) > config.metrics_interval_in_seconds * 3:
+                continue
+            with open(path) as f:
+                rows = json.load(f)
+        except Exception:
+            continue
+        worker = file_name[:-len('.json')]
+        for kind, name, labels, value in rows:
+            if name not in series_dict:
+                series_dict[name] = list()
+            series_dict[name].append((kind, [['worker', worker]] + labels, value))
+
+    lines = list()
+    for name in sorted(series_dict.keys()):
+        kind, description = METRICS.get(name, (series_dict[name][0][0], ''))
+        lines.append('# HELP ' + name + ' ' + description)
+        lines.append('# TYPE ' + name + ' ' + kind)
+        for kind, labels, value in series_dict[name]:
+            if kind == 'histogram':
+                cumulative_count = 0
+                for i, upper_bound in enumerate(BUCKETS):
+                    cumulative_count += value[i]
+                    lines.append(name + '_bucket' + format_labels(labels + [['le', upper_bound]]) +
+                                 ' ' + str(cumulative_count))
+                lines.append(name + '_bucket' + format_labels(labels + [['le', '+Inf']]) + ' ' + str(value[-1]))
+                lines.append(name + '_sum' + format_labels(labels) + ' ' + str(value[-2]))
+                lines.append(name + '_count' + format_labels(labels) + ' ' + str(value[-1]))
+            else:
+                lines.append(name + format_labels(labels) + ' ' + str(value))
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    return '{' + ','.join(str(label_name) + '="' + str(label_value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for label_name, label_value in labels) + '}'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        data = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # do not log every scrape
+        pass
+
+
+def start_server(logger):
+    """start a daemon thread to serve metrics on METRICS_HOST:METRICS_PORT"""
+    if config.metrics_port == 0:
+        return
+    try:
+        os.makedirs(config.metrics_directory, exist_ok=True)
+        server = ThreadingHTTPServer((config.metrics_host, config.metrics_port), MetricsHandler)
+    except Exception as e:
+        logger.error("Error in starting metrics server " + str(e))
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
@@ -0,0 +1,213 @@
+import asyncio
+import struct
+import time
+import metrics
+
+
+########################################################################################################################
+# Asyncio Modbus TCP Client
+# A minimal Modbus TCP client for reading coils, discrete inputs, holding registers and input registers.
+# The results are in the same form as modbus_tk returns without data format,
+# that is a tuple of bits for function code 1 and 2, and a tuple of unsigned 16-bit registers for function code 3 and 4.
+########################################################################################################################
+
+# Exception code of a slave which is busy processing a long-duration command
+SLAVE_DEVICE_BUSY = 6
+
+
+class ModbusError(Exception):
+    """exception response or invalid response from Modbus slave"""
+    pass
+
+
+class ModbusTcpClient:
+    """
+    Modbus TCP client over a persistent connection. Up to window requests are pipelined, that is sent without waiting
+    for the responses of the previous requests, and the responses are matched by MBAP transaction identifier.
+    The client falls back to serial mode, that is window of 1, if the device does not handle pipelined requests.
+    """
+
+    def __init__(self, host, port, timeout_in_sec=5.0, window=1, data_source_id=None):
+        """
+        :param host: host of the device
+        :param port: port of the device
+        :param timeout_in_sec: timeout of connecting and of each request
+        :param window: the maximum number of outstanding requests
+        :param data_source_id: data source id, used in labels of metrics
+        """
+        self.host = host
+        self.port = port
+        self.timeout_in_sec = timeout_in_sec
+        self.window = max(window, 1)
+        self.data_source_id = data_source_id
+        self._reader = None
+        self._writer = None
+        self._receiver = None
+        self._transaction_id = 0
+        # dict of transaction id to future of response pdu
+        self._pending = dict()
+        self._connect_lock = asyncio.Lock()
+        self._drain_lock = asyncio.Lock()
+        self._window_condition = asyncio.Condition()
+
+    def is_connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self.is_connected():
+                return
+            try:
+                self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                                    timeout=self.timeout_in_sec)
+            except asyncio.TimeoutError:
+                raise TimeoutError("timed out")
+            self._receiver = asyncio.ensure_future(self._receive(self._reader))
+
+    async def close(self):
+        writer = self._writer
+        receiver = self._receiver
+        self._reader = None
+        self._writer = None
+        self._receiver = None
+        self._fail_pending(ConnectionError("connection closed"))
+        if receiver is not None and receiver is not asyncio.current_task():
+            receiver.cancel()
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _close_writer(self, writer):
+        """close the connection of a failed request, unless it has been closed and reconnected by another request"""
+        if self._writer is writer:
+            await self.close()
+        else:
+            writer.close()
+
+    def fall_back_to_serial(self, reason):
+        """the device does not handle pipelined requests, send requests one by one from now on"""
+        if self.window > 1:
+            print("Fall back to serial mode for %s:%s: %s" % (self.host, self.port, reason))
+            self.window = 1
+
+    def _fail_pending(self, exception):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exception)
+        self._pending.clear()
+
+    async def _receive(self, reader):
+        """receive responses and resolve the futures of requests by transaction id"""
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction_id, _, length, _ = struct.unpack('>HHHB', header)
+                response_pdu = await reader.readexactly(length - 1)
+                future = self._pending.pop(transaction_id, None)
+                if future is None:
+                    # late response of a request that was timed out, or a device that does not echo transaction id
+                    if self.window > 1:
+                        self.fall_back_to_serial("unexpected transaction id " + str(transaction_id))
+                    continue
+                if not future.done():
+                    future.set_result(response_pdu)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self._reader is reader:
+                # the connection is lost, fail the outstanding requests and reconnect on next request
+                self._fail_pending(e)
+                await self.close()
+
+    async def read(self, slave_id, function_code, starting_address, quantity_of_x):
+        """send one read request and wait for the response, requests may be outstanding at the same time"""
+        labels = (('data_source_id', self.data_source_id), ('slave_id', slave_id))
+        pdu = struct.pack('>BHH', function_code, starting_address, quantity_of_x)
+        await self.connect()
+        async with self._window_condition:
+            await self._window_condition.wait_for(lambda: len(self._pending) < self.window)
+            if not self.is_connected():
+                await self.connect()
+            self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+            transaction_id = self._transaction_id
+            future = asyncio.get_running_loop().create_future()
+            self._pending[transaction_id] = future
+            number_of_outstanding_requests = len(self._pending)
+            # the writer is taken under the lock right after the connection is checked, because a close by the timeout
+            # of another request sets self._writer to None, then this request fails on the closed writer with
+            # ConnectionError instead of AttributeError, and the next request reconnects
+            writer = self._writer
+
+        start_time = time.monotonic()
+        try:
+            writer.write(struct.pack('>HHHB', transaction_id, 0, len(pdu) + 1, slave_id) + pdu)
+            async with self._drain_lock:
+                await writer.drain()
+            response_pdu = await asyncio.wait_for(future, timeout=self.timeout_in_sec)
+        except asyncio.TimeoutError:
+            metrics.inc('myems_modbus_tcp_timeouts_total', labels)
+            if number_of_outstanding_requests > 1:
+                # the device may drop requests when more than one request is outstanding
+                self.fall_back_to_serial("timed out with " + str(number_of_outstanding_requests) +
+                                         " outstanding requests")
+            # the connection is out of sync, reconnect on next request
+            await self._close_writer(writer)
+            raise TimeoutError("timed out")
+        except Exception:
+            metrics.inc('myems_modbus_tcp_request_errors_total', labels)
+            await self._close_writer(writer)
+            raise
+        finally:
+            self._pending.pop(transaction_id, None)
+            async with self._window_condition:
+                self._window_condition.notify_all()
+        metrics.observe('myems_modbus_tcp_request_duration_seconds', labels, time.monotonic() - start_time)
+
+        try:
+            data = parse_response(function_code, quantity_of_x, response_pdu)
+        except ModbusError:
+            metrics.inc('myems_modbus_tcp_request_errors_total', labels)
+            if len(response_pdu) >= 2 and response_pdu[0] & 0x80 and response_pdu[1] == SLAVE_DEVICE_BUSY \
+                    and number_of_outstanding_requests > 1:
+                self.fall_back_to_serial("slave device busy")
+            raise
+        return data
+
+    async def read_many(self, request_list):
+        """
+        pipeline read requests within the window
+        :param request_list: list of tuples (slave_id, function_code, starting_address, quantity_of_x)
+        :return: list of results or exceptions in the same order as request_list
+        """
+        return await asyncio.gather(*[self.read(*request) for request in request_list], return_exceptions=True)
+
+
+def parse_response(function_code, quantity_of_x, response_pdu):
+    """parse the response pdu of a read request"""
+    # a response has a function code and an exception code or a byte count at least
+    if len(response_pdu) < 2:
+        raise ModbusError("Modbus Error: Malformed response of length " + str(len(response_pdu)))
+    if response_pdu[0] & 0x80:
+        raise ModbusError("Modbus Error: Exception code = " + str(response_pdu[1]))
+    if response_pdu[0] != function_code:
+        raise ModbusError("Modbus Error: Unexpected function code = " + str(response_pdu[0]))
+
+    byte_count = response_pdu[1]
+    data = response_pdu[2:]
+    if byte_count != len(data):
+        raise ModbusError("Modbus Error: Byte count " + str(byte_count) +
+                          " is different from data length " + str(len(data)))
+
+    if function_code in (1, 2):
+        bits = list()
+        for byte_value in data:
+            for i in range(8):
+                if len(bits) >= quantity_of_x:
+                    break
+                bits.append((byte_value >> i) & 0x01)
+        return tuple(bits)
+
+    return struct.unpack('>%dH' % (byte_count // 2), data)
@@ -0,0 +1,407 @@
+import json
+import struct
+import config
+
+
+########################################################################################################################
+# Read Plan
+# Points are compiled once when the point list is loaded. Addresses are parsed and validated, data formats are
+# compiled to struct unpackers, and ratio and offset constant are converted to native numbers, so that the
+# acquisition loop only does I/O and arithmetic. Invalid points are rejected at load time.
+# Points on the same slave and function code are grouped, and overlapping or nearby register ranges are merged into
+# block reads within the Modbus PDU limit. All points of a block are decoded at once by a few precompiled structs,
+# which unpack the whole register buffer with pad bytes between points, and then scaled in bulk.
+# Points are also grouped into scan classes by scan interval and priority, and a deadline scheduler reads only the
+# scan classes that are due, so fast changing points and slow changing points can be polled at different intervals.
+########################################################################################################################
+
+# The maximum quantity of registers (function code 3 and 4) or bits (function code 1 and 2) in one request
+MAX_QUANTITY_OF_REGISTERS = 125
+MAX_QUANTITY_OF_BITS = 2000
+
+# The range of scan interval of points, a scan class with a shorter interval would poll the device in a tight loop
+MIN_SCAN_INTERVAL_IN_SECONDS = 1
+MAX_SCAN_INTERVAL_IN_SECONDS = 3600
+
+# Standard SQL requires that DECIMAL(18, 3) be able to store any value with 18 digits and
+# 3 decimals, so values that can be stored in the column range
+# from -999999999999999.999 to 999999999999999.999.
+MIN_DECIMAL_VALUE = -999999999999999.999
+MAX_DECIMAL_VALUE = 999999999999999.999
+
+# Index of value lists by object type
+ANALOG_VALUE = 0
+ENERGY_VALUE = 1
+DIGITAL_VALUE = 2
+VALUE_LIST_INDEX = {'ANALOG_VALUE': ANALOG_VALUE,
+                    'ENERGY_VALUE': ENERGY_VALUE,
+                    'DIGITAL_VALUE': DIGITAL_VALUE}
+
+
+class PlanPoint:
+    """a point compiled for reading and converting its value"""
+    __slots__ = ('id', 'is_trend', 'value_list_index', 'ratio', 'offset_constant',
+                 'slave_id', 'function_code', 'offset', 'number_of_registers', 'format', 'byte_swap',
+                 'unpack_from', 'swap',
+                 'deadband_absolute', 'deadband_percent', 'heartbeat_in_seconds',
+                 'last_trend_value', 'last_trend_timestamp',
+                 'scan_interval_in_seconds', 'priority')
+
+    def decode(self, buffer, starting_address):
+        """
+        decode the raw value of this point alone from a buffer returned by to_buffer, with byte swap applied
+        :param buffer: bits (function code 1 and 2) or bytes of registers (function code 3 and 4)
+        :param starting_address: the starting address of the buffer
+        """
+        index = self.offset - starting_address
+        if self.unpack_from is None:
+            return buffer[index]
+        if self.swap:
+            return self.unpack_from(swap_adjacent_bytes(buffer[index * 2:(index + self.number_of_registers) * 2]))[0]
+        return self.unpack_from(buffer, index * 2)[0]
+
+    def convert(self, value):
+        """apply ratio and offset constant, return None if the value is invalid"""
+        # NaN is not equal to itself
+        if value != value or not MIN_DECIMAL_VALUE <= value <= MAX_DECIMAL_VALUE:
+            return None
+
+        if self.value_list_index == DIGITAL_VALUE:
+            return int(value) * self.ratio + self.offset_constant
+        return value * self.ratio + self.offset_constant
+
+    def is_trend_value(self, value, timestamp):
+        """
+        report by exception, with deadband a trend value is written only if it moves past the deadband
+        since the last trend value or the heartbeat expires
+        :param value: the converted value
+        :param timestamp: the current time in seconds
+        """
+        if not self.is_trend:
+            return False
+        if self.deadband_absolute is None and self.deadband_percent is None:
+            return True
+
+        if self.last_trend_value is not None \
+                and timestamp - self.last_trend_timestamp < self.heartbeat_in_seconds:
+            delta = abs(value - self.last_trend_value)
+            if (self.deadband_absolute is None or delta <= self.deadband_absolute) \
+                    and (self.deadband_percent is None
+                         or delta <= abs(self.last_trend_value) * self.deadband_percent / 100):
+                return False
+
+        self.last_trend_value = value
+        self.last_trend_timestamp = timestamp
+        return True
+
+
+class ReadBlock:
+    """a block read of contiguous registers or bits on one slave"""
+    __slots__ = ('slave_id', 'function_code', 'starting_address', 'quantity_of_x', 'points',
+                 'decoders', 'gather', 'ratios', 'offset_constants', 'is_digital')
+
+    def __init__(self, slave_id, function_code, starting_address, quantity_of_x):
+        self.slave_id = slave_id
+        self.function_code = function_code
+        self.starting_address = starting_address
+        self.quantity_of_x = quantity_of_x
+        self.points = list()
+        self.decoders = None
+        self.gather = None
+        self.ratios = None
+        self.offset_constants = None
+        self.is_digital = None
+
+    def compile(self):
+        """
+        compile decoders of all points in this block.
+        points with the same byte order and byte swap are packed into one struct with pad bytes between them,
+        points overlapping a previous point or in native byte order start another struct
+        """
+        self.ratios = tuple(point.ratio for point in self.points)
+        self.offset_constants = tuple(point.offset_constant for point in self.points)
+        self.is_digital = tuple(point.value_list_index == DIGITAL_VALUE for point in self.points)
+        if self.function_code in (1, 2):
+            self.decoders = None
+            self.gather = tuple(point.offset - self.starting_address for point in self.points)
+            return
+
+        # each run is a list of [byte order, swap, offset in bytes, end in bytes, format of points, number of values]
+        runs = list()
+        # tuple of (run index, index of the first value in the run) of every point
+        value_positions = [None] * len(self.points)
+        for i in sorted(range(len(self.points)), key=lambda x: self.points[x].offset):
+            point = self.points[i]
+            position = (point.offset - self.starting_address) * 2
+            byte_order = point.format[0] if point.format[0] in '<>!=' else None
+            number_of_values = len(struct.unpack(point.format, bytes(point.number_of_registers * 2)))
+            run = None
+            if byte_order is not None:
+                for candidate in runs:
+                    if candidate[0] == byte_order and candidate[1] == point.swap and candidate[3] <= position:
+                        run = candidate
+                        break
+            if run is None:
+                run = [byte_order, point.swap, position, position, list(), 0]
+                runs.append(run)
+            if position > run[3]:
+                run[4].append('%dx' % (position - run[3]))
+            run[4].append(point.format if byte_order is None else point.format[1:])
+            run[3] = position + point.number_of_registers * 2
+            value_positions[i] = (runs.index(run), run[5])
+            run[5] += number_of_values
+
+        self.decoders = tuple((struct.Struct((run[0] or '') + ''.join(run[4])).unpack_from, run[2], run[1])
+                              for run in runs)
+        run_bases = [0] * len(runs)
+        for i in range(1, len(runs)):
+            run_bases[i] = run_bases[i - 1] + runs[i - 1][5]
+        self.gather = tuple(run_bases[run_index] + value_index for run_index, value_index in value_positions)
+
+    def decode(self, buffer):
+        """
+        decode and convert values of all points in this block at once
+        :param buffer: bits (function code 1 and 2) or bytes of registers (function code 3 and 4)
+        :return: list of values in the order of points, None if the value is invalid
+        """
+        if self.decoders is None:
+            raw_values = [buffer[i] for i in self.gather]
+        else:
+            values = ()
+            swapped_buffer = None
+            for unpack_from, offset, swap in self.decoders:
+                if swap:
+                    if swapped_buffer is None:
+                        swapped_buffer = swap_adjacent_bytes(buffer)
+                    values += unpack_from(swapped_buffer, offset)
+                else:
+                    values += unpack_from(buffer, offset)
+            raw_values = [values[i] for i in self.gather]
+
+        # NaN is not equal to itself
+        return [None if value != value or not MIN_DECIMAL_VALUE <= value <= MAX_DECIMAL_VALUE
+                else int(value) * ratio + offset_constant if is_digital
+                else value * ratio + offset_constant
+                for value, ratio, offset_constant, is_digital
+                in zip(raw_values, self.ratios, self.offset_constants, self.is_digital)]
+
+
+class ScanClass:
+    """blocks of points with the same scan interval and priority, which are read together when due"""
+    __slots__ = ('interval_in_seconds', 'priority', 'blocks', 'next_due')
+
+    def __init__(self, interval_in_seconds, priority):
+        self.interval_in_seconds = interval_in_seconds
+        self.priority = priority
+        self.blocks = list()
+        self.next_due = 0.0
+
+
+def to_buffer(function_code, data):
+    """pack registers into bytes once so that every point is unpacked at its offset"""
+    if function_code in (1, 2):
+        return data
+    return struct.pack('>%dH' % len(data), *data)
+
+
+def swap_adjacent_bytes(buffer):
+    """swap adjacent bytes of every register in one pass, abcd => badc, this is not big-endian and little-endian"""
+    swapped_buffer = bytearray(len(buffer))
+    swapped_buffer[0::2] = buffer[1::2]
+    swapped_buffer[1::2] = buffer[0::2]
+    return swapped_buffer
+
+
+def to_native_number(value):
+    """convert DECIMAL from database to int if it is integral, or else to float"""
+    if value == int(value):
+        return int(value)
+    return float(value)
+
+
+def is_non_negative_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+
+
+def compile_point(point, interval_in_seconds):
+    """
+    compile a point dict from database, return None if the point is invalid
+    :param point: point dict from database
+    :param interval_in_seconds: the interval of data source, which is the default scan interval of points
+    """
+    try:
+        address = json.loads(point['address'])
+        if not isinstance(address, dict) \
+                or 'slave_id' not in address.keys() \
+                or 'function_code' not in address.keys() \
+                or 'offset' not in address.keys() \
+                or 'number_of_registers' not in address.keys() \
+                or 'format' not in address.keys() \
+                or 'byte_swap' not in address.keys() \
+                or not isinstance(address['slave_id'], int) \
+                or not isinstance(address['offset'], int) \
+                or not isinstance(address['number_of_registers'], int) \
+                or address['slave_id'] < 1 \
+                or address['function_code'] not in (1, 2, 3, 4) \
+                or address['offset'] < 0 \
+                or address['number_of_registers'] < 0 \
+                or len(address['format']) < 1 \
+                or not isinstance(address['byte_swap'], bool):
+            return None
+
+        plan_point = PlanPoint()
+        plan_point.id = point['id']
+        plan_point.is_trend = point['is_trend']
+        plan_point.value_list_index = VALUE_LIST_INDEX[point['object_type']]
+        if plan_point.value_list_index == DIGITAL_VALUE:
+            plan_point.ratio = int(point['ratio'])
+            plan_point.offset_constant = int(point['offset_constant'])
+        else:
+            plan_point.ratio = to_native_number(point['ratio'])
+            plan_point.offset_constant = to_native_number(point['offset_constant'])
+        plan_point.slave_id = address['slave_id']
+        plan_point.function_code = address['function_code']
+        plan_point.offset = address['offset']
+        plan_point.number_of_registers = address['number_of_registers']
+        plan_point.format = address['format']
+        plan_point.byte_swap = address['byte_swap']
+
+        if plan_point.function_code in (1, 2):
+            plan_point.unpack_from = None
+        else:
+            # the data format must unpack a number from exactly the registers of the point
+            unpacker = struct.Struct(plan_point.format)
+            if unpacker.size != plan_point.number_of_registers * 2 \
+                    or not isinstance(unpacker.unpack(bytes(unpacker.size))[0], (int, float)):
+                return None
+            plan_point.unpack_from = unpacker.unpack_from
+
+        # adjacent bytes of 32-bit and 64-bit values are swapped
+        plan_point.swap = plan_point.byte_swap and plan_point.number_of_registers in (2, 4)
+
+        # optional deadband of analog value, for example {"absolute": 0.5, "percent": 1, "heartbeat_in_seconds": 900}
+        plan_point.deadband_absolute = None
+        plan_point.deadband_percent = None
+        plan_point.heartbeat_in_seconds = None
+        plan_point.last_trend_value = None
+        plan_point.last_trend_timestamp = None
+        if plan_point.value_list_index == ANALOG_VALUE and address.get('deadband') is not None:
+            deadband = address['deadband']
+            if not is_non_negative_number(deadband.get('absolute', 0)) \
+                    or not is_non_negative_number(deadband.get('percent', 0)) \
+                    or not is_non_negative_number(deadband.get('heartbeat_in_seconds', 0)):
+                return None
+            plan_point.deadband_absolute = deadband.get('absolute')
+            plan_point.deadband_percent = deadband.get('percent')
+            plan_point.heartbeat_in_seconds = deadband.get('heartbeat_in_seconds',
+                                                           config.deadband_heartbeat_in_seconds)
+
+        # optional scan class, for example {"scan_interval_in_seconds": 2, "priority": 1}
+        plan_point.scan_interval_in_seconds = address.get('scan_interval_in_seconds', interval_in_seconds)
+        plan_point.priority = address.get('priority', 0)
+        if not is_non_negative_number(plan_point.scan_interval_in_seconds) \
+                or plan_point.scan_interval_in_seconds < MIN_SCAN_INTERVAL_IN_SECONDS \
+                or plan_point.scan_interval_in_seconds > MAX_SCAN_INTERVAL_IN_SECONDS \
+                or not isinstance(plan_point.priority, int):
+            return None
+    except Exception:
+        return None
+
+    return plan_point
+
+
+def build_read_plan(logger, data_source_id, point_list, interval_in_seconds, max_gap):
+    """
+    compile points and build block reads of scan classes
+    :param logger: logger
+    :param data_source_id: data source id, used in log messages
+    :param point_list: list of point dicts from database
+    :param interval_in_seconds: the interval of data source, which is the default scan interval of points
+    :param max_gap: the maximum number of unused registers or bits between two points in the same block,
+                    negative value disables merging and every point is read individually
+    :return: list of ScanClass in order of priority from high to low
+    """
+    groups = dict()
+    for point in point_list:
+        if point['object_type'] not in VALUE_LIST_INDEX:
+            # other object types are not acquired from Modbus
+            continue
+        plan_point = compile_point(point, interval_in_seconds)
+        if plan_point is None:
+            logger.error('Data Source(ID=%s), Point(ID=%s) Invalid address data.', data_source_id, point['id'])
+            continue
+        key = (plan_point.scan_interval_in_seconds, plan_point.priority, plan_point.slave_id, plan_point.function_code)
+        if key not in groups:
+            groups[key] = list()
+        groups[key].append(plan_point)
+
+    scan_class_dict = dict()
+    for (scan_interval_in_seconds, priority, slave_id, function_code), group in groups.items():
+        if (scan_interval_in_seconds, priority) not in scan_class_dict:
+            scan_class_dict[(scan_interval_in_seconds, priority)] = ScanClass(scan_interval_in_seconds, priority)
+        scan_class = scan_class_dict[(scan_interval_in_seconds, priority)]
+
+        max_quantity = MAX_QUANTITY_OF_BITS if function_code in (1, 2) else MAX_QUANTITY_OF_REGISTERS
+        group.sort(key=lambda x: (x.offset, x.number_of_registers))
+
+        block = None
+        ending_address_of_block = 0
+        for plan_point in group:
+            ending_address = plan_point.offset + max(plan_point.number_of_registers, 1)
+            if block is None \
+                    or max_gap < 0 \
+                    or plan_point.offset > ending_address_of_block + max_gap \
+                    or max(ending_address, ending_address_of_block) - block.starting_address > max_quantity:
+                if block is not None:
+                    block.quantity_of_x = ending_address_of_block - block.starting_address
+                block = ReadBlock(slave_id, function_code, plan_point.offset, 0)
+                scan_class.blocks.append(block)
+                ending_address_of_block = ending_address
+            else:
+                ending_address_of_block = max(ending_address, ending_address_of_block)
+            block.points.append(plan_point)
+        block.quantity_of_x = ending_address_of_block - block.starting_address
+
+    for scan_class in scan_class_dict.values():
+        for block in scan_class.blocks:
+            block.compile()
+
+    return sorted(scan_class_dict.values(), key=lambda x: (-x.priority, x.interval_in_seconds))
+
+
+########################################################################################################################
+# Deadline Scheduler
+########################################################################################################################
+
+
+def start_schedule(read_plan, now):
+    """
+    schedule the first reads, scan classes are phase shifted within the shortest scan interval
+    so that the slave is not hit by all scan classes at the same time
+    :param read_plan: list of ScanClass
+    :param now: current monotonic time in seconds
+    """
+    if len(read_plan) == 0:
+        return
+    shortest_interval_in_seconds = min(scan_class.interval_in_seconds for scan_class in read_plan)
+    for i, scan_class in enumerate(read_plan):
+        scan_class.next_due = now + shortest_interval_in_seconds * i / len(read_plan)
+
+
+def get_due_scan_classes(read_plan, now):
+    """return due scan classes in order of priority from high to low, and then from the most overdue"""
+    due_scan_class_list = [scan_class for scan_class in read_plan if scan_class.next_due <= now]
+    due_scan_class_list.sort(key=lambda x: (-x.priority, x.next_due))
+    return due_scan_class_list
+
+
+def reschedule(scan_class, now):
+    """schedule the next read of a scan class, missed reads are skipped instead of being read in a burst"""
+    scan_class.next_due += scan_class.interval_in_seconds
+    if scan_class.next_due <= now:
+        scan_class.next_due = now + scan_class.interval_in_seconds
+
+
+def get_next_due(read_plan):
+    """return the monotonic time of the next due scan class"""
+    return min(scan_class.next_due for scan_class in read_plan)
@@ -0,0 +1,121 @@
+import json
+import mysql.connector
+import config
+
+
+########################################################################################################################
+# Data Source Reloader
+# Data sources and points of this gateway are loaded with one grouped query. Every data source comes with a signature
+# of its points, so that the running set can be compared against the latest settings and only the data sources whose
+# connection or points changed are restarted or re-planned.
+########################################################################################################################
+
+
+def load_data_sources(logger):
+    """
+    load data sources of this gateway
+    :return: dict of data_source_id to dict with keys name, connection and points_signature, None if failed
+    """
+    cnx_system_db = None
+    cursor_system_db = None
+    try:
+        cnx_system_db = mysql.connector.connect(**config.myems_system_db)
+        cursor_system_db = cnx_system_db.cursor()
+        # the signature changes when any point used in acquisition is added, deleted or edited
+        query = (" SELECT ds.id, ds.name, ds.connection, COUNT(p.id), "
+                 "        BIT_XOR(CRC32(CONCAT_WS('|', p.id, p.object_type, p.is_trend, "
+                 "                                     p.ratio, p.offset_constant, p.address))) "
+                 " FROM tbl_data_sources ds "
+                 "      INNER JOIN tbl_gateways g ON ds.gateway_id = g.id "
+                 "      LEFT JOIN tbl_points p ON p.data_source_id = ds.id AND p.is_virtual = 0 "
+                 " WHERE ds.protocol = 'modbus-tcp' AND g.id = %s AND g.token = %s "
+                 " GROUP BY ds.id, ds.name, ds.connection "
+                 " ORDER BY ds.id ")
+        cursor_system_db.execute(query, (config.gateway['id'], config.gateway['token'],))
+        rows_data_source = cursor_system_db.fetchall()
+    except Exception as e:
+        logger.error("Error in reloader " + str(e))
+        return None
+    finally:
+        if cursor_system_db:
+            cursor_system_db.close()
+        if cnx_system_db:
+            cnx_system_db.close()
+
+    data_source_dict = dict()
+    for row in rows_data_source:
+        data_source_dict[row[0]] = {'name': row[1],
+                                    'connection': row[2],
+                                    'points_signature': (row[3], row[4])}
+    return data_source_dict
+
+
+def parse_connection(logger, data_source_id, connection):
+    """
+    parse and validate connection of data source
+    :return: tuple of (host, port, interval_in_seconds, pipeline_window), None if the connection is invalid
+    """
+    if connection is None or len(connection) == 0:
+        logger.error("Data Source(ID=%s) Connection Not Found.", data_source_id)
+        return None
+
+    try:
+        server = json.loads(connection)
+    except Exception as e:
+        logger.error("Data Source(ID=%s) Connection JSON error " + str(e), data_source_id)
+        return None
+
+    if not isinstance(server, dict) \
+            or 'host' not in server.keys() \
+            or 'port' not in server.keys() \
+            or server['host'] is None \
+            or server['port'] is None \
+            or len(server['host']) == 0 \
+            or not isinstance(server['port'], int) \
+            or server['port'] < 1 \
+            or server['port'] > 65535:
+        logger.error("Data Source(ID=%s) Connection Invalid.", data_source_id)
+        return None
+    if 'interval_in_seconds' not in server.keys() \
+        or (not isinstance(server['interval_in_seconds'], int)
+            and not isinstance(server['interval_in_seconds'], float)) \
+        or server['interval_in_seconds'] < 0 \
+            or server['interval_in_seconds'] > 3600:
+        interval_in_seconds = config.interval_in_seconds
+    else:
+        interval_in_seconds = server['interval_in_seconds']
+    # the maximum number of outstanding requests to the device, 1 for devices that cannot handle pipelined requests
+    if 'pipeline_window' not in server.keys() \
+            or not isinstance(server['pipeline_window'], int) \
+            or server['pipeline_window'] < 1 \
+            or server['pipeline_window'] > 64:
+        pipeline_window = config.pipeline_window
+    else:
+        pipeline_window = server['pipeline_window']
+
+    return server['host'], server['port'], interval_in_seconds, pipeline_window
+
+
+def diff(running_dict, latest_dict):
+    """
+    compare running data sources against the latest data sources
+    :param running_dict: dict of data_source_id to dict with keys connection and points_signature
+    :param latest_dict: dict returned by load_data_sources
+    :return: tuple of id lists (to_stop, to_start, to_replan),
+             a data source whose connection changed is in both to_stop and to_start
+    """
+    to_stop = list()
+    to_start = list()
+    to_replan = list()
+    for data_source_id, running in running_dict.items():
+        if data_source_id not in latest_dict:
+            to_stop.append(data_source_id)
+        elif running['connection'] != latest_dict[data_source_id]['connection']:
+            to_stop.append(data_source_id)
+            to_start.append(data_source_id)
+        elif running['points_signature'] != latest_dict[data_source_id]['points_signature']:
+            to_replan.append(data_source_id)
+    for data_source_id in latest_dict.keys():
+        if data_source_id not in running_dict:
+            to_start.append(data_source_id)
+    return to_stop, sorted(to_start), to_replan
@@ -0,0 +1,169 @@
+import argparse
+import asyncio
+import json
+import random
+import struct
+
+
+########################################################################################################################
+# Modbus TCP Device Simulator
+# Serves register maps of N simulated devices on consecutive ports of localhost, every device answers for slaves
+# 1 to SLAVES. Latency, timeouts and garbage values can be injected to benchmark the acquisition engine without PLCs.
+# Usage: python3 simulator.py --port 5020 --devices 10 --latency 0.01 --timeout-rate 0.001 --garbage-rate 0.001
+########################################################################################################################
+
+# Exception codes
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+
+
+class Device:
+    """register map of a simulated device, which is shared by all slaves of the device"""
+
+    def __init__(self, number_of_registers, register_map=None):
+        """
+        :param number_of_registers: number of registers and bits of each table
+        :param register_map: optional dict with keys coils, discrete_inputs, holding_registers and input_registers,
+                             each is a list of initial values from address 0, the rest values are generated
+        """
+        register_map = register_map or dict()
+        self.number_of_registers = number_of_registers
+        # function code to table
+        self.tables = {1: self._load(register_map.get('coils'), lambda x: x % 2),
+                       2: self._load(register_map.get('discrete_inputs'), lambda x: (x // 2) % 2),
+                       3: self._load(register_map.get('holding_registers'), lambda x: x % 65536),
+                       4: self._load(register_map.get('input_registers'), lambda x: (x * 7) % 65536)}
+
+    def _load(self, values, generate):
+        values = list(values or list())[:self.number_of_registers]
+        return values + [generate(address) for address in range(len(values), self.number_of_registers)]
+
+    def read(self, function_code, starting_address, quantity_of_x, garbage_rate):
+        """return the response pdu of a read request"""
+        if function_code not in self.tables:
+            return struct.pack('>BB', function_code | 0x80, ILLEGAL_FUNCTION)
+        max_quantity = 2000 if function_code in (1, 2) else 125
+        if quantity_of_x < 1 or quantity_of_x > max_quantity:
+            return struct.pack('>BB', function_code | 0x80, ILLEGAL_DATA_VALUE)
+        if starting_address + quantity_of_x > self.number_of_registers:
+            return struct.pack('>BB', function_code | 0x80, ILLEGAL_DATA_ADDRESS)
+
+        values = self.tables[function_code][starting_address:starting_address + quantity_of_x]
+        if garbage_rate > 0 and random.random() < garbage_rate:
+            values = [random.getrandbits(1 if function_code in (1, 2) else 16) for _ in values]
+
+        if function_code in (1, 2):
+            data = bytearray((quantity_of_x + 7) // 8)
+            for i, value in enumerate(values):
+                if value:
+                    data[i // 8] |= 1 << (i % 8)
+            return struct.pack('>BB', function_code, len(data)) + bytes(data)
+        return struct.pack('>BB', function_code, quantity_of_x * 2) + struct.pack('>%dH' % quantity_of_x, *values)
+
+    def tick(self):
+        """let the values of holding registers and input registers drift slowly"""
+        for function_code in (3, 4):
+            table = self.tables[function_code]
+            for _ in range(max(len(table) // 100, 1)):
+                address = random.randrange(len(table))
+                table[address] = (table[address] + random.choice((-1, 1))) % 65536
+
+
+async def respond(device, slaves, writer, transaction_id, unit_id, request_pdu, args):
+    """answer one request after the injected latency"""
+    if args.latency > 0 or args.jitter > 0:
+        await asyncio.sleep(args.latency + random.uniform(0, args.jitter))
+    if args.timeout_rate > 0 and random.random() < args.timeout_rate:
+        # drop the request as if it was lost
+        return
+    if unit_id not in slaves:
+        # gateway target device failed to respond
+        response_pdu = struct.pack('>BB', request_pdu[0] | 0x80, 0x0B)
+    elif len(request_pdu) != 5:
+        response_pdu = struct.pack('>BB', request_pdu[0] | 0x80, ILLEGAL_FUNCTION)
+    else:
+        function_code, starting_address, quantity_of_x = struct.unpack('>BHH', request_pdu)
+        response_pdu = device.read(function_code, starting_address, quantity_of_x, args.garbage_rate)
+    writer.write(struct.pack('>HHHB', transaction_id, 0, len(response_pdu) + 1, unit_id) + response_pdu)
+    await writer.drain()
+
+
+async def serve(device, slaves, reader, writer, args):
+    """
+    serve one connection, requests are answered one by one in the order received by default,
+    concurrently with --concurrent, or requests received while another request is outstanding are dropped
+    with --drop-pipelined to simulate devices that cannot handle pipelined requests
+    """
+    task_set = set()
+    try:
+        while True:
+            header = await reader.readexactly(7)
+            transaction_id, protocol_id, length, unit_id = struct.unpack('>HHHB', header)
+            request_pdu = await reader.readexactly(length - 1)
+            task_set = set(task for task in task_set if not task.done())
+            if args.drop_pipelined and len(task_set) > 0:
+                continue
+            task = asyncio.ensure_future(respond(device, slaves, writer, transaction_id, unit_id, request_pdu, args))
+            task_set.add(task)
+            if not args.concurrent and not args.drop_pipelined:
+                await task
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        for task in task_set:
+            task.cancel()
+        writer.close()
+
+
+async def run(args):
+    register_map = None
+    if args.register_map is not None:
+        with open(args.register_map) as f:
+            register_map = json.load(f)
+
+    slaves = set(range(1, args.slaves + 1))
+    device_list = list()
+    server_list = list()
+    for i in range(args.devices):
+        device = Device(args.registers, register_map)
+        device_list.append(device)
+
+        async def handle(reader, writer, device=device):
+            await serve(device, slaves, reader, writer, args)
+
+        server_list.append(await asyncio.start_server(handle, args.host, args.port + i))
+    print("Simulating %d devices with %d slaves on %s:%d-%d" %
+          (args.devices, args.slaves, args.host, args.port, args.port + args.devices - 1))
+
+    while True:
+        await asyncio.sleep(1)
+        for device in device_list:
+            device.tick()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Modbus TCP device simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5020, help='port of the first device')
+    parser.add_argument('--devices', type=int, default=1, help='number of devices on consecutive ports')
+    parser.add_argument('--slaves', type=int, default=1, help='number of slaves of each device')
+    parser.add_argument('--registers', type=int, default=10000, help='number of registers and bits of each table')
+    parser.add_argument('--register-map', help='JSON file of initial values, for example '
+                                               '{"holding_registers": [1, 2, 3], "coils": [1, 0, 1]}')
+    parser.add_argument('--latency', type=float, default=0.0, help='latency of each response in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency in seconds')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='probability of dropping a request')
+    parser.add_argument('--garbage-rate', type=float, default=0.0, help='probability of random values in a response')
+    parser.add_argument('--concurrent', action='store_true', help='answer pipelined requests concurrently')
+    parser.add_argument('--drop-pipelined', action='store_true',
+                        help='drop requests received while another request is outstanding')
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
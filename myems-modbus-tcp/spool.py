@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+import mysql.connector
+import config
+import metrics
+from historical_writer import write_cycles, is_transient_error
+
+
+########################################################################################################################
+# Spool
+# Acquisition cycles that cannot be written to historical database are appended to a local spool, which is a directory
+# of segment files in line-delimited JSON. A replayer thread drains closed segments into historical database with the
+# original timestamps, one transaction per segment, so polling is never blocked by replay.
+# Line format: ["2025-01-01T00:00:00", [[point_id, is_trend, value], ...], [...], [...]]
+# where the value lists are indexed by ANALOG_VALUE, ENERGY_VALUE and DIGITAL_VALUE.
+# A segment rejected by historical database for its values is retried up to SPOOL_MAX_REPLAY_ATTEMPTS times, then it is
+# renamed to a failed segment, such as 00000000000000000001.spool.failed, and later segments are drained.
+# Replay stops at transient errors of the connection and is retried at the next interval.
+########################################################################################################################
+
+
+class Spool:
+
+    def __init__(self, logger, name):
+        """
+        :param logger: logger
+        :param name: name of the spool directory under SPOOL_DIRECTORY, one spool for each writer
+        """
+        self.logger = logger
+        self.directory = os.path.join(config.spool_directory, name)
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_size = 0
+        # dict of the numbers of failed replay attempts by segment
+        self._attempt_dict = dict()
+        segment_list = self._list_segments('.spool') + self._list_segments('.spool.failed')
+        self._sequence = max(int(segment.split('.')[0]) for segment in segment_list) if len(segment_list) > 0 else 0
+
+    def _list_segments(self, suffix='.spool'):
+        return sorted(file_name for file_name in os.listdir(self.directory) if file_name.endswith(suffix))
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._file_size = 0
+
+    def append(self, cycle_list):
+        """
+        append acquisition cycles to the spool
+        :param cycle_list: list of tuples (current_datetime_utc, value_lists)
+        """
+        lines = list()
+        for current_datetime_utc, value_lists in cycle_list:
+            lines.append(json.dumps([current_datetime_utc.isoformat()] +
+                                    [[[point_value['point_id'], point_value['is_trend'], point_value['value']]
+                                      for point_value in value_list]
+                                     for value_list in value_lists],
+                                    separators=(',', ':')) + '\n')
+        data = ''.join(lines).encode('utf-8')
+
+        with self._lock:
+            try:
+                if self._file is None or self._file_size + len(data) > config.spool_segment_size_in_bytes:
+                    self._close_segment()
+                    self._drop_oldest_segments()
+                    self._sequence += 1
+                    self._file = open(os.path.join(self.directory, '%020d.spool' % self._sequence), 'ab')
+                self._file.write(data)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file_size += len(data)
+                metrics.inc('myems_modbus_tcp_spooled_cycles_total', (), len(cycle_list))
+            except Exception as e:
+                self.logger.error("Error in spool " + self.directory + " " + str(e))
+                self._close_segment()
+
+    def _drop_oldest_segments(self):
+        """keep the total size under SPOOL_MAX_SIZE_IN_BYTES by dropping the oldest segments, failed ones included"""
+        segment_list = sorted(self._list_segments('.spool') + self._list_segments('.spool.failed'))
+        total_size = sum(os.path.getsize(os.path.join(self.directory, segment)) for segment in segment_list)
+        while len(segment_list) > 0 and total_size + config.spool_segment_size_in_bytes > config.spool_max_size_in_bytes:
+            segment = segment_list.pop(0)
+            total_size -= os.path.getsize(os.path.join(self.directory, segment))
+            os.remove(os.path.join(self.directory, segment))
+            self.logger.error("Spool " + self.directory + " is full, segment " + segment + " is dropped")
+
+    def has_pending(self):
+        with self._lock:
+            return self._file is not None or len(self._list_segments()) > 0
+
+    def replay(self):
+        """drain pending segments into historical database, return True if all segments are drained"""
+        with self._lock:
+            # close the current segment so that new cycles are appended to a new segment
+            self._close_segment()
+            segment_list = self._list_segments()
+        if len(segment_list) == 0:
+            return True
+
+        cnx_historical_db = None
+        cursor_historical_db = None
+        try:
+            cnx_historical_db = mysql.connector.connect(**config.myems_historical_db)
+            cursor_historical_db = cnx_historical_db.cursor()
+            for segment in segment_list:
+                cycle_list = read_segment(self.logger, os.path.join(self.directory, segment))
+                try:
+                    # latest values are not updated with spooled values because newer values may have been written
+                    write_cycles(cnx_historical_db, cursor_historical_db, cycle_list, update_latest=False)
+                except Exception as e:
+                    try:
+                        cnx_historical_db.rollback()
+                    except Exception as rollback_error:
+                        self.logger.error("Error in rolling back replay of spool " + self.directory + " " +
+                                          str(rollback_error))
+                    if is_transient_error(cnx_historical_db, e):
+                        self.logger.error("Error in replaying spool " + self.directory + " " + str(e))
+                        return False
+                    self._reject_segment(segment, e)
+                    continue
+                self._attempt_dict.pop(segment, None)
+                os.remove(os.path.join(self.directory, segment))
+        except Exception as e:
+            self.logger.error("Error in replaying spool " + self.directory + " " + str(e))
+            return False
+        finally:
+            if cursor_historical_db:
+                cursor_historical_db.close()
+            if cnx_historical_db:
+                cnx_historical_db.close()
+
+        return len(self._list_segments()) == 0
+
+    def _reject_segment(self, segment, e):
+        """count a failed attempt of a segment rejected for its values, move it aside after the maximum attempts"""
+        attempts = self._attempt_dict.get(segment, 0) + 1
+        if attempts < config.spool_max_replay_attempts:
+            self._attempt_dict[segment] = attempts
+            self.logger.error("Error in replaying segment " + segment + " of spool " + self.directory +
+                              " attempt " + str(attempts) + " " + str(e))
+            return
+        self._attempt_dict.pop(segment, None)
+        os.replace(os.path.join(self.directory, segment), os.path.join(self.directory, segment + '.failed'))
+        metrics.inc('myems_modbus_tcp_failed_segments_total', (), 1)
+        self.logger.error("Segment " + segment + " of spool " + self.directory + " is rejected after " +
+                          str(attempts) + " attempts and moved to " + segment + ".failed " + str(e))
+
+    def start_replayer(self):
+        """start a daemon thread to replay pending segments periodically"""
+        threading.Thread(target=self._replay_forever, daemon=True).start()
+
+    def _replay_forever(self):
+        while True:
+            time.sleep(config.spool_replay_interval_in_seconds)
+            if self.has_pending():
+                self.replay()
+
+
+def read_segment(logger, path):
+    """read acquisition cycles from a segment file, an incomplete line written before a crash is skipped"""
+    cycle_list = list()
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+                cycle_list.append((datetime.fromisoformat(row[0]),
+                                   [[{'point_id': point_value[0], 'is_trend': point_value[1], 'value': point_value[2]}
+                                     for point_value in value_list]
+                                    for value_list in row[1:]]))
+            except Exception as e:
+                logger.error("Error in reading spool segment " + path + " " + str(e))
+    return cycle_list
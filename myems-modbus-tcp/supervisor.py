@@ -0,0 +1,110 @@
+import signal
+import time
+from datetime import datetime
+from multiprocessing import Process
+import mysql.connector
+import config
+
+
+########################################################################################################################
+# Supervisor
+# Worker processes which terminated unexpectedly are restarted with exponential backoff, so that a worker which keeps
+# failing is retried less and less often without stalling the other workers of this gateway.
+# The restart count and the last exit reason of the affected data sources are recorded in tbl_data_sources.
+########################################################################################################################
+
+
+def new_worker(name, target, args):
+    """return a worker to be started and supervised"""
+    return {'name': name,
+            'target': target,
+            'args': args,
+            'process': None,
+            'started_at': None,
+            'number_of_failures': 0,
+            'restart_at': None}
+
+
+def start(worker):
+    """start the process of a worker"""
+    worker['process'] = Process(target=worker['target'], args=worker['args'])
+    worker['process'].start()
+    worker['started_at'] = time.monotonic()
+    worker['restart_at'] = None
+
+
+def stop(worker):
+    """terminate the process of a worker, it will not be restarted"""
+    if worker['process'] is not None:
+        worker['process'].terminate()
+        worker['process'].join()
+        worker['process'] = None
+    worker['restart_at'] = None
+
+
+def check(logger, worker, data_source_id_list=None):
+    """
+    schedule a restart of the worker if its process terminated, and restart it when the backoff elapsed,
+    never blocks, so that one failing worker does not delay the others
+    :param data_source_id_list: data sources acquired by the worker, or None to match data sources by process id
+    """
+    now = time.monotonic()
+    process = worker['process']
+    if process is not None and not process.is_alive():
+        process.join()
+        exit_reason = get_exit_reason(process.exitcode)
+        # a worker which ran stably for a while starts over from the shortest backoff
+        if now - worker['started_at'] > config.restart_backoff_max_in_seconds:
+            worker['number_of_failures'] = 0
+        worker['number_of_failures'] += 1
+        backoff_in_seconds = get_backoff_in_seconds(worker['number_of_failures'])
+        logger.error("Worker %s %s, restart in %s seconds", worker['name'], exit_reason, backoff_in_seconds)
+        record_exit(logger, exit_reason, data_source_id_list, process.pid)
+        worker['process'] = None
+        worker['restart_at'] = now + backoff_in_seconds
+
+    if worker['process'] is None and worker['restart_at'] is not None and now >= worker['restart_at']:
+        start(worker)
+
+
+def get_backoff_in_seconds(number_of_failures):
+    """return the delay before restarting a worker which failed number_of_failures times in a row"""
+    return min(config.restart_backoff_initial_in_seconds * 2 ** max(number_of_failures - 1, 0),
+               config.restart_backoff_max_in_seconds)
+
+
+def get_exit_reason(exitcode):
+    """return the exit reason of a terminated process by its exit code"""
+    if exitcode < 0:
+        try:
+            return "killed by signal " + signal.Signals(-exitcode).name
+        except ValueError:
+            return "killed by signal " + str(-exitcode)
+    return "exited with code " + str(exitcode)
+
+
+def record_exit(logger, exit_reason, data_source_id_list=None, process_id=None):
+    """increase restart count and record the last exit reason of data sources"""
+    if data_source_id_list is not None and len(data_source_id_list) == 0:
+        return
+    cnx_system_db = None
+    cursor_system_db = None
+    try:
+        cnx_system_db = mysql.connector.connect(**config.myems_system_db)
+        cursor_system_db = cnx_system_db.cursor()
+        update_row = (" UPDATE tbl_data_sources "
+                      " SET restart_count = restart_count + 1, last_exit_reason = %s, last_exit_datetime_utc = %s ")
+        if data_source_id_list is not None:
+            update_row += " WHERE id IN (" + ", ".join(["%s"] * len(data_source_id_list)) + ") "
+            cursor_system_db.execute(update_row, (exit_reason[:255], datetime.utcnow(), *data_source_id_list))
+        else:
+            update_row += " WHERE protocol = 'modbus-tcp' AND process_id = %s "
+            cursor_system_db.execute(update_row, (exit_reason[:255], datetime.utcnow(), process_id))
+        cnx_system_db.commit()
+    except Exception as e:
+        logger.error("Error in recording exit of worker " + str(e))
+    finally:
+        if cursor_system_db:
+            cursor_system_db.close()
+        if cnx_system_db:
+            cnx_system_db.close()
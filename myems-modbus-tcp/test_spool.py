@@ -0,0 +1,141 @@
+import contextlib
+import logging
+import tempfile
+from datetime import datetime, timedelta
+from mysql.connector import errors
+import config
+import spool
+
+
+########################################################################################################################
+# Test of spool replay with a segment rejected by historical database for its values followed by good segments
+# Historical database is replaced by a fake connection which rejects out of range values as MySQL does in strict mode
+########################################################################################################################
+
+# values beyond the range of the column are rejected
+MAX_VALUE = 1e20
+
+
+class FakeCursor:
+
+    def __init__(self, cnx):
+        self.cnx = cnx
+
+    def execute(self, statement, parameters):
+        if self.cnx.is_lost:
+            raise errors.OperationalError(msg="Lost connection to MySQL server during query", errno=2013)
+        for parameter in parameters:
+            if isinstance(parameter, float) and abs(parameter) > MAX_VALUE:
+                raise errors.DataError(msg="Out of range value for column 'actual_value'", errno=1264)
+        self.cnx.pending_list.append(parameters)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self, is_lost=False):
+        self.is_lost = is_lost
+        self.pending_list = list()
+        self.committed_list = list()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed_list.extend(self.pending_list)
+        self.pending_list = list()
+
+    def rollback(self):
+        self.pending_list = list()
+
+    def is_connected(self):
+        return not self.is_lost
+
+    def close(self):
+        pass
+
+
+def append_segment(s, minute, value):
+    """append a cycle of one analog value and close the segment"""
+    s.append([(datetime(2025, 1, 1) + timedelta(minutes=minute),
+               [[{'point_id': 1, 'is_trend': True, 'value': value}], [], []])])
+    with s._lock:
+        s._close_segment()
+
+
+@contextlib.contextmanager
+def fake_historical_db(cnx, spool_max_replay_attempts):
+    """
+    replace historical database with the fake connection and the spool directory with a temporary directory,
+    and restore them on exit, so that other tests are not affected
+    """
+    saved = (config.spool_directory, config.spool_max_replay_attempts, spool.mysql.connector.connect)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            config.spool_directory = directory
+            config.spool_max_replay_attempts = spool_max_replay_attempts
+            spool.mysql.connector.connect = lambda **kwargs: cnx
+            yield
+    finally:
+        config.spool_directory, config.spool_max_replay_attempts, spool.mysql.connector.connect = saved
+
+
+def test_replay_moves_rejected_segment_aside():
+    cnx = FakeConnection()
+    with fake_historical_db(cnx, 3):
+        s = spool.Spool(logging.getLogger('test_spool'), 'test')
+        append_segment(s, 0, 1e30)
+        append_segment(s, 1, 1.0)
+        append_segment(s, 2, 2.0)
+
+        # the rejected segment is retried while later segments are drained
+        assert s.replay() is False
+        assert [parameters[2] for parameters in cnx.committed_list] == [1.0, 2.0]
+        assert s._list_segments() == ['%020d.spool' % 1]
+        assert s.replay() is False
+        assert s._list_segments() == ['%020d.spool' % 1]
+
+        # the rejected segment is moved aside after the maximum attempts
+        assert s.replay() is True
+        assert s._list_segments() == []
+        assert s._list_segments('.failed') == ['%020d.spool.failed' % 1]
+        assert len(cnx.committed_list) == 2
+
+        # new segments are numbered after the failed segment
+        s = spool.Spool(logging.getLogger('test_spool'), 'test')
+        append_segment(s, 3, 3.0)
+        assert s._list_segments() == ['%020d.spool' % 2]
+
+
+def test_replay_stops_at_connection_error():
+    cnx = FakeConnection(is_lost=True)
+    with fake_historical_db(cnx, 1):
+        s = spool.Spool(logging.getLogger('test_spool'), 'test')
+        append_segment(s, 0, 1.0)
+        append_segment(s, 1, 2.0)
+
+        # segments are kept and not counted as rejected when the connection is lost
+        assert s.replay() is False
+        assert s.replay() is False
+        assert s._list_segments() == ['%020d.spool' % 1, '%020d.spool' % 2]
+        assert s._list_segments('.failed') == []
+
+        cnx.is_lost = False
+        assert s.replay() is True
+        assert [parameters[2] for parameters in cnx.committed_list] == [1.0, 2.0]
+
+
+########################################################################################################################
+# main procedure
+########################################################################################################################
+def main():
+    test_replay_moves_rejected_segment_aside()
+    print("Succeeded to move rejected segment aside and drain later segments")
+    test_replay_stops_at_connection_error()
+    print("Succeeded to keep segments at connection error")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+import argparse
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+import numpy as np
+from sympy import sympify, Piecewise, symbols
+import config
+from equation import compile_equation, compile_expression
+from meter import normalize
+
+
+########################################################################################################################
+# Normalization Benchmark
+# Normalize generated energy values of one meter, the bucketing with list.pop(0) and list.insert(0, ...) against the
+# forward pass of meter.normalize, and check that both get the same hourly values.
+#         python3 benchmark.py meter --days 365 --interval 60 --legacy-days 30
+# The bucketing is quadratic in the number of energy values, so it is measured over --legacy-days only by default.
+#
+# Evaluate the equations of virtual meters on generated hourly values, sympify and evalf of every time slot against
+# the compiled equations of equation.py, and check that both get the same values.
+#         python3 benchmark.py equation --hours 8760 --sympy-hours 720
+#
+# Evaluate the expressions of virtual points on generated minutely values, Piecewise and subs of SymPy for every
+# timestamp against the compiled expressions of equation.py, and check that both get the same values.
+#         python3 benchmark.py expression --minutes 43200 --sympy-minutes 1440
+########################################################################################################################
+
+# the regression suite of equations of virtual meters, equations beyond the grammar are evaluated with SymPy
+EQUATION_LIST = ('x1+x2+x3',
+                 'x1-x2',
+                 'x1-x2-x3',
+                 'x1+x2-x3',
+                 'x1*0.5+x2*0.5',
+                 '(x1+x2)/2',
+                 'x1*1.2-x2/3',
+                 '-x1+2*x2',
+                 '0.3*x1+0.7*(x2-x3)',
+                 'x1/(x2+1)',
+                 'x1^2/1000',
+                 'x1**0.5',
+                 'x1%100',
+                 'x1//10',
+                 'abs(x1-x2)',
+                 'sqrt(x1*x2)',
+                 'exp(x1/10000)',
+                 'log(x1+1)',
+                 'floor(x1)+ceiling(x2)',
+                 'pi*x1',
+                 '100',
+                 'max(x1, x2)',
+                 'min(x1, x2)')
+
+# the regression suite of piecewise functions of virtual points, with the symbols of SymPy to evaluate them
+EXPRESSION_LIST = ('(1, x1 < 200), (2, x1 >= 500), (0, True)',
+                   '(x1 - x2, x1 > x2), (0, True)',
+                   '(x1, (x1 > 100) & (x2 < 300)), (x2, (x1 <= 100) | (x2 > 900)), (-1, True)',
+                   '(x1 * 0.5, x1 < 2 * x2), (x2 ^ 2 / 1000, True)',
+                   '(1, ~(x1 > 500)), (0, True)')
+
+# the relative tolerance of values evaluated in float64 against the 15 significant digits of evalf
+RELATIVE_TOLERANCE = 1e-12
+
+
+def generate(start_datetime_utc, days, interval_in_seconds):
+    """generate increasing energy values with random increments, and a gap of one hour in every day"""
+    rows_energy_values = list()
+    actual_value = Decimal('1000.000000')
+    number_of_values = int(days * 86400 / interval_in_seconds)
+    for i in range(number_of_values):
+        utc_date_time = start_datetime_utc + timedelta(seconds=i * interval_in_seconds)
+        actual_value += Decimal(random.randint(0, 1000)) / Decimal(1000)
+        if utc_date_time.hour == 3:
+            continue
+        rows_energy_values.append((utc_date_time.replace(tzinfo=None), actual_value))
+    return rows_energy_values
+
+
+def legacy(meter, rows_energy_values, energy_value_just_before_start, start_datetime_utc, end_datetime_utc):
+    """bucket energy values into time slots as meter.worker did before the forward pass"""
+    # the bucketing consumes the list
+    rows_energy_values = list(rows_energy_values)
+    normalized_values = list()
+    maximum = Decimal(0.0)
+    if len(energy_value_just_before_start) > 0 and energy_value_just_before_start['actual_value'] > Decimal(0.0):
+        maximum = energy_value_just_before_start['actual_value']
+
+    current_datetime_utc = start_datetime_utc
+    while current_datetime_utc < end_datetime_utc:
+        initial_maximum = maximum
+        current_energy_values = list()
+        while len(rows_energy_values) > 0:
+            row_energy_value = rows_energy_values.pop(0)
+            energy_value_datetime = row_energy_value[0].replace(tzinfo=timezone.utc)
+            if energy_value_datetime < current_datetime_utc + timedelta(minutes=config.minutes_to_count):
+                current_energy_values.append(row_energy_value)
+            else:
+                rows_energy_values.insert(0, row_energy_value)
+                break
+
+        increment = Decimal(0.0)
+        for index in range(len(current_energy_values)):
+            current_energy_value = current_energy_values[index]
+            if maximum < current_energy_value[1]:
+                increment += current_energy_value[1] - maximum
+            maximum = current_energy_value[1]
+
+        if initial_maximum <= Decimal(0.1):
+            increment = Decimal(0.0)
+        if increment < meter['hourly_low_limit']:
+            increment = Decimal(0.0)
+        if increment > meter['hourly_high_limit']:
+            increment = Decimal(0.0)
+
+        normalized_values.append({'start_datetime_utc': current_datetime_utc,
+                                  'actual_value': increment})
+        current_datetime_utc += timedelta(minutes=config.minutes_to_count)
+    return normalized_values
+
+
+def measure(function, meter, rows_energy_values, start_datetime_utc, days):
+    """return the normalized values and the elapsed seconds of normalizing the values in the first days"""
+    end_datetime_utc = start_datetime_utc + timedelta(days=days)
+    rows = [row for row in rows_energy_values if row[0].replace(tzinfo=timezone.utc) < end_datetime_utc]
+    energy_value_just_before_start = {'utc_date_time': start_datetime_utc.replace(tzinfo=None),
+                                      'actual_value': Decimal('1000.000000')}
+    start = time.perf_counter()
+    normalized_values = function(meter, rows, energy_value_just_before_start, start_datetime_utc, end_datetime_utc)
+    return normalized_values, time.perf_counter() - start, len(rows)
+
+
+def meter(args):
+    """compare the bucketing with the forward pass of meter.normalize"""
+    random.seed(0)
+    meter = {'hourly_low_limit': Decimal(0), 'hourly_high_limit': Decimal(1000000)}
+    start_datetime_utc = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    rows_energy_values = generate(start_datetime_utc, max(args.days, args.legacy_days), args.interval)
+
+    legacy_values, legacy_seconds, legacy_count = measure(legacy, meter, rows_energy_values,
+                                                          start_datetime_utc, args.legacy_days)
+    forward_values, forward_seconds, forward_count = measure(normalize, meter, rows_energy_values,
+                                                             start_datetime_utc, args.days)
+    print("%-14s %8d values %10.3f s %12.0f values/s" %
+          ('bucketing:', legacy_count, legacy_seconds, legacy_count / legacy_seconds))
+    print("%-14s %8d values %10.3f s %12.0f values/s" %
+          ('forward pass:', forward_count, forward_seconds, forward_count / forward_seconds))
+    number_of_slots = min(len(legacy_values), len(forward_values))
+    print("Same values of %d time slots: %s" %
+          (number_of_slots, legacy_values[:number_of_slots] == forward_values[:number_of_slots]))
+
+
+def equation(args):
+    """compare sympify and evalf of every time slot with the compiled equations, on the regression suite"""
+    random.seed(0)
+    value_dict = dict()
+    for variable_name in ('x1', 'x2', 'x3'):
+        value_dict[variable_name] = [Decimal(random.randint(0, 100000000)) / Decimal(1000) for _ in range(args.hours)]
+    array_dict = {variable_name: np.array([float(value) for value in value_list], dtype=np.float64)
+                  for variable_name, value_list in value_dict.items()}
+    sympy_hours = min(args.sympy_hours, args.hours)
+
+    is_matched = True
+    for equation_string in EQUATION_LIST:
+        expr = sympify(equation_string)
+        start = time.perf_counter()
+        try:
+            # energy values are Decimal as they are fetched from the energy database
+            sympy_list = [float(expr.evalf(subs={variable_name: value_list[i]
+                                                 for variable_name, value_list in value_dict.items()}))
+                          for i in range(sympy_hours)]
+        except Exception as e:
+            print("%-24s failed with SymPy: %s" % (equation_string, type(e).__name__ + ' ' + str(e)))
+            continue
+        sympy_seconds = (time.perf_counter() - start) / sympy_hours
+
+        compiled_equation = compile_equation(equation_string)
+        if compiled_equation is None:
+            print("%-24s %10.1f us/slot with SymPy, not compiled" % (equation_string, sympy_seconds * 1e6))
+            continue
+        start = time.perf_counter()
+        result = compiled_equation.evaluate(array_dict, args.hours)
+        compiled_seconds = (time.perf_counter() - start) / args.hours
+
+        matched = bool(np.allclose(result[:sympy_hours], sympy_list, rtol=RELATIVE_TOLERANCE, atol=0))
+        is_matched = is_matched and matched
+        print("%-24s %10.1f us/slot with SymPy, %8.3f us/slot compiled, %7.0f times faster, matched: %s" %
+              (equation_string, sympy_seconds * 1e6, compiled_seconds * 1e6, sympy_seconds / compiled_seconds,
+               matched))
+    print("All compiled equations matched SymPy: %s" % is_matched)
+
+
+def expression(args):
+    """compare Piecewise and subs of every timestamp with the compiled expressions, on the regression suite"""
+    random.seed(0)
+    value_dict = dict()
+    for variable_name in ('x1', 'x2'):
+        value_dict[variable_name] = [Decimal(random.randint(0, 1000000)) / Decimal(1000) for _ in range(args.minutes)]
+    array_dict = {variable_name: np.array([float(value) for value in value_list], dtype=np.float64)
+                  for variable_name, value_list in value_dict.items()}
+    sympy_minutes = min(args.sympy_minutes, args.minutes)
+    x1, x2 = symbols('x1 x2')
+
+    is_matched = True
+    for expression_string in EXPRESSION_LIST:
+        # virtualpoint.worker evaluated piecewise functions with eval before the compiled expressions
+        formula = Piecewise(*eval(expression_string.replace('^', '**'), {'x1': x1, 'x2': x2}))
+        start = time.perf_counter()
+        sympy_list = [float(formula.subs({variable_name: value_list[i]
+                                          for variable_name, value_list in value_dict.items()}))
+                      for i in range(sympy_minutes)]
+        sympy_seconds = (time.perf_counter() - start) / sympy_minutes
+
+        compiled_expression = compile_expression(expression_string)
+        start = time.perf_counter()
+        result = compiled_expression.evaluate(array_dict, args.minutes)
+        compiled_seconds = (time.perf_counter() - start) / args.minutes
+
+        matched = bool(np.allclose(result[:sympy_minutes], sympy_list, rtol=RELATIVE_TOLERANCE, atol=0))
+        is_matched = is_matched and matched
+        print("%-72s %8.1f us/value with SymPy, %6.3f us/value compiled, %7.0f times faster, matched: %s" %
+              (expression_string, sympy_seconds * 1e6, compiled_seconds * 1e6, sympy_seconds / compiled_seconds,
+               matched))
+    print("All compiled expressions matched SymPy: %s" % is_matched)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of normalization')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_meter = subparsers.add_parser('meter', help='normalize energy values of one meter')
+    parser_meter.add_argument('--days', type=float, default=365, help='days of energy values')
+    parser_meter.add_argument('--interval', type=float, default=60, help='interval in seconds of energy values')
+    parser_meter.add_argument('--legacy-days', type=float, default=30, help='days of energy values of the bucketing')
+    parser_equation = subparsers.add_parser('equation', help='evaluate equations of virtual meters')
+    parser_equation.add_argument('--hours', type=int, default=8760, help='number of hourly time slots')
+    parser_equation.add_argument('--sympy-hours', type=int, default=720,
+                                 help='number of hourly time slots evaluated with SymPy')
+    parser_expression = subparsers.add_parser('expression', help='evaluate piecewise functions of virtual points')
+    parser_expression.add_argument('--minutes', type=int, default=43200, help='number of minutely timestamps')
+    parser_expression.add_argument('--sympy-minutes', type=int, default=1440,
+                                   help='number of minutely timestamps evaluated with SymPy')
+    args = parser.parse_args()
+
+    if args.command == 'meter':
+        meter(args)
+    elif args.command == 'equation':
+        equation(args)
+    elif args.command == 'expression':
+        expression(args)
+
+
+if __name__ == '__main__':
+    main()
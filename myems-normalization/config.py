@@ -44,3 +44,16 @@ utc_offset = config('UTC_OFFSET', default='+08:00')
 # the pool size depends on the computing performance of the database server and the analysis server
 pool_size = config('POOL_SIZE', default=5, cast=int)
 
+# the number of connections kept to each database by every worker process, tasks borrow connections from them
+# NOTE: worker processes keep their connections across cycles, the max_connections of MySQL should allow for
+# POOL_SIZE * CONNECTION_POOL_SIZE connections to each database from every calculating process of the service
+connection_pool_size = config('CONNECTION_POOL_SIZE', default=1, cast=int)
+
+# indicates how to normalize energy values of meters,
+# 'meter' normalizes every meter with its own connections and queries,
+# 'batch' normalizes groups of METER_BATCH_SIZE meters with one range query per group and bulk inserts
+meter_normalization_mode = config('METER_NORMALIZATION_MODE', default='meter')
+
+# the number of meters in one group of batched normalization
+meter_batch_size = config('METER_BATCH_SIZE', default=100, cast=int)
+
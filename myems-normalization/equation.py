@@ -0,0 +1,202 @@
+import ast
+from functools import lru_cache, reduce
+import numpy as np
+
+
+########################################################################################################################
+# Compiled equations of virtual meters and compiled expressions of virtual points.
+# An equation is parsed once into a Python AST, checked against a restricted grammar, and compiled into a tree of
+# NumPy functions which is evaluated on whole arrays of operand values at once, instead of sympify and evalf for every
+# time slot. Nothing is evaluated by eval, only the nodes of the grammar are compiled:
+#   numbers, variables, pi, + - * / ** ^ % //, unary + -, abs, sqrt, exp, log, floor, ceiling, min, max
+# The expressions of virtual points also support conditions and conditional forms:
+#   < <= > >= == != (chained too), & | ~ and or not, True, False, value if condition else value,
+#   and piecewise functions as pairs of value and condition, the first pair with a true condition is taken:
+#   (1, x < 200), (2, x >= 500), (0, True)
+# Equations beyond the restricted grammar are not compiled.
+#
+# NOTE: '^' is power as it is in sympify, and values are evaluated in float64 instead of the 15 significant digits of
+# evalf.
+########################################################################################################################
+
+BINARY_OPERATORS = {ast.Add: np.add,
+                    ast.Sub: np.subtract,
+                    ast.Mult: np.multiply,
+                    ast.Div: np.true_divide,
+                    ast.Pow: np.power,
+                    ast.Mod: np.mod,
+                    ast.FloorDiv: np.floor_divide}
+
+UNARY_OPERATORS = {ast.UAdd: np.positive,
+                   ast.USub: np.negative}
+
+COMPARISON_OPERATORS = {ast.Lt: np.less,
+                        ast.LtE: np.less_equal,
+                        ast.Gt: np.greater,
+                        ast.GtE: np.greater_equal,
+                        ast.Eq: np.equal,
+                        ast.NotEq: np.not_equal}
+
+# functions of sympify by lower case name, and the number of arguments, or None for one or more arguments
+FUNCTIONS = {'abs': (np.abs, 1),
+             'sqrt': (np.sqrt, 1),
+             'exp': (np.exp, 1),
+             'log': (np.log, 1),
+             'floor': (np.floor, 1),
+             'ceiling': (np.ceil, 1),
+             'min': (np.minimum, None),
+             'max': (np.maximum, None)}
+
+CONSTANTS = {'pi': np.pi}
+
+# the kinds of compiled nodes
+NUMBER = 'number'
+BOOLEAN = 'boolean'
+
+
+class Equation:
+    """an equation compiled to be evaluated on arrays of values of its variables"""
+
+    def __init__(self, equation, function, variable_names):
+        self.equation = equation
+        self.function = function
+        self.variable_names = variable_names
+
+    def evaluate(self, value_dict, length):
+        """
+        evaluate the equation on arrays of values
+        :param value_dict: dict of arrays of values by variable name
+        :param length: the length of the arrays
+        :return: array of results, raise ValueError if a variable is not found or a result is not finite
+        """
+        for variable_name in self.variable_names:
+            if variable_name not in value_dict:
+                raise ValueError("variable " + variable_name + " of equation " + self.equation + " is not found")
+        with np.errstate(all='ignore'):
+            result = np.broadcast_to(np.asarray(self.function(value_dict), dtype=np.float64), (length,))
+        if not np.all(np.isfinite(result)):
+            raise ValueError("equation " + self.equation + " is not finite at time slot " +
+                             str(int(np.flatnonzero(~np.isfinite(result))[0])))
+        return result
+
+
+@lru_cache(maxsize=1024)
+def compile_equation(equation):
+    """return the compiled arithmetic equation of a virtual meter, or None if it is beyond the restricted grammar"""
+    return compile_tree(equation, is_condition_allowed=False)
+
+
+@lru_cache(maxsize=1024)
+def compile_expression(expression):
+    """
+    return the compiled expression of a virtual point, an arithmetic expression with conditions or a piecewise
+    function, or None if it is beyond the restricted grammar
+    """
+    return compile_tree(expression, is_condition_allowed=True)
+
+
+def compile_tree(equation, is_condition_allowed):
+    try:
+        # '^' is converted before parsing as sympify does, so that it has the precedence of '**'
+        tree = ast.parse(equation.strip().replace('^', '**'), mode='eval')
+        variable_name_list = list()
+        pair_list = get_pairs(tree.body) if is_condition_allowed else None
+        if pair_list is not None:
+            function = compile_piecewise(pair_list, variable_name_list)
+        else:
+            function = compile_node(tree.body, NUMBER, variable_name_list, is_condition_allowed)
+    except (SyntaxError, ValueError):
+        return None
+    return Equation(equation, function, tuple(sorted(set(variable_name_list))))
+
+
+def get_pairs(node):
+    """return the pairs of value and condition of a piecewise function, or None if the node is not piecewise"""
+    if not isinstance(node, ast.Tuple) or len(node.elts) == 0:
+        return None
+    if all(isinstance(element, ast.Tuple) and len(element.elts) == 2 for element in node.elts):
+        return node.elts
+    if len(node.elts) == 2 and not any(isinstance(element, ast.Tuple) for element in node.elts):
+        # a piecewise function of one pair
+        return [node]
+    return None
+
+
+def compile_piecewise(pair_list, variable_name_list):
+    value_list = [compile_node(pair.elts[0], NUMBER, variable_name_list, True) for pair in pair_list]
+    condition_list = [compile_node(pair.elts[1], BOOLEAN, variable_name_list, True) for pair in pair_list]
+
+    def piecewise(value_dict):
+        conditions = [condition(value_dict) for condition in condition_list]
+        values = [value(value_dict) for value in value_list]
+        shape = np.broadcast_shapes(*[np.shape(item) for item in conditions + values])
+        # the result is not a number where no condition is true, as Piecewise of SymPy
+        return np.select([np.broadcast_to(condition, shape) for condition in conditions],
+                         [np.broadcast_to(value, shape) for value in values], default=np.nan)
+    return piecewise
+
+
+def compile_node(node, kind, variable_name_list, is_condition_allowed):
+    """
+    compile the node of the kind NUMBER or BOOLEAN into a function of the dict of arrays of values,
+    and collect the names of variables, raise ValueError if the node is beyond the restricted grammar
+    """
+    def compile_child(child, child_kind):
+        return compile_node(child, child_kind, variable_name_list, is_condition_allowed)
+
+    if kind == NUMBER:
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            operator = BINARY_OPERATORS[type(node.op)]
+            left, right = compile_child(node.left, NUMBER), compile_child(node.right, NUMBER)
+            return lambda value_dict: operator(left(value_dict), right(value_dict))
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            operator = UNARY_OPERATORS[type(node.op)]
+            operand = compile_child(node.operand, NUMBER)
+            return lambda value_dict: operator(operand(value_dict))
+        elif isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            value = np.float64(node.value)
+            return lambda value_dict: value
+        elif isinstance(node, ast.Name) and node.id not in FUNCTIONS:
+            name = node.id
+            if name in CONSTANTS:
+                # a variable named as a constant is taken as the variable
+                constant = CONSTANTS[name]
+                return lambda value_dict: value_dict.get(name, constant)
+            variable_name_list.append(name)
+            return lambda value_dict: value_dict[name]
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS \
+                and len(node.keywords) == 0:
+            function, number_of_arguments = FUNCTIONS[node.func.id]
+            if len(node.args) == 0 or (number_of_arguments is not None and len(node.args) != number_of_arguments):
+                raise ValueError("wrong number of arguments of " + node.func.id)
+            argument_list = [compile_child(argument, NUMBER) for argument in node.args]
+            return lambda value_dict: reduce(function, [argument(value_dict) for argument in argument_list]) \
+                if number_of_arguments is None else function(argument_list[0](value_dict))
+        elif isinstance(node, ast.IfExp) and is_condition_allowed:
+            test = compile_child(node.test, BOOLEAN)
+            body, orelse = compile_child(node.body, NUMBER), compile_child(node.orelse, NUMBER)
+            return lambda value_dict: np.where(test(value_dict), body(value_dict), orelse(value_dict))
+    elif kind == BOOLEAN and is_condition_allowed:
+        if isinstance(node, ast.Compare) and all(type(op) in COMPARISON_OPERATORS for op in node.ops):
+            # chained comparisons are true if all the comparisons are true
+            operand_list = [compile_child(operand, NUMBER) for operand in [node.left] + node.comparators]
+            operator_list = [COMPARISON_OPERATORS[type(op)] for op in node.ops]
+
+            def compare(value_dict):
+                values = [operand(value_dict) for operand in operand_list]
+                return reduce(np.logical_and, [operator_list[i](values[i], values[i + 1])
+                                               for i in range(len(operator_list))])
+            return compare
+        elif isinstance(node, ast.BoolOp) or (isinstance(node, ast.BinOp) and
+                                              type(node.op) in (ast.BitAnd, ast.BitOr)):
+            operator = np.logical_and if isinstance(node.op, (ast.And, ast.BitAnd)) else np.logical_or
+            operand_list = [compile_child(operand, BOOLEAN) for operand in
+                            (node.values if isinstance(node, ast.BoolOp) else (node.left, node.right))]
+            return lambda value_dict: reduce(operator, [operand(value_dict) for operand in operand_list])
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.Invert)):
+            operand = compile_child(node.operand, BOOLEAN)
+            return lambda value_dict: np.logical_not(operand(value_dict))
+        elif isinstance(node, ast.Constant) and type(node.value) is bool:
+            value = np.bool_(node.value)
+            return lambda value_dict: value
+    raise ValueError("unsupported " + kind + " " + type(node).__name__)
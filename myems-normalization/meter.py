@@ -2,19 +2,27 @@ import random
 import time
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal
+from itertools import groupby
 from multiprocessing import Pool
 import mysql.connector
 import config
+import connection
 
 
 ########################################################################################################################
 # PROCEDURES:
 # Step 1: Query all meters and associated energy value points
-# Step 2: Create multiprocessing pool to call worker in parallel
+# Step 2: Call worker in parallel by the multiprocessing pool
+#
+# NOTE: with METER_NORMALIZATION_MODE=batch, meters are normalized in groups by batch_worker, see calculate_batches
 ########################################################################################################################
 
 
 def calculate_hourly(logger):
+    # the pool is kept across cycles, and every worker process keeps its connection pools, see connection.py
+    p = Pool(processes=config.pool_size,
+             initializer=connection.initialize,
+             initargs=(logger, (config.myems_energy_db, config.myems_historical_db)))
 
     while True:
         ################################################################################################################
@@ -79,12 +87,16 @@ def calculate_hourly(logger):
         print("Got all meters in MyEMS System Database")
 
         ################################################################################################################
-        # Step 2: Create multiprocessing pool to call worker in parallel
+        # Step 2: Call worker in parallel by the multiprocessing pool
         ################################################################################################################
-        p = Pool(processes=config.pool_size)
-        error_list = p.map(worker, meter_list)
-        p.close()
-        p.join()
+        try:
+            if config.meter_normalization_mode == 'batch':
+                error_list = calculate_batches(p, meter_list)
+            else:
+                error_list = p.map(worker, meter_list)
+        except Exception as e:
+            # a task raised an error instead of returning it, go on with the next cycle
+            error_list = ["Error in step 2 of meter.calculate_hourly " + str(e)]
 
         for error in error_list:
             if error is not None and len(error) > 0:
@@ -114,22 +126,17 @@ def worker(meter):
     cnx_energy_db = None
     cursor_energy_db = None
     try:
-        cnx_energy_db = mysql.connector.connect(**config.myems_energy_db)
+        cnx_energy_db = connection.connect(config.myems_energy_db)
         cursor_energy_db = cnx_energy_db.cursor()
     except Exception as e:
         error_string = "Error in step 1.1 of meter.worker " + str(e) + " for '" + meter['name'] + "'"
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
-    # get the initial start datetime from config file in case there is no energy data
-    start_datetime_utc = datetime.strptime(config.start_datetime_utc, '%Y-%m-%d %H:%M:%S')
-    start_datetime_utc = start_datetime_utc.replace(tzinfo=timezone.utc)
-    start_datetime_utc = start_datetime_utc.replace(minute=0, second=0, microsecond=0)
-
     try:
         query = (" SELECT MAX(start_datetime_utc) "
                  " FROM tbl_meter_hourly "
@@ -141,38 +148,19 @@ def worker(meter):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
-        print(error_string)
-        return error_string
-
-    if row_datetime is not None and len(row_datetime) > 0 and isinstance(row_datetime[0], datetime):
-        start_datetime_utc = row_datetime[0].replace(tzinfo=timezone.utc)
-        # replace second and microsecond with 0
-        # NOTE: DO NOT replace minute in case of calculating in half hourly
-        start_datetime_utc = start_datetime_utc.replace(second=0, microsecond=0)
-        # start from the next time slot
-        start_datetime_utc += timedelta(minutes=config.minutes_to_count)
-
-    end_datetime_utc = datetime.utcnow().replace(tzinfo=timezone.utc)
-    # we should allow myems-cleaning service to take at most [minutes_to_clean] minutes to clean the data
-    end_datetime_utc -= timedelta(minutes=config.minutes_to_clean)
-
-    time_difference = end_datetime_utc - start_datetime_utc
-    time_difference_in_minutes = time_difference / timedelta(minutes=1)
-    if time_difference_in_minutes < config.minutes_to_count:
-        error_string = "it's too early to calculate" + " for '" + meter['name'] + "'"
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
-    # trim end_datetime_utc
-    trimmed_end_datetime_utc = start_datetime_utc + timedelta(minutes=config.minutes_to_count)
-    while trimmed_end_datetime_utc <= end_datetime_utc:
-        trimmed_end_datetime_utc += timedelta(minutes=config.minutes_to_count)
-
-    end_datetime_utc = trimmed_end_datetime_utc - timedelta(minutes=config.minutes_to_count)
+    start_datetime_utc, end_datetime_utc = get_period(row_datetime[0] if row_datetime is not None and
+                                                      len(row_datetime) > 0 else None)
 
     if end_datetime_utc <= start_datetime_utc:
         error_string = "it's too early to calculate" + " for '" + meter['name'] + "'"
+        if cursor_energy_db:
+            cursor_energy_db.close()
+        if cnx_energy_db:
+            connection.release(cnx_energy_db)
         print(error_string)
         return error_string
 
@@ -186,19 +174,19 @@ def worker(meter):
     cnx_historical_db = None
     cursor_historical_db = None
     try:
-        cnx_historical_db = mysql.connector.connect(**config.myems_historical_db)
+        cnx_historical_db = connection.connect(config.myems_historical_db)
         cursor_historical_db = cnx_historical_db.cursor()
     except Exception as e:
         error_string = "Error in step 1.2 of meter.worker " + str(e) + " for '" + meter['name'] + "'"
         if cursor_historical_db:
             cursor_historical_db.close()
         if cnx_historical_db:
-            cnx_historical_db.close()
+            connection.release(cnx_historical_db)
 
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
 
         print(error_string)
         return error_string
@@ -222,12 +210,12 @@ def worker(meter):
         if cursor_historical_db:
             cursor_historical_db.close()
         if cnx_historical_db:
-            cnx_historical_db.close()
+            connection.release(cnx_historical_db)
 
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
 
         print(error_string)
         return error_string
@@ -246,7 +234,7 @@ def worker(meter):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
 
         print(error_string)
         return error_string
@@ -254,7 +242,7 @@ def worker(meter):
         if cursor_historical_db:
             cursor_historical_db.close()
         if cnx_historical_db:
-            cnx_historical_db.close()
+            connection.release(cnx_historical_db)
 
     ####################################################################################################################
     # Step 3: Normalize energy values by minutes_to_count
@@ -338,71 +326,14 @@ def worker(meter):
     # 300346191	1003344	2019-03-14 01:25:00	0	            1
     ####################################################################################################################
 
-    normalized_values = list()
-    if rows_energy_values is None or len(rows_energy_values) == 0:
-        # NOTE: there isn't any value to be normalized
-        # that means the meter is offline or all values are bad
-        current_datetime_utc = start_datetime_utc
-        while current_datetime_utc < end_datetime_utc:
-            normalized_values.append({'start_datetime_utc': current_datetime_utc, 'actual_value': Decimal(0.0)})
-            current_datetime_utc += timedelta(minutes=config.minutes_to_count)
-    else:
-        maximum = Decimal(0.0)
-        if energy_value_just_before_start is not None and \
-                len(energy_value_just_before_start) > 0 and \
-                energy_value_just_before_start['actual_value'] > Decimal(0.0):
-            maximum = energy_value_just_before_start['actual_value']
-
-        current_datetime_utc = start_datetime_utc
-        while current_datetime_utc < end_datetime_utc:
-            initial_maximum = maximum
-            # get all energy values in current time slot
-            current_energy_values = list()
-            while len(rows_energy_values) > 0:
-                row_energy_value = rows_energy_values.pop(0)
-                energy_value_datetime = row_energy_value[0].replace(tzinfo=timezone.utc)
-                if energy_value_datetime < current_datetime_utc + timedelta(minutes=config.minutes_to_count):
-                    current_energy_values.append(row_energy_value)
-                else:
-                    rows_energy_values.insert(0, row_energy_value)
-                    break
-
-            # get the energy increment one by one in current time slot
-            increment = Decimal(0.0)
-            # maximum should be equal to the maximum value of last time here
-            for index in range(len(current_energy_values)):
-                current_energy_value = current_energy_values[index]
-                if maximum < current_energy_value[1]:
-                    increment += current_energy_value[1] - maximum
-                maximum = current_energy_value[1]
-
-            # omit huge initial value for a new meter
-            # or omit huge value for a recovered meter with zero values during failure
-            # NOTE: this method may cause the lose of energy consumption in this time slot
-            if initial_maximum <= Decimal(0.1):
-                increment = Decimal(0.0)
-
-            # check with hourly low limit
-            if increment < meter['hourly_low_limit']:
-                increment = Decimal(0.0)
-
-            # check with hourly high limit
-            # NOTE: this method may cause the lose of energy consumption in this time slot
-            if increment > meter['hourly_high_limit']:
-                increment = Decimal(0.0)
-
-            meta_data = {'start_datetime_utc': current_datetime_utc,
-                         'actual_value': increment}
-            # append mete_data
-            normalized_values.append(meta_data)
-            current_datetime_utc += timedelta(minutes=config.minutes_to_count)
+    normalized_values = normalize(meter, rows_energy_values, energy_value_just_before_start,
+                                  start_datetime_utc, end_datetime_utc)
 
     ####################################################################################################################
     # Step 4: Insert into energy database
     ####################################################################################################################
-    while len(normalized_values) > 0:
-        insert_100 = normalized_values[:100]
-        normalized_values = normalized_values[100:]
+    for i in range(0, len(normalized_values), 100):
+        insert_100 = normalized_values[i:i + 100]
         try:
             add_values = (" INSERT INTO tbl_meter_hourly (meter_id, start_datetime_utc, actual_value) "
                           " VALUES  ")
@@ -419,7 +350,7 @@ def worker(meter):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
 
             print(error_string)
             return error_string
@@ -427,7 +358,299 @@ def worker(meter):
     if cursor_energy_db:
         cursor_energy_db.close()
     if cnx_energy_db:
-        cnx_energy_db.close()
+        connection.release(cnx_energy_db)
 
     print("End of processing meter: " + "'" + meter['name'] + "'")
     return None
+
+
+########################################################################################################################
+# Normalize energy values by minutes_to_count in one forward pass.
+# The energy values are sorted by utc_date_time, so every time slot takes the values from the current index until the
+# first value of the next time slot, and every value is visited once.
+########################################################################################################################
+
+def normalize(meter, rows_energy_values, energy_value_just_before_start, start_datetime_utc, end_datetime_utc):
+    """
+    get the energy increments of the time slots between start_datetime_utc and end_datetime_utc
+    :param meter: dict of hourly_low_limit and hourly_high_limit
+    :param rows_energy_values: list of (utc_date_time, actual_value) sorted by utc_date_time
+    :param energy_value_just_before_start: dict of the latest energy value before start_datetime_utc, or empty dict
+    :return: list of dict of start_datetime_utc and actual_value
+    """
+    normalized_values = list()
+    if rows_energy_values is None or len(rows_energy_values) == 0:
+        # NOTE: there isn't any value to be normalized
+        # that means the meter is offline or all values are bad
+        current_datetime_utc = start_datetime_utc
+        while current_datetime_utc < end_datetime_utc:
+            normalized_values.append({'start_datetime_utc': current_datetime_utc, 'actual_value': Decimal(0.0)})
+            current_datetime_utc += timedelta(minutes=config.minutes_to_count)
+        return normalized_values
+
+    maximum = Decimal(0.0)
+    if energy_value_just_before_start is not None and \
+            len(energy_value_just_before_start) > 0 and \
+            energy_value_just_before_start['actual_value'] > Decimal(0.0):
+        maximum = energy_value_just_before_start['actual_value']
+
+    index = 0
+    current_datetime_utc = start_datetime_utc
+    while current_datetime_utc < end_datetime_utc:
+        next_datetime_utc = current_datetime_utc + timedelta(minutes=config.minutes_to_count)
+        initial_maximum = maximum
+        # get the energy increment one by one in current time slot
+        increment = Decimal(0.0)
+        # maximum should be equal to the maximum value of last time here
+        while index < len(rows_energy_values) and \
+                rows_energy_values[index][0].replace(tzinfo=timezone.utc) < next_datetime_utc:
+            actual_value = rows_energy_values[index][1]
+            if maximum < actual_value:
+                increment += actual_value - maximum
+            maximum = actual_value
+            index += 1
+
+        # omit huge initial value for a new meter
+        # or omit huge value for a recovered meter with zero values during failure
+        # NOTE: this method may cause the lose of energy consumption in this time slot
+        if initial_maximum <= Decimal(0.1):
+            increment = Decimal(0.0)
+
+        # check with hourly low limit
+        if increment < meter['hourly_low_limit']:
+            increment = Decimal(0.0)
+
+        # check with hourly high limit
+        # NOTE: this method may cause the lose of energy consumption in this time slot
+        if increment > meter['hourly_high_limit']:
+            increment = Decimal(0.0)
+
+        normalized_values.append({'start_datetime_utc': current_datetime_utc,
+                                  'actual_value': increment})
+        current_datetime_utc = next_datetime_utc
+    return normalized_values
+
+
+def get_period(max_start_datetime_utc):
+    """
+    get the start datetime and end datetime of the time slots to be normalized
+    :param max_start_datetime_utc: the latest start_datetime_utc in tbl_meter_hourly of the meter, or None
+    :return: tuple of start_datetime_utc and end_datetime_utc, it's too early to calculate if end is not after start
+    """
+    if isinstance(max_start_datetime_utc, datetime):
+        start_datetime_utc = max_start_datetime_utc.replace(tzinfo=timezone.utc)
+        # replace second and microsecond with 0
+        # NOTE: DO NOT replace minute in case of calculating in half hourly
+        start_datetime_utc = start_datetime_utc.replace(second=0, microsecond=0)
+        # start from the next time slot
+        start_datetime_utc += timedelta(minutes=config.minutes_to_count)
+    else:
+        # get the initial start datetime from config file in case there is no energy data
+        start_datetime_utc = datetime.strptime(config.start_datetime_utc, '%Y-%m-%d %H:%M:%S')
+        start_datetime_utc = start_datetime_utc.replace(tzinfo=timezone.utc)
+        start_datetime_utc = start_datetime_utc.replace(minute=0, second=0, microsecond=0)
+
+    end_datetime_utc = datetime.utcnow().replace(tzinfo=timezone.utc)
+    # we should allow myems-cleaning service to take at most [minutes_to_clean] minutes to clean the data
+    end_datetime_utc -= timedelta(minutes=config.minutes_to_clean)
+
+    # trim end_datetime_utc to the end of the last whole time slot
+    trimmed_end_datetime_utc = start_datetime_utc + timedelta(minutes=config.minutes_to_count)
+    while trimmed_end_datetime_utc <= end_datetime_utc:
+        trimmed_end_datetime_utc += timedelta(minutes=config.minutes_to_count)
+
+    return start_datetime_utc, trimmed_end_datetime_utc - timedelta(minutes=config.minutes_to_count)
+
+
+########################################################################################################################
+# Batched normalization of meters, with METER_NORMALIZATION_MODE=batch.
+# The latest time slots of all meters are queried with one grouped query, and meters are normalized in groups of
+# METER_BATCH_SIZE meters by batch_worker in the pool of worker processes:
+# Step 1: Determine the start datetime and end datetime of every meter in the group
+# Step 2: Get the values just before start of all meters in the group with one query
+# Step 3: Stream the raw data of all points in the group with one range query ordered by point, and normalize
+# Step 4: Insert the normalized values of the group into energy database with bulk inserts in one transaction
+########################################################################################################################
+
+# the number of rows fetched at a time from the range query of a group
+FETCH_SIZE = 10000
+# the number of rows in one bulk insert into tbl_meter_hourly
+INSERT_BATCH_SIZE = 1000
+
+
+def calculate_batches(pool, meter_list):
+    """normalize meters in groups by batch_worker in the pool, return the list of errors"""
+    cnx_energy_db_latest = None
+    cursor_energy_db_latest = None
+    try:
+        cnx_energy_db_latest = mysql.connector.connect(**config.myems_energy_db)
+        cursor_energy_db_latest = cnx_energy_db_latest.cursor()
+        # the index on meter_id and start_datetime_utc makes it a loose index scan
+        cursor_energy_db_latest.execute(" SELECT meter_id, MAX(start_datetime_utc) "
+                                        " FROM tbl_meter_hourly "
+                                        " GROUP BY meter_id ")
+        max_start_datetime_dict = dict(cursor_energy_db_latest.fetchall())
+    except Exception as e:
+        return ["Error in step 2.1 of meter.calculate_batches " + str(e)]
+    finally:
+        if cursor_energy_db_latest:
+            cursor_energy_db_latest.close()
+        if cnx_energy_db_latest:
+            cnx_energy_db_latest.close()
+
+    for meter in meter_list:
+        meter['max_start_datetime_utc'] = max_start_datetime_dict.get(meter['id'])
+
+    # meters of adjacent points are grouped together for range scans of the index on point_id and utc_date_time
+    meter_list = sorted(meter_list, key=lambda item: item['point_id'])
+    group_list = [meter_list[i:i + config.meter_batch_size]
+                  for i in range(0, len(meter_list), config.meter_batch_size)]
+    # shuffle the groups for randomly calculating
+    random.shuffle(group_list)
+
+    error_list = list()
+    for group_error_list in pool.map(batch_worker, group_list):
+        error_list.extend(group_error_list)
+    return error_list
+
+
+def batch_worker(meter_group):
+    """normalize a group of meters, return the list of errors"""
+    print("Start to process a group of " + str(len(meter_group)) + " meters")
+    cnx_energy_db = None
+    cursor_energy_db = None
+    cnx_historical_db = None
+    cursor_historical_db = None
+
+    def close_connections():
+        # the borrowed connections are given back to the connection pools of the process
+        if cursor_historical_db:
+            cursor_historical_db.close()
+        if cnx_historical_db:
+            connection.release(cnx_historical_db)
+        if cursor_energy_db:
+            cursor_energy_db.close()
+        if cnx_energy_db:
+            connection.release(cnx_energy_db)
+
+    try:
+        cnx_energy_db = connection.connect(config.myems_energy_db)
+        cursor_energy_db = cnx_energy_db.cursor()
+        cnx_historical_db = connection.connect(config.myems_historical_db)
+        cursor_historical_db = cnx_historical_db.cursor()
+    except Exception as e:
+        error_string = "Error in step 1.1 of meter.batch_worker " + str(e)
+        close_connections()
+        print(error_string)
+        return [error_string]
+
+    ####################################################################################################################
+    # Step 1: Determine the start datetime and end datetime of every meter in the group
+    ####################################################################################################################
+    meter_period_list = list()
+    for meter in meter_group:
+        start_datetime_utc, end_datetime_utc = get_period(meter['max_start_datetime_utc'])
+        if end_datetime_utc <= start_datetime_utc:
+            print("it's too early to calculate" + " for '" + meter['name'] + "'")
+            continue
+        meter_period_list.append((meter, start_datetime_utc, end_datetime_utc))
+
+    if len(meter_period_list) == 0:
+        close_connections()
+        return list()
+
+    try:
+        ################################################################################################################
+        # Step 2: Get the values just before start of all meters in the group with one query
+        ################################################################################################################
+        query = " UNION ALL ".join([" (SELECT %s, utc_date_time, actual_value "
+                                    "  FROM tbl_energy_value "
+                                    "  WHERE point_id = %s AND utc_date_time < %s AND is_bad = 0 "
+                                    "  ORDER BY utc_date_time DESC "
+                                    "  LIMIT 1) "] * len(meter_period_list))
+        parameters = list()
+        for index, (meter, start_datetime_utc, end_datetime_utc) in enumerate(meter_period_list):
+            parameters.extend((index, meter['point_id'], start_datetime_utc))
+        cursor_historical_db.execute(query, parameters)
+        energy_value_just_before_start_dict = dict()
+        for row in cursor_historical_db.fetchall():
+            energy_value_just_before_start_dict[int(row[0])] = {"utc_date_time": row[1], "actual_value": row[2]}
+    except Exception as e:
+        error_string = "Error in step 2.1 of meter.batch_worker " + str(e)
+        print(error_string)
+        close_connections()
+        return [error_string]
+
+    ####################################################################################################################
+    # Step 3: Stream the raw data of all points in the group with one range query ordered by point, and normalize
+    ####################################################################################################################
+    normalized_row_list = list()
+    normalized_index_set = set()
+
+    def normalize_meters(point_id, rows_point_values):
+        for index, (meter, start_datetime_utc, end_datetime_utc) in enumerate(meter_period_list):
+            if meter['point_id'] != point_id:
+                continue
+            start_datetime = start_datetime_utc.replace(tzinfo=None)
+            end_datetime = end_datetime_utc.replace(tzinfo=None)
+            rows_energy_values = [row for row in rows_point_values if start_datetime <= row[0] < end_datetime]
+            for normalized_value in normalize(meter, rows_energy_values,
+                                              energy_value_just_before_start_dict.get(index, dict()),
+                                              start_datetime_utc, end_datetime_utc):
+                normalized_row_list.append((meter['id'],
+                                            normalized_value['start_datetime_utc'].replace(tzinfo=None),
+                                            normalized_value['actual_value']))
+            normalized_index_set.add(index)
+
+    try:
+        query = (" SELECT point_id, utc_date_time, actual_value "
+                 " FROM tbl_energy_value "
+                 " WHERE is_bad = 0 AND (" +
+                 " OR ".join([" (point_id = %s AND utc_date_time >= %s AND utc_date_time < %s) "] *
+                             len(meter_period_list)) +
+                 " ) "
+                 " ORDER BY point_id, utc_date_time ")
+        parameters = list()
+        for meter, start_datetime_utc, end_datetime_utc in meter_period_list:
+            parameters.extend((meter['point_id'], start_datetime_utc, end_datetime_utc))
+        cursor_historical_db.execute(query, parameters)
+
+        # the values of one point are kept in memory at a time
+        def fetch_rows():
+            while True:
+                rows = cursor_historical_db.fetchmany(FETCH_SIZE)
+                if rows is None or len(rows) == 0:
+                    break
+                yield from rows
+
+        for point_id, rows in groupby(fetch_rows(), key=lambda item: item[0]):
+            normalize_meters(point_id, [(row[1], row[2]) for row in rows])
+
+        # NOTE: there isn't any value of the rest meters to be normalized
+        for index, (meter, start_datetime_utc, end_datetime_utc) in enumerate(meter_period_list):
+            if index not in normalized_index_set:
+                normalize_meters(meter['point_id'], list())
+    except Exception as e:
+        error_string = "Error in step 3.1 of meter.batch_worker " + str(e)
+        print(error_string)
+        close_connections()
+        return [error_string]
+
+    ####################################################################################################################
+    # Step 4: Insert the normalized values of the group into energy database with bulk inserts in one transaction
+    ####################################################################################################################
+    try:
+        for i in range(0, len(normalized_row_list), INSERT_BATCH_SIZE):
+            # executemany of INSERT is sent as one multi-row INSERT statement
+            cursor_energy_db.executemany(" INSERT INTO tbl_meter_hourly (meter_id, start_datetime_utc, actual_value) "
+                                         " VALUES (%s, %s, %s) ", normalized_row_list[i:i + INSERT_BATCH_SIZE])
+        cnx_energy_db.commit()
+    except Exception as e:
+        error_string = "Error in step 4.1 of meter.batch_worker " + str(e)
+        print(error_string)
+        close_connections()
+        return [error_string]
+
+    close_connections()
+    print("End of processing a group of " + str(len(meter_group)) + " meters")
+    return list()
@@ -5,16 +5,27 @@ from decimal import Decimal
 from multiprocessing import Pool
 import mysql.connector
 from sympy import sympify
+import numpy as np
 import config
+import connection
+import equation
 
 
 ########################################################################################################################
 # PROCEDURES:
-# Step 1: Query all virtual meters
-# Step 2: Create multiprocessing pool to call worker in parallel
+# Step 1: Query all virtual meters and the virtual meters in their equations
+# Step 2: Call worker in parallel by the multiprocessing pool, level by level in dependency order
+#
+# NOTE: a virtual meter is calculated after all the virtual meters in its equation, so that new time slots are
+# propagated through any depth of nested virtual meters in one cycle. Virtual meters in the same level do not depend on
+# each other and they are calculated in parallel.
 ########################################################################################################################
 
 def calculate_hourly(logger):
+    # the pool is kept across cycles, and every worker process keeps its connection pools, see connection.py
+    p = Pool(processes=config.pool_size,
+             initializer=connection.initialize,
+             initargs=(logger, (config.myems_system_db, config.myems_energy_db)))
 
     while True:
         # the outermost while loop to reconnect server if there is a connection error
@@ -36,6 +47,7 @@ def calculate_hourly(logger):
         print("Connected to MyEMS System Database")
 
         virtual_meter_list = list()
+        dependency_list = list()
         try:
             cursor_system_db.execute(" SELECT id, name, equation "
                                      " FROM tbl_virtual_meters "
@@ -51,6 +63,15 @@ def calculate_hourly(logger):
                 meta_result = {"id": row[0], "name": row[1], "equation": row[2]}
                 virtual_meter_list.append(meta_result)
 
+            # the virtual meters in the equations of virtual meters
+            cursor_system_db.execute(" SELECT virtual_meter_id, meter_id "
+                                     " FROM tbl_variables "
+                                     " WHERE meter_type = 'virtual_meter' ")
+            rows_variables = cursor_system_db.fetchall()
+            if rows_variables is not None and len(rows_variables) > 0:
+                for row in rows_variables:
+                    dependency_list.append((row[0], row[1]))
+
         except Exception as e:
             logger.error("Error in step 1 of virtual meter calculate hourly " + str(e))
             # sleep and continue the outer loop to reconnect the database
@@ -62,27 +83,70 @@ def calculate_hourly(logger):
             if cnx_system_db:
                 cnx_system_db.close()
 
-        # shuffle the virtual meter list for randomly calculating the meter hourly value
-        random.shuffle(virtual_meter_list)
+        level_list, cyclic_list = get_levels(virtual_meter_list, dependency_list)
+        if len(cyclic_list) > 0:
+            logger.error("Error in step 1 of virtual meter calculate hourly, virtual meters in or depending on "
+                         "circular references are skipped: " +
+                         ", ".join("'" + virtual_meter['name'] + "'" for virtual_meter in cyclic_list))
 
         print("Got all virtual meters in MyEMS System Database")
         ################################################################################################################
-        # Step 2: Create multiprocessing pool to call worker in parallel
+        # Step 2: Call worker in parallel by the multiprocessing pool, level by level in dependency order
         ################################################################################################################
-        p = Pool(processes=config.pool_size)
-        error_list = p.map(worker, virtual_meter_list)
-        p.close()
-        p.join()
-
-        for error in error_list:
-            if error is not None and len(error) > 0:
-                logger.error(error)
+        for level in level_list:
+            # shuffle the virtual meter list for randomly calculating the meter hourly value
+            random.shuffle(level)
+            try:
+                error_list = p.map(worker, level)
+            except Exception as e:
+                # a task raised an error instead of returning it, go on with the next level
+                error_list = ["Error in step 2 of virtual meter calculate hourly " + str(e)]
+
+            for error in error_list:
+                if error is not None and len(error) > 0:
+                    logger.error(error)
 
         print("go to sleep ...")
         time.sleep(60)
         print("wake from sleep, and continue to work...")
 
 
+def get_levels(virtual_meter_list, dependency_list):
+    """
+    sort virtual meters into levels of the dependency graph in topological order
+    :param virtual_meter_list: list of virtual meters
+    :param dependency_list: list of (virtual meter id, id of a virtual meter in its equation)
+    :return: tuple of list of levels, every level is a list of virtual meters which depend on the previous levels only,
+             and list of virtual meters in or depending on circular references
+    """
+    virtual_meter_dict = {virtual_meter['id']: virtual_meter for virtual_meter in virtual_meter_list}
+    # the number of virtual meters in the equation of each virtual meter, and the dependents of each virtual meter
+    in_degree_dict = {virtual_meter_id: 0 for virtual_meter_id in virtual_meter_dict.keys()}
+    dependent_dict = {virtual_meter_id: list() for virtual_meter_id in virtual_meter_dict.keys()}
+    for virtual_meter_id, input_virtual_meter_id in set(dependency_list):
+        # the variables of deleted virtual meters are ignored
+        if virtual_meter_id in virtual_meter_dict and input_virtual_meter_id in virtual_meter_dict:
+            in_degree_dict[virtual_meter_id] += 1
+            dependent_dict[input_virtual_meter_id].append(virtual_meter_id)
+
+    level_list = list()
+    current_level = [virtual_meter_id for virtual_meter_id, in_degree in in_degree_dict.items() if in_degree == 0]
+    while len(current_level) > 0:
+        level_list.append([virtual_meter_dict[virtual_meter_id] for virtual_meter_id in current_level])
+        next_level = list()
+        for virtual_meter_id in current_level:
+            for dependent_id in dependent_dict[virtual_meter_id]:
+                in_degree_dict[dependent_id] -= 1
+                if in_degree_dict[dependent_id] == 0:
+                    next_level.append(dependent_id)
+        current_level = next_level
+
+    # the virtual meters never reaching in degree 0 are in circular references or depend on them
+    cyclic_list = [virtual_meter_dict[virtual_meter_id] for virtual_meter_id, in_degree in in_degree_dict.items()
+                   if in_degree > 0]
+    return level_list, cyclic_list
+
+
 ########################################################################################################################
 # Step 1: get start datetime and end datetime
 # Step 2: parse the expression and get all meters, virtual meters, offline meters associated with the expression
@@ -96,13 +160,13 @@ def worker(virtual_meter):
     cursor_energy_db = None
 
     try:
-        cnx_energy_db = mysql.connector.connect(**config.myems_energy_db)
+        cnx_energy_db = connection.connect(config.myems_energy_db)
         cursor_energy_db = cnx_energy_db.cursor()
     except Exception as e:
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         return "Error in step 1.1 of virtual meter worker " + str(e) + " for '" + virtual_meter['name'] + "'"
 
     print("Start to process virtual meter: " + "'" + virtual_meter['name']+"'")
@@ -122,7 +186,7 @@ def worker(virtual_meter):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         return "Error in step 1.2 of virtual meter worker " + str(e) + " for '" + virtual_meter['name'] + "'"
 
     start_datetime_utc = datetime.strptime(config.start_datetime_utc, '%Y-%m-%d %H:%M:%S')
@@ -144,7 +208,7 @@ def worker(virtual_meter):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         return "it isn't time to calculate" + " for '" + virtual_meter['name'] + "'"
     elif time_difference_in_minutes > 60 * 24 * 30:
         # avoid to caculate records more than one month
@@ -161,7 +225,7 @@ def worker(virtual_meter):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         return "it isn't time to calculate" + " for '" + virtual_meter['name'] + "'"
 
     print("start_datetime_utc: " + start_datetime_utc.isoformat()[0:19]
@@ -174,17 +238,17 @@ def worker(virtual_meter):
     cnx_system_db = None
     cursor_system_db = None
     try:
-        cnx_system_db = mysql.connector.connect(**config.myems_system_db)
+        cnx_system_db = connection.connect(config.myems_system_db)
         cursor_system_db = cnx_system_db.cursor()
     except Exception as e:
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         return "Error in step 2.1 of virtual meter worker " + str(e) + " for '" + virtual_meter['name'] + "'"
 
     meter_list_in_expression = list()
@@ -241,13 +305,13 @@ def worker(virtual_meter):
         if cursor_energy_db:
             cursor_energy_db.close()
         if cnx_energy_db:
-            cnx_energy_db.close()
+            connection.release(cnx_energy_db)
         return "Error in step 2.2 of virtual meter worker " + str(e) + " for '" + virtual_meter['name'] + "'"
     finally:
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
 
     ############################################################################################################
     # Step 3: query energy consumption values from table meter hourly, virtual meter hourly
@@ -276,7 +340,7 @@ def worker(virtual_meter):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             return "Error in step 3.2 virtual meter worker " + str(e) + " for '" + virtual_meter['name'] + "'"
 
     print("getting energy consumption values from myems_energy_db.tbl_virtual_meter_hourly...")
@@ -302,7 +366,7 @@ def worker(virtual_meter):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             return "Error in step 3.3 virtual meter worker " + str(e) + " for '" + virtual_meter['name'] + "'"
 
     print("getting energy consumption values from myems_energy_db.tbl_offline_meter_hourly...")
@@ -328,7 +392,7 @@ def worker(virtual_meter):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             return "Error in step 3.4 virtual meter worker " + str(e) + " for '" + virtual_meter['name'] + "'"
 
     ############################################################################################################
@@ -379,73 +443,115 @@ def worker(virtual_meter):
                     if common_end_datetime_utc > max(energy_hourly.keys()):
                         common_end_datetime_utc = max(energy_hourly.keys())
 
-    print("evaluating the equation with SymPy...")
     normalized_values = list()
+    compiled_equation = equation.compile_equation(virtual_meter['equation'].lower())
+    if compiled_equation is not None:
+        ################################################################################################################
+        # Evaluating the compiled equation on the aligned arrays of values of all time slots at once
+        ################################################################################################################
+        print("evaluating the compiled equation...")
+        try:
+            datetime_list = list()
+            current_datetime_utc = common_start_datetime_utc
+            while common_start_datetime_utc is not None \
+                    and common_end_datetime_utc is not None \
+                    and current_datetime_utc <= common_end_datetime_utc:
+                datetime_list.append(current_datetime_utc)
+                current_datetime_utc += timedelta(minutes=config.minutes_to_count)
+
+            value_dict = dict()
+            for energy_hourly_dict, id_key, expression_list in \
+                    ((energy_meter_hourly, 'meter_id', meter_list_in_expression),
+                     (energy_virtual_meter_hourly, 'virtual_meter_id', virtual_meter_list_in_expression),
+                     (energy_offline_meter_hourly, 'offline_meter_id', offline_meter_list_in_expression)):
+                for item_in_expression in expression_list:
+                    energy_hourly = energy_hourly_dict[str(item_in_expression[id_key])]
+                    value_dict[item_in_expression['variable_name']] = \
+                        np.fromiter((energy_hourly.get(current_datetime_utc, Decimal(0.0))
+                                     for current_datetime_utc in datetime_list),
+                                    dtype=np.float64, count=len(datetime_list))
+
+            if len(datetime_list) > 0:
+                result_list = compiled_equation.evaluate(value_dict, len(datetime_list)).tolist()
+                for current_datetime_utc, actual_value in zip(datetime_list, result_list):
+                    normalized_values.append({'start_datetime_utc': current_datetime_utc,
+                                              'actual_value': actual_value})
+        except Exception as e:
+            if cursor_energy_db:
+                cursor_energy_db.close()
+            if cnx_energy_db:
+                connection.release(cnx_energy_db)
+            return "Error in step 4.1 virtual meter worker " + str(e) + " for '" + virtual_meter['name'] + "'"
+    else:
+        # the equation is beyond the grammar of compiled equations
+        print("evaluating the equation with SymPy...")
+
+        ############################################################################################################
+        # Converting Strings to SymPy Expressions
+        # The sympify function(that’s sympify, not to be confused with simplify) can be used to
+        # convert strings into SymPy expressions.
+        ############################################################################################################
+        try:
+            expr = sympify(virtual_meter['equation'].lower())
+            print("the expression to be evaluated: " + str(expr))
+            current_datetime_utc = common_start_datetime_utc
+            print("common_start_datetime_utc: " + str(common_start_datetime_utc))
+            print("common_end_datetime_utc: " + str(common_end_datetime_utc))
+            while common_start_datetime_utc is not None \
+                    and common_end_datetime_utc is not None \
+                    and current_datetime_utc <= common_end_datetime_utc:
+                meta_data = dict()
+                meta_data['start_datetime_utc'] = current_datetime_utc
+
+                ####################################################################################################
+                # create a dictionary of Symbol: point pairs
+                ####################################################################################################
+
+                subs = dict()
+
+                ####################################################################################################
+                # Evaluating the expression at current_datetime_utc
+                ####################################################################################################
+
+                if meter_list_in_expression is not None and len(meter_list_in_expression) > 0:
+                    for meter_in_expression in meter_list_in_expression:
+                        meter_id = str(meter_in_expression['meter_id'])
+                        actual_value = energy_meter_hourly[meter_id].get(current_datetime_utc, Decimal(0.0))
+                        subs[meter_in_expression['variable_name']] = actual_value
+
+                if virtual_meter_list_in_expression is not None and len(virtual_meter_list_in_expression) > 0:
+                    for virtual_meter_in_expression in virtual_meter_list_in_expression:
+                        virtual_meter_id = str(virtual_meter_in_expression['virtual_meter_id'])
+                        actual_value = energy_virtual_meter_hourly[virtual_meter_id].get(current_datetime_utc,
+                                                                                         Decimal(0.0))
+                        subs[virtual_meter_in_expression['variable_name']] = actual_value
+
+                if offline_meter_list_in_expression is not None and len(offline_meter_list_in_expression) > 0:
+                    for offline_meter_in_expression in offline_meter_list_in_expression:
+                        offline_meter_id = str(offline_meter_in_expression['offline_meter_id'])
+                        actual_value = energy_offline_meter_hourly[offline_meter_id].get(current_datetime_utc,
+                                                                                         Decimal(0.0))
+                        subs[offline_meter_in_expression['variable_name']] = actual_value
+
+                ####################################################################################################
+                # To numerically evaluate an expression with a Symbol at a point,
+                # we might use subs followed by evalf,
+                # but it is more efficient and numerically stable to pass the substitution to evalf
+                # using the subs flag, which takes a dictionary of Symbol: point pairs.
+                ####################################################################################################
+
+                meta_data['actual_value'] = expr.evalf(subs=subs)
+
+                normalized_values.append(meta_data)
+
+                current_datetime_utc += timedelta(minutes=config.minutes_to_count)
 
-    ############################################################################################################
-    # Converting Strings to SymPy Expressions
-    # The sympify function(that’s sympify, not to be confused with simplify) can be used to
-    # convert strings into SymPy expressions.
-    ############################################################################################################
-    try:
-        expr = sympify(virtual_meter['equation'].lower())
-        print("the expression to be evaluated: " + str(expr))
-        current_datetime_utc = common_start_datetime_utc
-        print("common_start_datetime_utc: " + str(common_start_datetime_utc))
-        print("common_end_datetime_utc: " + str(common_end_datetime_utc))
-        while common_start_datetime_utc is not None \
-                and common_end_datetime_utc is not None \
-                and current_datetime_utc <= common_end_datetime_utc:
-            meta_data = dict()
-            meta_data['start_datetime_utc'] = current_datetime_utc
-
-            ####################################################################################################
-            # create a dictionary of Symbol: point pairs
-            ####################################################################################################
-
-            subs = dict()
-
-            ####################################################################################################
-            # Evaluating the expression at current_datetime_utc
-            ####################################################################################################
-
-            if meter_list_in_expression is not None and len(meter_list_in_expression) > 0:
-                for meter_in_expression in meter_list_in_expression:
-                    meter_id = str(meter_in_expression['meter_id'])
-                    actual_value = energy_meter_hourly[meter_id].get(current_datetime_utc, Decimal(0.0))
-                    subs[meter_in_expression['variable_name']] = actual_value
-
-            if virtual_meter_list_in_expression is not None and len(virtual_meter_list_in_expression) > 0:
-                for virtual_meter_in_expression in virtual_meter_list_in_expression:
-                    virtual_meter_id = str(virtual_meter_in_expression['virtual_meter_id'])
-                    actual_value = energy_virtual_meter_hourly[virtual_meter_id].get(current_datetime_utc, Decimal(0.0))
-                    subs[virtual_meter_in_expression['variable_name']] = actual_value
-
-            if offline_meter_list_in_expression is not None and len(offline_meter_list_in_expression) > 0:
-                for offline_meter_in_expression in offline_meter_list_in_expression:
-                    offline_meter_id = str(offline_meter_in_expression['offline_meter_id'])
-                    actual_value = energy_offline_meter_hourly[offline_meter_id].get(current_datetime_utc, Decimal(0.0))
-                    subs[offline_meter_in_expression['variable_name']] = actual_value
-
-            ####################################################################################################
-            # To numerically evaluate an expression with a Symbol at a point,
-            # we might use subs followed by evalf,
-            # but it is more efficient and numerically stable to pass the substitution to evalf
-            # using the subs flag, which takes a dictionary of Symbol: point pairs.
-            ####################################################################################################
-
-            meta_data['actual_value'] = expr.evalf(subs=subs)
-
-            normalized_values.append(meta_data)
-
-            current_datetime_utc += timedelta(minutes=config.minutes_to_count)
-
-    except Exception as e:
-        if cursor_energy_db:
-            cursor_energy_db.close()
-        if cnx_energy_db:
-            cnx_energy_db.close()
-        return "Error in step 4.1 virtual meter worker " + str(e) + " for '" + virtual_meter['name'] + "'"
+        except Exception as e:
+            if cursor_energy_db:
+                cursor_energy_db.close()
+            if cnx_energy_db:
+                connection.release(cnx_energy_db)
+            return "Error in step 4.1 virtual meter worker " + str(e) + " for '" + virtual_meter['name'] + "'"
 
     print("saving energy values to table energy virtual meter hourly...")
 
@@ -469,12 +575,12 @@ def worker(virtual_meter):
             if cursor_energy_db:
                 cursor_energy_db.close()
             if cnx_energy_db:
-                cnx_energy_db.close()
+                connection.release(cnx_energy_db)
             return "Error in step 4.2 virtual meter worker " + str(e) + " for '" + virtual_meter['name'] + "'"
 
     if cursor_energy_db:
         cursor_energy_db.close()
     if cnx_energy_db:
-        cnx_energy_db.close()
+        connection.release(cnx_energy_db)
 
     return None
@@ -1,22 +1,29 @@
 import json
 import random
-import re
 import time
 from datetime import datetime
 from decimal import Decimal
 from multiprocessing import Pool
 import mysql.connector
-from sympy import sympify, Piecewise, symbols
+import numpy as np
+from sympy import sympify
 import config
+import connection
+import equation
 
 
 ########################################################################################################################
 # PROCEDURES:
 # Step 1: Query all virtual points
-# Step 2: Create multiprocessing pool to call worker in parallel
+# Step 2: Call worker in parallel by the multiprocessing pool
 ########################################################################################################################
 
 def calculate(logger):
+    # the pool is kept across cycles, and every worker process keeps its connection pools, see connection.py
+    p = Pool(processes=config.pool_size,
+             initializer=connection.initialize,
+             initargs=(logger, (config.myems_system_db, config.myems_historical_db)))
+
     while True:
         # the outermost while loop to reconnect server if there is a connection error
         cnx_system_db = None
@@ -74,12 +81,13 @@ def calculate(logger):
 
         print("Got all virtual points in MyEMS System Database")
         ################################################################################################################
-        # Step 2: Create multiprocessing pool to call worker in parallel
+        # Step 2: Call worker in parallel by the multiprocessing pool
         ################################################################################################################
-        p = Pool(processes=config.pool_size)
-        error_list = p.map(worker, virtual_point_list)
-        p.close()
-        p.join()
+        try:
+            error_list = p.map(worker, virtual_point_list)
+        except Exception as e:
+            # a task raised an error instead of returning it, go on with the next cycle
+            error_list = ["Error in step 2 of virtual point calculate " + str(e)]
 
         for error in error_list:
             if error is not None and len(error) > 0:
@@ -103,13 +111,13 @@ def worker(virtual_point):
     cursor_historical_db = None
 
     try:
-        cnx_historical_db = mysql.connector.connect(**config.myems_historical_db)
+        cnx_historical_db = connection.connect(config.myems_historical_db)
         cursor_historical_db = cnx_historical_db.cursor()
     except Exception as e:
         if cursor_historical_db:
             cursor_historical_db.close()
         if cnx_historical_db:
-            cnx_historical_db.close()
+            connection.release(cnx_historical_db)
         return "Error in step 1.1 of virtual point worker " + str(e) + " for '" + virtual_point['name'] + "'"
 
     print("Start to process virtual point: " + "'" + virtual_point['name'] + "'")
@@ -125,7 +133,7 @@ def worker(virtual_point):
         if cursor_historical_db:
             cursor_historical_db.close()
         if cnx_historical_db:
-            cnx_historical_db.close()
+            connection.release(cnx_historical_db)
         return "variable point type should not be DIGITAL_VALUE " + " for '" + virtual_point['name'] + "'"
 
     try:
@@ -138,7 +146,7 @@ def worker(virtual_point):
         if cursor_historical_db:
             cursor_historical_db.close()
         if cnx_historical_db:
-            cnx_historical_db.close()
+            connection.release(cnx_historical_db)
         return "Error in step 1.2 of virtual point worker " + str(e) + " for '" + virtual_point['name'] + "'"
 
     start_datetime_utc = datetime.strptime(config.start_datetime_utc, '%Y-%m-%d %H:%M:%S').replace(tzinfo=None)
@@ -152,7 +160,7 @@ def worker(virtual_point):
         if cursor_historical_db:
             cursor_historical_db.close()
         if cnx_historical_db:
-            cnx_historical_db.close()
+            connection.release(cnx_historical_db)
         return "it isn't time to calculate" + " for '" + virtual_point['name'] + "'"
 
     print("start_datetime_utc: " + start_datetime_utc.isoformat()[0:19]
@@ -173,6 +181,10 @@ def worker(virtual_point):
                 or 'substitutions' not in address.keys() \
                 or len(address['expression']) == 0 \
                 or len(address['substitutions']) == 0:
+            if cursor_historical_db:
+                cursor_historical_db.close()
+            if cnx_historical_db:
+                connection.release(cnx_historical_db)
             return "Error in step 2.1 of virtual point worker for '" + virtual_point['name'] + "'"
         expression = address['expression']
         substitutions = address['substitutions']
@@ -182,7 +194,7 @@ def worker(virtual_point):
         if cursor_historical_db:
             cursor_historical_db.close()
         if cnx_historical_db:
-            cnx_historical_db.close()
+            connection.release(cnx_historical_db)
         return "Error in step 2.2 of virtual point worker " + str(e) + " for '" + virtual_point['name'] + "'"
 
     ############################################################################################################
@@ -192,13 +204,17 @@ def worker(virtual_point):
     cnx_system_db = None
     cursor_system_db = None
     try:
-        cnx_system_db = mysql.connector.connect(**config.myems_system_db)
+        cnx_system_db = connection.connect(config.myems_system_db)
         cursor_system_db = cnx_system_db.cursor()
     except Exception as e:
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
+        if cursor_historical_db:
+            cursor_historical_db.close()
+        if cnx_historical_db:
+            connection.release(cnx_historical_db)
         print("Error in step 3 of virtual point worker " + str(e))
         return "Error in step 3 of virtual point worker " + str(e)
 
@@ -211,17 +227,25 @@ def worker(virtual_point):
         rows_points = cursor_system_db.fetchall()
 
         if rows_points is None or len(rows_points) == 0:
+            if cursor_historical_db:
+                cursor_historical_db.close()
+            if cnx_historical_db:
+                connection.release(cnx_historical_db)
             return "Error in step 3.1 of virtual point worker for '" + virtual_point['name'] + "'"
 
         for row in rows_points:
             all_point_dict[row[0]] = row[1]
     except Exception as e:
+        if cursor_historical_db:
+            cursor_historical_db.close()
+        if cnx_historical_db:
+            connection.release(cnx_historical_db)
         return "Error in step 3.2 virtual point worker " + str(e) + " for '" + virtual_point['name'] + "'"
     finally:
         if cursor_system_db:
             cursor_system_db.close()
         if cnx_system_db:
-            cnx_system_db.close()
+            connection.release(cnx_system_db)
     ############################################################################################################
     # Step 4: query points value from historical database
     ############################################################################################################
@@ -233,6 +257,10 @@ def worker(virtual_point):
             for point in point_list:
                 point_object_type = all_point_dict.get(point['point_id'])
                 if point_object_type is None:
+                    if cursor_historical_db:
+                        cursor_historical_db.close()
+                    if cnx_historical_db:
+                        connection.release(cnx_historical_db)
                     return "variable point type should not be None " + " for '" + virtual_point['name'] + "'"
                 if point_object_type == 'ANALOG_VALUE':
                     query = (" SELECT utc_date_time, actual_value "
@@ -260,12 +288,16 @@ def worker(virtual_point):
                         point_values_dict[point['point_id']] = None
                 else:
                     # point type should not be DIGITAL_VALUE
+                    if cursor_historical_db:
+                        cursor_historical_db.close()
+                    if cnx_historical_db:
+                        connection.release(cnx_historical_db)
                     return "variable point type should not be DIGITAL_VALUE " + " for '" + virtual_point['name'] + "'"
         except Exception as e:
             if cursor_historical_db:
                 cursor_historical_db.close()
             if cnx_historical_db:
-                cnx_historical_db.close()
+                connection.release(cnx_historical_db)
             return "Error in step 4.1 virtual point worker " + str(e) + " for '" + virtual_point['name'] + "'"
 
     ############################################################################################################
@@ -273,72 +305,57 @@ def worker(virtual_point):
     ############################################################################################################
 
     print("getting date time set for all points")
-    utc_date_time_set = set()
-    if point_values_dict is not None and len(point_values_dict) > 0:
-        for point_id, point_values in point_values_dict.items():
-            if point_values is not None and len(point_values) > 0:
-                utc_date_time_set = utc_date_time_set.union(point_values.keys())
+    # the expression is evaluated at the date times when all points have values
+    utc_date_time_list = list()
+    if point_list is not None and len(point_list) > 0 \
+            and all(point_values_dict.get(point['point_id']) is not None for point in point_list):
+        utc_date_time_set = set(point_values_dict[point_list[0]['point_id']].keys())
+        for point in point_list[1:]:
+            utc_date_time_set.intersection_update(point_values_dict[point['point_id']].keys())
+        utc_date_time_list = sorted(utc_date_time_set)
 
-    print("evaluating the equation with SymPy")
     normalized_values = list()
 
     ############################################################################################################
-    # Converting Strings to SymPy Expressions
-    # The sympify function(that’s sympify, not to be confused with simplify) can be used to
-    # convert strings into SymPy expressions.
+    # Evaluating the compiled expression on the arrays of points values at once,
+    # the algebraic expressions beyond the restricted grammar are evaluated with SymPy
     ############################################################################################################
     try:
-        if re.search(',', expression):
-            for item in substitutions.keys():
-                locals()[item] = symbols(item)
-            expr = eval(expression)
-            print("the expression will be evaluated as piecewise function: " + str(expr))
+        compiled_expression = equation.compile_expression(expression)
+        if compiled_expression is not None:
+            print("evaluating the compiled expression: " + expression)
+            if len(utc_date_time_list) > 0:
+                value_dict = dict()
+                for point in point_list:
+                    point_values = point_values_dict[point['point_id']]
+                    value_dict[point['variable_name']] = np.array([float(point_values[utc_date_time])
+                                                                   for utc_date_time in utc_date_time_list],
+                                                                  dtype=np.float64)
+                result = compiled_expression.evaluate(value_dict, len(utc_date_time_list))
+                for i in range(len(utc_date_time_list)):
+                    normalized_values.append({'utc_date_time': utc_date_time_list[i],
+                                              'actual_value': Decimal(str(result[i]))})
+        elif ',' in expression:
+            raise ValueError("piecewise function " + expression + " is not supported")
         else:
-            expr = sympify(expression)
-            print("the expression will be evaluated as algebraic expression: " + str(expr))
-
-        for utc_date_time in utc_date_time_set:
-            meta_data = dict()
-            meta_data['utc_date_time'] = utc_date_time
-
-            ####################################################################################################
-            # create a dictionary of Symbol: point pairs
-            ####################################################################################################
-
-            subs = dict()
-
             ####################################################################################################
-            # Evaluating the expression at current_datetime_utc
+            # Converting Strings to SymPy Expressions
+            # The sympify function(that’s sympify, not to be confused with simplify) can be used to
+            # convert strings into SymPy expressions.
             ####################################################################################################
-
-            if point_list is not None and len(point_list) > 0:
+            expr = sympify(expression)
+            print("the expression will be evaluated as algebraic expression with SymPy: " + str(expr))
+            for utc_date_time in utc_date_time_list:
+                subs = dict()
                 for point in point_list:
-                    actual_value = point_values_dict[point['point_id']].get(utc_date_time, None)
-                    if actual_value is None:
-                        break
-                    subs[point['variable_name']] = actual_value
-
-            if len(subs) != len(point_list):
-                continue
-
-            ####################################################################################################
-            # To numerically evaluate an expression with a Symbol at a point,
-            # we might use subs followed by evalf,
-            # but it is more efficient and numerically stable to pass the substitution to evalf
-            # using the subs flag, which takes a dictionary of Symbol: point pairs.
-            ####################################################################################################
-            if re.search(',', expression):
-                formula = Piecewise(*expr)
-                meta_data['actual_value'] = Decimal(str(formula.subs(subs)))
-                normalized_values.append(meta_data)
-            else:
-                meta_data['actual_value'] = Decimal(str(expr.evalf(subs=subs)))
-                normalized_values.append(meta_data)
+                    subs[point['variable_name']] = point_values_dict[point['point_id']][utc_date_time]
+                normalized_values.append({'utc_date_time': utc_date_time,
+                                          'actual_value': Decimal(str(expr.evalf(subs=subs)))})
     except Exception as e:
         if cursor_historical_db:
             cursor_historical_db.close()
         if cnx_historical_db:
-            cnx_historical_db.close()
+            connection.release(cnx_historical_db)
         return "Error in step 5.1 virtual point worker " + str(e) + " for '" + virtual_point['name'] + "'"
 
     print("saving virtual points values to historical database")
@@ -371,7 +388,7 @@ def worker(virtual_point):
                 if cursor_historical_db:
                     cursor_historical_db.close()
                 if cnx_historical_db:
-                    cnx_historical_db.close()
+                    connection.release(cnx_historical_db)
                 return "Error in step 5.2 virtual point worker " + str(e) + " for '" + virtual_point['name'] + "'"
 
         try:
@@ -393,12 +410,12 @@ def worker(virtual_point):
             if cursor_historical_db:
                 cursor_historical_db.close()
             if cnx_historical_db:
-                cnx_historical_db.close()
+                connection.release(cnx_historical_db)
             return "Error in step 5.3 virtual point worker " + str(e) + " for '" + virtual_point['name'] + "'"
 
     if cursor_historical_db:
         cursor_historical_db.close()
     if cnx_historical_db:
-        cnx_historical_db.close()
+        connection.release(cnx_historical_db)
 
     return None